@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+'''
+Compares the time spent encoding and decoding the JSON documents handled by
+the harvesting pipeline with each of the available JSON libraries, and with
+the one picked by ckanext.harvest.codec.
+
+Usage:
+
+    python bin/benchmark_codec.py [{iterations}]
+'''
+import sys
+import timeit
+
+MESSAGE = {'harvest_object_id': u'8b9a3b5e-4d6c-4b0a-9f1e-1c2d3e4f5a6b'}
+
+PACKAGE = {
+    'id': u'2c9d5c1e-6d6b-4c2e-8b0e-3e4f5a6b7c8d',
+    'name': u'test-dataset',
+    'title': u'Test dataset with a reasonably long title',
+    'notes': u'Description of the dataset. ' * 40,
+    'metadata_modified': u'2015-01-01T00:00:00.000000',
+    'tags': [{'name': u'tag-%i' % i} for i in range(10)],
+    'extras': [{'key': u'key-%i' % i, 'value': u'value %i' % i}
+               for i in range(20)],
+    'resources': [{
+        'id': u'resource-%i' % i,
+        'url': u'http://example.com/data/resource-%i.csv' % i,
+        'format': u'CSV',
+        'description': u'Resource description ' * 5,
+    } for i in range(10)],
+    'groups': [],
+    'owner_org': None,
+}
+
+
+def get_libraries():
+    libraries = []
+    import json
+    libraries.append(('json', json.dumps, json.loads))
+    try:
+        import simplejson
+        libraries.append(('simplejson', simplejson.dumps, simplejson.loads))
+    except ImportError:
+        pass
+    try:
+        import ujson
+        libraries.append(('ujson',
+                          lambda o: ujson.dumps(o, escape_forward_slashes=False),
+                          ujson.loads))
+    except ImportError:
+        pass
+    try:
+        from ckanext.harvest import codec
+        libraries.append(('codec (%s)' % codec.backend, codec.dumps, codec.loads))
+    except ImportError:
+        pass
+    return libraries
+
+
+def main(iterations):
+    print '%-20s %-10s %15s %15s' % ('library', 'document', 'encode (us)', 'decode (us)')
+    for name, dumps, loads in get_libraries():
+        for doc_name, doc in (('message', MESSAGE), ('package', PACKAGE)):
+            encoded = dumps(doc)
+            encode = timeit.timeit(lambda: dumps(doc), number=iterations)
+            decode = timeit.timeit(lambda: loads(encoded), number=iterations)
+            print '%-20s %-10s %15.2f %15.2f' % (
+                name, doc_name,
+                encode * 1e6 / iterations, decode * 1e6 / iterations)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
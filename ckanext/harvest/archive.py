@@ -0,0 +1,147 @@
+'''
+Cold storage for the contents of old harvest objects.
+
+Contents are appended, as stored in the database (ie compressed), to segment
+files in the ``ckanext.harvest.archive.dir`` directory. A new segment is
+started once the current one reaches ``ckanext.harvest.archive.segment_size``
+bytes. Segments are never modified once written, and the database keeps the
+segment, offset and length of each archived content. They are read back
+through memory maps, so only the pages actually needed are loaded.
+'''
+import os
+import re
+import mmap
+import errno
+import fcntl
+import logging
+
+from pylons import config
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT_SIZE = 1024 * 1024 * 1024
+
+SEGMENT_NAME = 'segment-%06i.dat'
+SEGMENT_RE = re.compile(r'^segment-(\d{6})\.dat$')
+
+LOCK_NAME = '.lock'
+
+
+class ArchiveLocked(Exception):
+    '''Raised when another process is already writing to the archive'''
+    pass
+
+
+class SegmentArchive(object):
+    '''Append-only segment files holding archived contents'''
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._maps = {}
+        self._lock = None
+
+    def lock(self):
+        '''Takes the exclusive right to append to the archive, raising
+        ArchiveLocked if another process has it'''
+        _makedirs(self.directory)
+        f = open(os.path.join(self.directory, LOCK_NAME), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            f.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                raise ArchiveLocked(self.directory)
+            raise
+        self._lock = f
+
+    def unlock(self):
+        if self._lock:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+            self._lock.close()
+            self._lock = None
+
+    def append(self, records):
+        '''
+        Appends the given strings to the archive, and makes sure they are
+        written to disk. Returns a list with the ``(segment, offset,
+        length)`` of each one. The archive must be locked.
+        '''
+        assert self._lock, 'The archive must be locked to append to it'
+        locations = []
+        segment = self._last_segment()
+        f = open(self._segment_path(segment), 'ab')
+        try:
+            for record in records:
+                offset = f.tell()
+                if offset and offset + len(record) > self.segment_size:
+                    _sync(f)
+                    f.close()
+                    segment += 1
+                    f = open(self._segment_path(segment), 'ab')
+                    offset = f.tell()
+                f.write(record)
+                locations.append((segment, offset, len(record)))
+            _sync(f)
+        finally:
+            f.close()
+        return locations
+
+    def read(self, segment, offset, length):
+        '''Returns a record of the archive'''
+        segment_map = self._maps.get(segment)
+        if segment_map is None or offset + length > len(segment_map):
+            # Map the segment again if it has grown since it was mapped
+            if segment_map is not None:
+                segment_map.close()
+            with open(self._segment_path(segment), 'rb') as f:
+                segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = segment_map
+        if offset + length > len(segment_map):
+            raise IOError('Record %i:%i+%i is out of its segment' %
+                          (segment, offset, length))
+        return segment_map[offset:offset + length]
+
+    def close(self):
+        for segment_map in self._maps.values():
+            segment_map.close()
+        self._maps = {}
+        self.unlock()
+
+    def _last_segment(self):
+        segments = [int(match.group(1)) for match in
+                    (SEGMENT_RE.match(name) for name in os.listdir(self.directory))
+                    if match]
+        return max(segments) if segments else 0
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, SEGMENT_NAME % segment)
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+_archive = None
+
+
+def get_archive():
+    '''Returns the content archive, or None if it is not configured'''
+    global _archive
+    directory = config.get('ckanext.harvest.archive.dir')
+    if not directory:
+        return None
+    if _archive is None or _archive.directory != directory:
+        segment_size = int(config.get('ckanext.harvest.archive.segment_size',
+                                      DEFAULT_SEGMENT_SIZE))
+        _archive = SegmentArchive(directory, segment_size)
+    return _archive
@@ -0,0 +1,86 @@
+'''
+JSON encoding and decoding used across the harvesting pipeline (queue
+messages, harvest object contents, source configurations...).
+
+The fastest library available is used: ujson_ if it is installed, then
+simplejson_ (with its C speedups), falling back to the standard library json
+module. All of them return unicode strings when decoding, keep the full
+precision of floats, raise ValueError on invalid documents and TypeError on
+objects that can not be serialized.
+
+.. _ujson: https://pypi.python.org/pypi/ujson
+.. _simplejson: https://pypi.python.org/pypi/simplejson
+'''
+
+
+def _get_ujson_options(ujson):
+    '''
+    Returns the options passed to ujson to keep the full precision of floats
+    (only needed by versions before 2.0), or None if the installed version
+    can not be used: old versions (eg 1.35) round floats to 15 digits at most
+    and serialize unknown objects as ``{}``.
+    '''
+    value = 0.12345678901234567
+    for dumps_options, loads_options in (({}, {}),
+                                         ({'double_precision': 17},
+                                          {'precise_float': True})):
+        try:
+            if ujson.loads(ujson.dumps(value, **dumps_options),
+                           **loads_options) == value:
+                break
+        except (TypeError, ValueError):
+            pass
+    else:
+        return None
+    try:
+        ujson.dumps(object())
+    except TypeError:
+        return dumps_options, loads_options
+    return None
+
+
+try:
+    import ujson as _json
+    _options = _get_ujson_options(_json)
+    if _options is None:
+        raise ImportError('ujson is too old')
+    _dumps_options, _loads_options = _options
+    # Unlike the other libraries, ujson escapes forward slashes by default
+    _dumps_options['escape_forward_slashes'] = False
+    backend = 'ujson'
+except ImportError:
+    try:
+        import simplejson as _json
+        backend = 'simplejson'
+    except ImportError:
+        import json as _json
+        backend = 'json'
+
+
+if backend == 'ujson':
+
+    def dumps(obj):
+        return _json.dumps(obj, **_dumps_options)
+
+    def dump(obj, f):
+        return _json.dump(obj, f, **_dumps_options)
+
+    def loads(s):
+        return _json.loads(s, **_loads_options)
+
+    def load(f):
+        return _json.load(f, **_loads_options)
+
+else:
+
+    def dumps(obj):
+        return _json.dumps(obj)
+
+    def dump(obj, f):
+        return _json.dump(obj, f)
+
+    def loads(s):
+        return _json.loads(s)
+
+    def load(f):
+        return _json.load(f)
@@ -12,7 +12,8 @@ class Harvester(CkanCommand):
     Usage:
 
       harvester initdb
-        - Creates the necessary tables in the database
+        - Creates the necessary tables and indexes in the database. Missing
+          indexes are created concurrently, without locking the tables
 
       harvester source {name} {url} {type} [{title}] [{active}] [{owner_org}] [{frequency}] [{config}]
         - create new harvest source
@@ -21,7 +22,8 @@ class Harvester(CkanCommand):
         - remove (deactivate) a harvester source, whilst leaving any related datasets, jobs and objects
 
       harvester clearsource {id}
-        - clears all datasets, jobs and objects related to a harvest source, but keeps the source itself
+        - clears all datasets, jobs and objects related to a harvest source, but keeps the source itself.
+          If interrupted, running it again resumes the clearing where it stopped
 
       harvester sources [all]
         - lists harvest sources
@@ -42,10 +44,14 @@ class Harvester(CkanCommand):
       harvester fetch_consumer
         - starts the consumer for the fetching queue
 
+      harvester index_consumer
+        - starts the consumer for the indexing queue (when
+          ckanext.harvest.async_indexing is enabled)
+
       harvester purge_queues
         - removes all jobs from fetch and gather queue
 
-      harvester [-j] [-o] [--segments={segments}] import [{source-id}]
+      harvester [-j] [-o] [--segments={segments}] [--offline] import [{source-id}]
         - perform the import stage with the last fetched objects, for a certain
           source or a single harvest object. Please note that no objects will
           be fetched from the remote server. It will only affect the objects
@@ -59,11 +65,45 @@ class Harvester(CkanCommand):
           The --segments flag allows to define a string containing hex digits that represent which of
           the 16 harvest object segments to import. e.g. 15af will run segments 1,5,a,f
 
+          If the --offline flag is provided, the remote content needed during the import
+          is only read from the HTTP response cache, and no requests are sent.
+
       harvester job-all
         - create new harvest jobs for all active sources.
 
-      harvester reindex
-        - reindexes the harvest source datasets
+      harvester reindex [--processes={n}]
+        - reindexes the harvest source datasets, using n worker processes
+
+      harvester remove_orphans [{source-id}]
+        - removes the datasets of the organizations owning harvest sources
+          that are not linked to any harvest object, for all of them or just
+          for the one owning the given source
+
+      harvester delta_encode [{source-id}]
+        - stores the contents of the old harvest objects as deltas against
+          the next version of the same document, for all sources or just
+          the given one
+
+      harvester archive [--days={n}] [--interval={seconds}]
+        - moves the contents of the non-current harvest objects gathered more
+          than n days ago to the archive segment files. With --interval, it
+          keeps running and archives them again every given number of seconds
+
+      harvester purge_history [--keep-jobs={n}] [--days={d}]
+        - deletes the old harvest jobs, objects and errors, keeping the last n
+          jobs of each source, the jobs younger than d days and the current
+          objects, and the contents no longer used
+
+      harvester partition [--partitions={n}]
+        - partitions the harvest_object and harvest_object_error tables in n
+          partitions (16 by default). The harvesters must be stopped while it
+          runs. Requires PostgreSQL 11 or later
+
+      harvester migrate_contents [--batch-size={n}]
+        - moves the harvest object contents stored by older versions to the
+          content table, n objects per transaction (500 by default). It can
+          be interrupted and run again, and the harvesters can keep running
+          meanwhile
 
     The commands should be run from the ckanext-harvest directory and expect
     a development.ini file to be present. Most of the time you will
@@ -96,6 +136,27 @@ class Harvester(CkanCommand):
 '''A string containing hex digits that represent which of
  the 16 harvest object segments to import. e.g. 15af will run segments 1,5,a,f''')
 
+        self.parser.add_option('--offline', dest='offline',
+            action='store_true', default=False, help='Only use the HTTP response cache during the import stage')
+
+        self.parser.add_option('--processes', dest='processes',
+            type='int', default=None, help='Number of worker processes used to reindex the harvest sources')
+
+        self.parser.add_option('--days', dest='days',
+            type='int', default=None, help='Age in days of the harvest objects to archive or jobs to keep')
+
+        self.parser.add_option('--keep-jobs', dest='keep_jobs',
+            type='int', default=None, help='Number of jobs to keep for each source')
+
+        self.parser.add_option('--partitions', dest='partitions',
+            type='int', default=None, help='Number of partitions of the harvest tables')
+
+        self.parser.add_option('--interval', dest='interval',
+            type='int', default=None, help='Seconds between archive runs')
+
+        self.parser.add_option('--batch-size', dest='batch_size',
+            type='int', default=None, help='Number of contents moved per transaction')
+
     def command(self):
         self._load_config()
 
@@ -137,15 +198,26 @@ class Harvester(CkanCommand):
             import logging
             logging.getLogger('amqplib').setLevel(logging.INFO)
             from ckanext.harvest.queue import (get_fetch_consumer, fetch_callback,
-                get_fetch_queue_name)
+                get_fetch_queue_name, async_indexing_enabled)
+            if async_indexing_enabled():
+                # The datasets are indexed by the index consumer instead
+                from pylons import config
+                config['ckan.search.automatic_indexing'] = False
             consumer = get_fetch_consumer()
             for method, header, body in consumer.consume(queue=get_fetch_queue_name()):
                fetch_callback(consumer, method, header, body)
+        elif cmd == 'index_consumer':
+            import logging
+            logging.getLogger('amqplib').setLevel(logging.INFO)
+            from ckanext.harvest.queue import (get_index_consumer,
+                consume_index_queue)
+            consume_index_queue(get_index_consumer())
         elif cmd == 'purge_queues':
             from ckanext.harvest.queue import purge_queues
             purge_queues()
         elif cmd == 'initdb':
             self.initdb()
+            self.create_indexes()
         elif cmd == 'import':
             self.initdb()
             self.import_stage()
@@ -156,6 +228,18 @@ class Harvester(CkanCommand):
             pprint(harvesters_info)
         elif cmd == 'reindex':
             self.reindex()
+        elif cmd == 'remove_orphans':
+            self.remove_orphans()
+        elif cmd == 'delta_encode':
+            self.delta_encode()
+        elif cmd == 'archive':
+            self.archive()
+        elif cmd == 'purge_history':
+            self.purge_history()
+        elif cmd == 'partition':
+            self.partition()
+        elif cmd == 'migrate_contents':
+            self.migrate_contents()
         else:
             print 'Command %s not recognized' % cmd
 
@@ -168,6 +252,32 @@ class Harvester(CkanCommand):
 
         print 'DB tables created'
 
+    def create_indexes(self):
+        from ckanext.harvest.model import migrate_indexes
+        migrate_indexes()
+
+        print 'DB indexes created'
+
+    def partition(self):
+        from ckanext.harvest.model import (migrate_partitions, HarvestError,
+                                           DEFAULT_PARTITIONS)
+        try:
+            migrate_partitions(self.options.partitions or DEFAULT_PARTITIONS)
+        except HarvestError, e:
+            print str(e)
+            sys.exit(1)
+
+        print 'DB tables partitioned'
+
+    def migrate_contents(self):
+        from ckanext.harvest.model import (migrate_contents,
+                                           DEFAULT_MIGRATE_CONTENTS_BATCH_SIZE)
+        count = migrate_contents(self.options.batch_size or
+                                 DEFAULT_MIGRATE_CONTENTS_BATCH_SIZE)
+
+        print '%s harvest object contents moved' % count
+        print 'Run VACUUM FULL harvest_object (or pg_repack) to free their space'
+
     def create_harvest_source(self):
 
         if len(self.args) >= 2:
@@ -315,6 +425,8 @@ class Harvester(CkanCommand):
         context = {'model': model, 'session':model.Session, 'user': self.admin_user['name'],
                    'join_datasets': not self.options.no_join_datasets,
                    'segments': self.options.segments}
+        if self.options.offline:
+            context['http_cache_mode'] = 'replay'
 
 
         objs_count = get_action('harvest_objects_import')(context,{
@@ -331,9 +443,63 @@ class Harvester(CkanCommand):
         print 'Created %s new harvest jobs' % len(jobs)
 
     def reindex(self):
-        context = {'model': model, 'user': self.admin_user['name']}
-        get_action('harvest_sources_reindex')(context,{})
+        context = {'model': model, 'user': self.admin_user['name'],
+                   'processes': self.options.processes}
+        count = get_action('harvest_sources_reindex')(context, {})
+        print '%s harvest sources reindexed' % count
+
+
+    def remove_orphans(self):
+        if len(self.args) >= 2:
+            source_id = unicode(self.args[1])
+        else:
+            source_id = None
+        context = {'model': model, 'session': model.Session,
+                   'user': self.admin_user['name']}
+        count = get_action('harvest_orphans_remove')(context, {
+                'source_id': source_id,
+                })
+        print '%s orphaned datasets removed' % count
 
+    def delta_encode(self):
+        if len(self.args) >= 2:
+            source_id = unicode(self.args[1])
+        else:
+            source_id = None
+        context = {'model': model, 'session': model.Session,
+                   'user': self.admin_user['name']}
+        count = get_action('harvest_delta_encode')(context, {
+                'source_id': source_id,
+                })
+        print '%s harvest object contents stored as deltas' % count
+
+    def archive(self):
+        import time
+        from ckanext.harvest.archive import ArchiveLocked
+        context = {'model': model, 'session': model.Session,
+                   'user': self.admin_user['name']}
+        while True:
+            try:
+                count = get_action('harvest_objects_archive')(context.copy(), {
+                        'days': self.options.days,
+                        })
+                print '%s harvest object contents archived' % count
+            except ArchiveLocked:
+                print 'The archive is being written by another process'
+            finally:
+                model.Session.remove()
+            if not self.options.interval:
+                break
+            time.sleep(self.options.interval)
+
+    def purge_history(self):
+        context = {'model': model, 'session': model.Session,
+                   'user': self.admin_user['name']}
+        deleted = get_action('harvest_history_purge')(context, {
+                'keep_jobs': self.options.keep_jobs,
+                'days': self.options.days,
+                })
+        print '%(jobs)s harvest jobs, %(objects)s objects and %(contents)s contents deleted' % deleted
 
     def print_harvest_sources(self, sources):
         if sources:
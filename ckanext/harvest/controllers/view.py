@@ -13,10 +13,11 @@ from pylons.i18n import _
 from ckan import model
 
 import ckan.plugins as p
-import ckan.lib.helpers as h, json
+import ckan.lib.helpers as h
 from ckan.lib.base import BaseController, c, \
                           request, response, render, abort, redirect
 
+from ckanext.harvest import codec
 from ckanext.harvest.plugin import DATASET_TYPE_NAME
 
 import logging
@@ -76,8 +77,8 @@ class ViewController(BaseController):
     def clear(self, id):
         try:
             context = {'model':model, 'user':c.user, 'session':model.Session}
-            p.toolkit.get_action('harvest_source_clear')(context,{'id':id})
-            h.flash_success(_('Harvest source cleared'))
+            p.toolkit.get_action('harvest_source_clear')(context,{'id':id, 'background': True})
+            h.flash_success(_('Harvest source is being cleared'))
         except p.toolkit.ObjectNotFound:
             abort(404,_('Harvest source not found'))
         except p.toolkit.NotAuthorized:
@@ -106,7 +107,11 @@ class ViewController(BaseController):
             # Check content type. It will probably be either XML or JSON
             try:
 
-                if obj['content']:
+                if 'full_metadata' in obj['extras']:
+                    # Original document of a dataset harvested from another
+                    # CKAN instance, which harvested it itself
+                    content = obj['extras']['full_metadata']
+                elif obj['content']:
                     content = obj['content']
                 elif 'original_document' in obj['extras']:
                     content = obj['extras']['original_document']
@@ -122,7 +127,7 @@ class ViewController(BaseController):
 
             except etree_exceptions:
                 try:
-                    json.loads(obj['content'])
+                    codec.loads(content)
                     response.content_type = 'application/json; charset=utf-8'
                 except ValueError:
                     # Just return whatever it is
@@ -0,0 +1,108 @@
+'''
+Deltas between successive versions of a harvested document.
+
+A delta is a list of operations that rebuild a document from another one
+(the base): ``[start, end]`` copies the characters ``start:end`` of the
+base, and a string inserts new text. Deltas are serialized as JSON, as
+``{"chars": operations}``.
+
+The lines of the documents are matched first, then the lines that changed
+are compared token by token (words, runs of whitespace and punctuation), so
+documents on a single line, like the JSON stored by the CKAN harvester, get
+small deltas too.
+
+Deltas stored by previous versions are a plain list, where ``[start, end]``
+copies whole lines of the base. They can still be applied.
+'''
+import re
+import difflib
+
+from ckanext.harvest import codec
+
+# The documents are compared line by line, then the lines that changed
+# piece by piece (ending at JSON or XML delimiters), then token by token
+SPLIT_LEVELS = [
+    re.compile(r'[^\n]*\n|[^\n]+'),
+    re.compile(r'[^\n,;{}\[\]<>]*[\n,;{}\[\]<>]|[^\n,;{}\[\]<>]+'),
+    re.compile(r'\w+|\s+|[^\w\s]', re.UNICODE),
+]
+
+# Maximum number of parts of the base times parts of the new document below
+# which changed lines or pieces are compared further
+MAX_COMPARISONS = 100000000
+
+
+def make_delta(base, content):
+    '''Returns the serialized delta that rebuilds content from base'''
+    operations = []
+    _diff(operations, base, content, 0, 0)
+    return codec.dumps({'chars': operations})
+
+
+def apply_delta(base, delta):
+    '''Rebuilds a document from its base and the serialized delta'''
+    operations = codec.loads(delta)
+    if isinstance(operations, dict):
+        source = base
+        operations = operations['chars']
+    else:
+        source = base.splitlines(True)
+    parts = []
+    for operation in operations:
+        if isinstance(operation, list):
+            parts.append(u''.join(source[operation[0]:operation[1]]))
+        else:
+            parts.append(operation)
+    return u''.join(parts)
+
+
+def _diff(operations, base_text, new_text, offset, level):
+    '''
+    Appends the operations that rebuild new_text from base_text, which
+    starts at ``offset`` in the base, splitting both into the parts of the
+    given level. The parts that changed are compared again at the next
+    level.
+    '''
+    base_parts = SPLIT_LEVELS[level].findall(base_text)
+    parts = SPLIT_LEVELS[level].findall(new_text)
+    if len(base_parts) * len(parts) > MAX_COMPARISONS and level > 0:
+        # Too slow to compare, and unlikely to be similar anyway
+        _insert(operations, new_text)
+        return
+    base_offsets = _get_offsets(base_parts)
+    matcher = difflib.SequenceMatcher(None, base_parts, parts, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            _copy(operations, offset + base_offsets[i1],
+                  offset + base_offsets[i2])
+        elif j2 > j1:
+            # replace and insert, deleted parts are just not copied
+            changed_text = u''.join(parts[j1:j2])
+            if i2 > i1 and level + 1 < len(SPLIT_LEVELS):
+                _diff(operations, u''.join(base_parts[i1:i2]), changed_text,
+                      offset + base_offsets[i1], level + 1)
+            else:
+                _insert(operations, changed_text)
+
+
+def _get_offsets(parts):
+    '''Returns the offset of each part in their concatenation, and its end'''
+    offsets = [0]
+    for part in parts:
+        offsets.append(offsets[-1] + len(part))
+    return offsets
+
+
+def _copy(operations, start, end):
+    if operations and isinstance(operations[-1], list) \
+            and operations[-1][1] == start:
+        operations[-1][1] = end
+    else:
+        operations.append([start, end])
+
+
+def _insert(operations, text):
+    if operations and not isinstance(operations[-1], list):
+        operations[-1] += text
+    else:
+        operations.append(text)
@@ -1,30 +1,115 @@
 import logging
 import re
 import uuid
+import time
+import hashlib
+import datetime
 
-from sqlalchemy.sql import update,and_, bindparam
+from dateutil.parser import parse as parse_date
+
+from sqlalchemy.sql import update,and_, or_, bindparam
 from sqlalchemy.exc import InvalidRequestError
 from pylons import config
 
 from ckan import plugins as p
 from ckan import model
 from ckan.model import Session, Package
+from ckan.model.types import make_uuid
 from ckan.logic import ValidationError, NotFound, get_action
 
 from ckan.logic.schema import default_create_package_schema
 from ckan.lib.navl.validators import ignore_missing,ignore
-from ckan.lib.munge import munge_title_to_name,substitute_ascii_equivalents
+from ckan.lib.munge import substitute_ascii_equivalents
 
+from ckanext.harvest import codec
+import ckanext.harvest.model as harvest_model
 from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestGatherError, \
-                                    HarvestObjectError
+                                    HarvestObjectError, HarvestGuidFingerprint, \
+                                    allocate_package_names
 from sqlalchemy.exc import IntegrityError
 
 from ckan.plugins.core import SingletonPlugin, implements
 from ckanext.harvest.interfaces import IHarvester
+from ckanext.harvest.queue import queue_package_index
 
 
 log = logging.getLogger(__name__)
 
+# Number of harvest objects inserted at once by the gather stage
+DEFAULT_GATHER_BATCH_SIZE = 1000
+
+# Packages read in advance for the objects about to be imported, keyed by id
+# (None if the package does not exist)
+_prefetched_packages = {}
+
+
+def get_package_rows(package_ids):
+    '''
+    Returns a dict with the ``id``, ``name``, ``state`` and
+    ``metadata_modified`` (as an ISO string, like package_show) of each of the
+    given packages that exist, keyed by id. They are read from the package
+    table in a single query.
+    '''
+    packages = {}
+    package_ids = list(set(package_ids))
+    if not package_ids:
+        return packages
+    rows = Session.query(Package.id, Package.name, Package.state,
+                         Package.metadata_modified) \
+            .filter(Package.id.in_(package_ids))
+    for id, name, state, metadata_modified in rows:
+        packages[id] = {
+            'id': id,
+            'name': name,
+            'state': state,
+            'metadata_modified': metadata_modified.isoformat()
+                                 if metadata_modified else None,
+        }
+    return packages
+
+
+def prefetch_packages(package_ids):
+    '''
+    Reads in a single query the packages that the next objects to be
+    imported will need to check, so _create_or_update_package does not need
+    to query them one by one.
+    '''
+    _prefetched_packages.clear()
+    packages = get_package_rows(package_ids)
+    for package_id in package_ids:
+        _prefetched_packages[package_id] = packages.get(package_id)
+
+
+# Import contexts of the jobs being imported by this process, keyed by job id
+_import_contexts = {}
+MAX_IMPORT_CONTEXTS = 20
+
+
+# Local groups and organizations found (or not) by name or id, shared by the
+# harvesters of this process, as {(is_organization, name_or_id): (result, expiry)}
+_group_cache = {}
+DEFAULT_GROUP_CACHE_TTL = 300
+
+
+def clear_group_cache():
+    _group_cache.clear()
+
+
+def _cache_group(key, group):
+    ttl = int(config.get('ckanext.harvest.group_cache_ttl',
+                         DEFAULT_GROUP_CACHE_TTL))
+    _group_cache[key] = (group, time.time() + ttl)
+
+
+def clear_import_context(source_id=None):
+    '''
+    Removes the cached import contexts of the jobs of the given harvest
+    source (or of all sources), so they are built again on the next import.
+    '''
+    for job_id, import_context in _import_contexts.items():
+        if source_id is None or import_context['source_id'] == source_id:
+            del _import_contexts[job_id]
+
 
 def munge_tag(tag):
     tag = substitute_ascii_equivalents(tag)
@@ -42,21 +127,23 @@ class HarvesterBase(SingletonPlugin):
 
     _user_name = None
 
+    # Set by harvest_objects_import to re-import objects even when their
+    # content has not changed
+    force_import = False
+
+    # Set by harvest_objects_import to override the mode of the HTTP response
+    # cache (eg 'replay' to re-import without sending any request)
+    http_cache_mode = None
+
     def _gen_new_name(self, title):
         '''
         Creates a URL friendly name from a title
 
-        If the name already exists, it will add some random characters at the end
+        If the name already exists, it will add some random characters at the end.
+        The name is reserved until the current transaction ends, so other
+        processes do not pick it at the same time.
         '''
-
-        name = munge_title_to_name(title).replace('_', '-')
-        while '--' in name:
-            name = name.replace('--', '-')
-        pkg_obj = Session.query(Package).filter(Package.name == name).first()
-        if pkg_obj:
-            return name + str(uuid.uuid4())[:5]
-        else:
-            return name
+        return allocate_package_names([title])[0]
 
 
     def _save_gather_error(self, message, job):
@@ -130,11 +217,134 @@ class HarvesterBase(SingletonPlugin):
 
         return self._user_name
 
-    def _create_harvest_objects(self, remote_ids, harvest_job):
+    def _get_import_context(self, harvest_object):
+        '''
+        Returns the data shared by the import stage of all the objects of a
+        harvest job, as a dict with the following keys:
+
+        * ``config``: the parsed configuration of the harvest source
+        * ``source_package``: the harvest source dataset dict
+        * ``schema``: the schema used to create and update the datasets
+        * ``user_name``: the name of the user performing the import
+        * ``site_user``: the site user dict
+
+        It is built once per job, and built again if the harvest source has
+        been modified since (its ``metadata_modified`` is checked each time).
+        '''
+        job_id = harvest_object.harvest_job_id
+        source = harvest_object.source or harvest_object.job.source
+        source_modified = Session.query(Package.metadata_modified) \
+                .filter(Package.id == source.id).scalar()
+
+        import_context = _import_contexts.get(job_id)
+        if import_context and import_context['source_modified'] == source_modified:
+            return import_context
+
+        user_name = self._get_user_name()
+        context = {'model': model, 'session': Session, 'user': user_name,
+                   'ignore_auth': True}
+        site_user = get_action('get_site_user')(
+            {'model': model, 'ignore_auth': True, 'defer_commit': True}, {})
+        try:
+            config = codec.loads(source.config) if source.config else {}
+        except ValueError:
+            config = {}
+
+        schema = default_create_package_schema()
+        schema['id'] = [ignore_missing, unicode]
+        schema['__junk'] = [ignore]
+
+        import_context = {
+            'job_id': job_id,
+            'source_id': source.id,
+            'source_modified': source_modified,
+            'config': config,
+            'source_package': get_action('package_show')(context, {'id': source.id}),
+            'schema': schema,
+            'user_name': user_name,
+            'site_user': site_user,
+        }
+        if job_id not in _import_contexts and \
+                len(_import_contexts) >= MAX_IMPORT_CONTEXTS:
+            _import_contexts.clear()
+        _import_contexts[job_id] = import_context
+        log.debug('Built import context for job %s', job_id)
+        return import_context
+
+    def _find_local_group(self, name_or_id, is_organization=False):
+        '''
+        Returns a dict with the ``id`` and ``name`` of the active local group
+        (or organization) with the given name or id, or None if there is
+        none.
+
+        It is read straight from the group table, and the result (including
+        misses) is cached for ``ckanext.harvest.group_cache_ttl`` seconds.
+        '''
+        key = (is_organization, name_or_id)
+        cached = _group_cache.get(key)
+        if cached and cached[1] > time.time():
+            return cached[0]
+
+        row = Session.query(model.Group.id, model.Group.name) \
+                .filter(or_(model.Group.id == name_or_id,
+                            model.Group.name == name_or_id)) \
+                .filter(model.Group.state == u'active') \
+                .filter(model.Group.is_organization == is_organization) \
+                .first()
+        group = {'id': row[0], 'name': row[1]} if row else None
+        _cache_group(key, group)
+        return group
+
+    def _create_local_group(self, name_or_id, create, is_organization=False):
+        '''
+        Creates a missing local group (or organization) by calling
+        ``create``, which should create it and return its dict, unless it has
+        been created by another process in the meantime.
+
+        A PostgreSQL advisory lock on the group name is held until the group
+        is created, so only one worker creates it while the others wait for
+        it and then find it. Returns a dict with the ``id`` and ``name`` of
+        the group, or None if it could not be created.
+        '''
+        # Do not retry creating groups whose creation failed recently (eg
+        # because they could not be fetched from the remote server)
+        failed_key = (is_organization, name_or_id, 'failed')
+        cached = _group_cache.get(failed_key)
+        if cached and cached[1] > time.time():
+            return None
+
+        lock_key = '%s:%s' % ('organization' if is_organization else 'group',
+                              name_or_id)
+        lock_id = int(hashlib.md5(lock_key.encode('utf-8')).hexdigest()[:15], 16)
+
+        # The lock is released when the transaction ends, ie once the group
+        # has been created and committed
+        Session.execute('SELECT pg_advisory_xact_lock(:id)', {'id': lock_id})
+        try:
+            _group_cache.pop((is_organization, name_or_id), None)
+            group = self._find_local_group(name_or_id, is_organization)
+            if not group:
+                group_dict = create()
+                if group_dict:
+                    group = {'id': group_dict['id'], 'name': group_dict['name']}
+                    _cache_group((is_organization, name_or_id), group)
+                else:
+                    _cache_group(failed_key, None)
+            Session.commit()
+        except:
+            Session.rollback()
+            raise
+        return group
+
+    def _create_harvest_objects(self, remote_ids, harvest_job,
+                                modified_dates=None):
         '''
         Given a list of remote ids and a Harvest Job, create as many Harvest Objects and
         return a list of their ids to be passed to the fetch stage.
 
+        If provided, ``modified_dates`` is a dict with the remote modification
+        date of each remote id, which will be stored in the objects.
+
         TODO: Not sure it is worth keeping this function
         '''
         try:
@@ -143,6 +353,9 @@ class HarvesterBase(SingletonPlugin):
                 for remote_id in remote_ids:
                     # Create a new HarvestObject for this identifier
                     obj = HarvestObject(guid = remote_id, job = harvest_job)
+                    if modified_dates:
+                        obj.metadata_modified_date = self._parse_modified_date(
+                                modified_dates.get(remote_id))
                     obj.save()
                     object_ids.append(obj.id)
                 return object_ids
@@ -152,6 +365,182 @@ class HarvesterBase(SingletonPlugin):
             self._save_gather_error('%r' % e.message, harvest_job)
 
 
+    def _create_harvest_objects_in_batches(self, remote_ids, harvest_job,
+                                           batch_size=None):
+        '''
+        Creates a Harvest Object for each of the remote ids yielded by the
+        given iterable, inserting them in batches of ``batch_size`` rows
+        (``ckanext.harvest.gather_batch_size`` by default) so that the remote
+        ids never need to be all in memory at the same time.
+
+        Returns a list of the ids of the new objects, to be passed to the
+        fetch stage.
+        '''
+        if batch_size is None:
+            batch_size = int(config.get('ckanext.harvest.gather_batch_size',
+                                        DEFAULT_GATHER_BATCH_SIZE))
+        harvest_object_table = harvest_model.harvest_object_table
+
+        object_ids = []
+        batch = []
+
+        def insert_batch():
+            Session.execute(harvest_object_table.insert(), batch)
+            Session.commit()
+            log.debug('Created %i harvest objects for job %s', len(batch),
+                      harvest_job.id)
+            del batch[:]
+
+        for remote_id in remote_ids:
+            object_id = make_uuid()
+            batch.append({
+                'id': object_id,
+                'guid': remote_id,
+                'harvest_job_id': harvest_job.id,
+                # The before_insert listener does not run for bulk inserts
+                'harvest_source_id': harvest_job.source_id,
+                'current': False,
+                'state': u'WAITING',
+                'retry_times': 0,
+                'gathered': datetime.datetime.utcnow(),
+            })
+            object_ids.append(object_id)
+            if len(batch) >= batch_size:
+                insert_batch()
+        if batch:
+            insert_batch()
+        return object_ids
+
+
+    def _is_unchanged(self, harvest_object):
+        '''
+        Checks whether the content fetched for this harvest object is
+        identical to the one of the current harvest object for the same guid,
+        in which case there is no need to import it again.
+
+        The content digest is stored in ``content_hash`` when the content is
+        set, as it references the stored content. If the harvest source has
+        been modified since the current object was imported (eg its
+        configuration changed), the object is always considered as changed.
+
+        Returns the current HarvestObject if the content is unchanged, None
+        otherwise.
+        '''
+        if self.force_import or not harvest_object.content_hash:
+            return None
+
+        previous_object = Session.query(HarvestObject) \
+                .join(Package, Package.id == HarvestObject.package_id) \
+                .filter(HarvestObject.guid == harvest_object.guid) \
+                .filter(HarvestObject.harvest_source_id ==
+                        harvest_object.harvest_source_id) \
+                .filter(HarvestObject.current == True) \
+                .filter(HarvestObject.id != harvest_object.id) \
+                .filter(Package.state == u'active') \
+                .first()
+
+        if not previous_object or \
+                previous_object.content_hash != harvest_object.content_hash:
+            return None
+
+        source_modified = Session.query(Package.metadata_modified) \
+                .filter(Package.id == harvest_object.harvest_source_id) \
+                .scalar()
+        if source_modified and (not previous_object.import_finished or
+                source_modified > previous_object.import_finished):
+            return None
+
+        return previous_object
+
+    def _skip_unchanged(self, harvest_object):
+        '''
+        Marks the harvest object as unchanged if its content is identical to
+        the one of the current object for the same guid (see
+        ``_is_unchanged``). The dataset, its revisions and the search index
+        are not touched, and the previous object remains the current one.
+
+        Returns True if the object was marked as unchanged, False otherwise.
+        '''
+        previous_object = self._is_unchanged(harvest_object)
+        if not previous_object:
+            return False
+
+        log.info('Content for GUID %s has not changed, skipping...' %
+                 harvest_object.guid)
+        harvest_object.package_id = previous_object.package_id
+        harvest_object.report_status = 'unchanged'
+        harvest_object.save()
+        return True
+
+    def _get_changed_guids(self, harvest_job, remote_guids):
+        '''
+        Compares the guids found on the remote source during the gather
+        stage with the guid index of the source, which is kept up to date by
+        the import stage.
+
+        ``remote_guids`` is an iterable of ``(guid, modified)`` pairs, where
+        ``modified`` is the remote modification date of the guid, as a
+        datetime or a string, or None if the remote does not provide it.
+        Guids without a modification date are always considered changed.
+
+        Returns a tuple with three lists:
+
+        * new guids, not harvested before (or whose dataset no longer exists)
+        * changed guids, with a different modification date than the one of
+          the current harvest object
+        * deleted guids, harvested before but no longer present on the remote
+
+        The new and changed guids keep the order in which they were provided.
+        '''
+        source_id = harvest_job.source_id or harvest_job.source.id
+
+        query = Session.query(HarvestGuidFingerprint.guid,
+                              HarvestGuidFingerprint.metadata_modified_date) \
+                .join(Package, Package.id == HarvestGuidFingerprint.package_id) \
+                .filter(HarvestGuidFingerprint.harvest_source_id == source_id) \
+                .filter(Package.state == u'active')
+        local_guids = dict(query.yield_per(10000))
+
+        new = []
+        changed = []
+        seen = set()
+        for guid, modified in remote_guids:
+            if guid in seen:
+                continue
+            seen.add(guid)
+            if guid not in local_guids:
+                new.append(guid)
+                continue
+            modified = self._parse_modified_date(modified)
+            local_modified = local_guids[guid]
+            if not modified or not local_modified or modified != local_modified:
+                changed.append(guid)
+
+        deleted = sorted(set(local_guids) - seen)
+
+        log.info('Gather for source %s: %i new, %i changed, %i unchanged, '
+                 '%i deleted guids', source_id, len(new), len(changed),
+                 len(seen) - len(new) - len(changed), len(deleted))
+
+        return new, changed, deleted
+
+    def _parse_modified_date(self, modified):
+        '''
+        Returns a naive UTC datetime for the given modification date, which
+        can be a datetime or a string. Returns None if it can not be parsed.
+        '''
+        if not modified:
+            return None
+        if not isinstance(modified, datetime.datetime):
+            try:
+                modified = parse_date(modified)
+            except (ValueError, TypeError, OverflowError):
+                log.debug('Could not parse modified date %r', modified)
+                return None
+        if modified.tzinfo is not None:
+            modified = (modified - modified.utcoffset()).replace(tzinfo=None)
+        return modified
+
     def _remove_package(self, package_dict):
         '''
         Removes the given package id, when access denied for a given ID is returned
@@ -161,6 +550,22 @@ class HarvesterBase(SingletonPlugin):
             'session': Session,
         }
         get_action('package_delete')(context, package_dict)
+        # With async indexing the dataset is not removed from the index when
+        # deleted, and it has no harvest object pointing to it to be sent to
+        # the index queue by the fetch consumer
+        package = model.Package.get(package_dict['id'])
+        if package:
+            queue_package_index(package.id)
+
+    def _get_existing_package(self, package_id):
+        '''
+        Returns the ``id``, ``name``, ``state`` and ``metadata_modified`` of
+        an existing package as a dict, or None if it does not exist.
+        '''
+        if package_id in _prefetched_packages:
+            # Only use it once, as the package may change after this import
+            return _prefetched_packages.pop(package_id)
+        return get_package_rows([package_id]).get(package_id)
 
     def _create_or_update_package(self, package_dict, harvest_object):
         '''
@@ -183,10 +588,7 @@ class HarvesterBase(SingletonPlugin):
         for rest api based dicts
         '''
         try:
-            # Change default schema
-            schema = default_create_package_schema()
-            schema['id'] = [ignore_missing, unicode]
-            schema['__junk'] = [ignore]
+            import_context = self._get_import_context(harvest_object)
 
             # Check API version
             if self.config:
@@ -197,13 +599,12 @@ class HarvesterBase(SingletonPlugin):
             else:
                 api_version = 2
 
-            user_name = self._get_user_name()
             context = {
                 'model': model,
                 'session': Session,
-                'user': user_name,
+                'user': import_context['user_name'],
                 'api_version': api_version,
-                'schema': schema,
+                'schema': import_context['schema'],
                 'ignore_auth': True,
             }
 
@@ -213,11 +614,12 @@ class HarvesterBase(SingletonPlugin):
                 tags = list(set(tags))
                 package_dict['tags'] = tags
 
-            # Check if package exists
-            data_dict = {}
-            data_dict['id'] = package_dict['id']
+            # Check if package exists, reading just the fields needed from
+            # the package table rather than the full package_show dict
             try:
-                existing_package_dict = get_action('package_show')(context, data_dict)
+                existing_package_dict = self._get_existing_package(package_dict['id'])
+                if not existing_package_dict:
+                    raise NotFound
 
                 # In case name has been modified when first importing. See issue #101.
                 package_dict['name'] = existing_package_dict['name']
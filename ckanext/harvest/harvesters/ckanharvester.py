@@ -1,21 +1,59 @@
+import os
 import urllib2
 import ast
+import tempfile
+
+from pylons import config
 
 from ckan.lib.base import c
 from ckan import model
 from ckan.model import Session, Package
 from ckan.logic import ValidationError, NotFound, get_action
-from ckan.lib.helpers import json
 from ckan.lib.munge import munge_name
 
-from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestGatherError, \
-                                    HarvestObjectError
+from ckanext.harvest import codec
+from ckanext.harvest.model import HarvestJob, HarvestGatherError, \
+                                    HarvestObjectError, HarvestObjectExtra
+from ckanext.harvest.httpcache import get_response_cache, get_cache_mode, \
+                                      MODE_PREFER, MODE_REPLAY
+from ckanext.harvest.hosts import is_host_error, report_host_failure
 
 import logging
 log = logging.getLogger(__name__)
 
 from base import HarvesterBase
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Maximum size (in bytes) of the responses from the remote hosts
+DEFAULT_MAX_RESPONSE_SIZE = 100 * 1024 * 1024
+# Responses larger than this (in bytes) are spooled to a temporary file
+DEFAULT_SPOOL_THRESHOLD = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# Harvest object extra where the original document of datasets harvested by
+# the remote instance is stored
+FULL_METADATA_KEY = 'full_metadata'
+
+
+def iter_json_items(f, key):
+    '''
+    Yields the items of the list stored in ``key`` of the JSON object read
+    from the file-like object ``f``.
+
+    If ijson is installed the items are decoded incrementally, as the file is
+    read. Otherwise the whole document is decoded first, and a warning is
+    logged.
+    '''
+    if ijson:
+        return ijson.items(f, key + '.item')
+    log.warning('ijson is not installed, decoding the whole %s list in memory',
+                key)
+    return iter(codec.load(f)[key])
+
+
 class CKANHarvester(HarvesterBase):
     '''
     A Harvester for CKAN instances
@@ -35,33 +73,107 @@ class CKANHarvester(HarvesterBase):
         return '/api/2/rest'
 
     def _get_content(self, url):
-        http_request = urllib2.Request(
-            url = url,
-        )
-
-	http_request.add_header("User-Agent", "ckanext_harvest")
+        content = self._get_content_stream(url)
+        try:
+            return content.read()
+        finally:
+            content.close()
+
+    def _get_content_stream(self, url):
+        '''
+        Returns a file-like object with the body of the response to the given
+        URL. Bodies larger than ``ckanext.harvest.spool_threshold`` bytes are
+        spooled to a temporary file rather than kept in memory while they are
+        received, and bodies larger than ``ckanext.harvest.max_response_size``
+        bytes are rejected, whether they come from the remote host or from the
+        response cache.
+
+        Note that the spool only bounds the memory used to receive the body:
+        callers decoding it in full (eg with ``codec.load``) still read it
+        into memory, so ``max_response_size`` is what bounds their peak memory.
+
+        The caller is responsible for closing the returned object.
+        '''
+        headers = {'User-Agent': 'ckanext_harvest'}
 
         api_key = self.config.get('api_key',None)
         if api_key:
-            http_request.add_header('Authorization',api_key)
+            headers['Authorization'] = api_key
+
+        max_size = int(config.get('ckanext.harvest.max_response_size',
+                                  DEFAULT_MAX_RESPONSE_SIZE))
+
+        cache = get_response_cache()
+        cache_mode = get_cache_mode(self.http_cache_mode)
+        if cache and cache_mode in (MODE_PREFER, MODE_REPLAY):
+            content = cache.open(url, headers)
+            if content is not None:
+                size = os.fstat(content.fileno()).st_size
+                if max_size and size > max_size:
+                    content.close()
+                    raise ContentFetchError(
+                        'Cached response for url: %s is too large (%i bytes)' %
+                        (url, size))
+                return content
+        if cache_mode == MODE_REPLAY:
+            raise ContentFetchError('No cached response for url: %s' % url)
+
+        http_request = urllib2.Request(
+            url = url,
+            headers = headers,
+        )
 
         try:
             http_response = urllib2.urlopen(http_request)
-        except urllib2.URLError, e:
+        except urllib2.HTTPError, e:
             if e.code == 403:
                 raise ContentNotFoundError('Package is no longer publicly available, HTTP 403 response for %s' % url)
-            else:
+            error_class = RemoteHostError if is_host_error(e) else ContentFetchError
+            raise error_class('Could not fetch url: %s, error: %s' % (url, str(e)))
+        except urllib2.URLError, e:
+            # No response at all, eg the connection was refused or timed out
+            raise RemoteHostError(
+                'Could not fetch url: %s, error: %s' %
+                (url, str(e))
+            )
+
+        spool_threshold = int(config.get('ckanext.harvest.spool_threshold',
+                                         DEFAULT_SPOOL_THRESHOLD))
+        content = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+        try:
+            content_length = http_response.info().get('Content-Length')
+            if max_size and content_length and content_length.isdigit() \
+                    and int(content_length) > max_size:
                 raise ContentFetchError(
-                    'Could not fetch url: %s, error: %s' %
-                    (url, str(e))
-                )
-        return http_response.read()
+                    'Response for url: %s is too large (%s bytes)' %
+                    (url, content_length))
+            size = 0
+            while True:
+                chunk = http_response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise ContentFetchError(
+                        'Response for url: %s is larger than %i bytes' %
+                        (url, max_size))
+                content.write(chunk)
+            content.seek(0)
+            if cache:
+                cache.set_file(url, headers, content)
+                content.seek(0)
+        except:
+            content.close()
+            raise
+        finally:
+            http_response.close()
+        return content
 
     def _get_group(self, base_url, group_name):
         url = base_url + self._get_action_api_offset() + '/group_show?id=' + munge_name(group_name)
         try:
             content = self._get_content(url)
-            return json.loads(content)
+            return codec.loads(content)
         except (ContentFetchError, ValueError):
             log.debug('Could not fetch/decode remote group');
             raise RemoteResourceError('Could not fetch/decode remote group')
@@ -70,15 +182,54 @@ class CKANHarvester(HarvesterBase):
         url = base_url + self._get_action_api_offset() + '/organization_show?id=' + org_name
         try:
             content = self._get_content(url)
-            content_dict = json.loads(content)
+            content_dict = codec.loads(content)
             return content_dict['result']
         except (ContentFetchError, ValueError, KeyError):
             log.debug('Could not fetch/decode remote group');
             raise RemoteResourceError('Could not fetch/decode remote organization')
 
+    def _create_remote_group(self, context, harvest_object, group_name):
+        '''Creates a local copy of a remote group, returning its dict or None'''
+        try:
+            group = self._get_group(harvest_object.source.url, group_name)
+        except RemoteResourceError:
+            log.error('Could not get remote group %s' % group_name)
+            return None
+
+        for key in ['packages', 'created', 'users', 'groups', 'tags', 'extras', 'display_name']:
+            group.pop(key, None)
+
+        group = get_action('group_create')(context.copy(), group)
+        log.info('Group %s has been newly created' % group_name)
+        return group
+
+    def _create_remote_organization(self, context, harvest_object, remote_org):
+        '''Creates a local copy of a remote organization, returning its dict
+        or None'''
+        try:
+            try:
+                org = self._get_organization(harvest_object.source.url, remote_org)
+            except RemoteResourceError:
+                # fallback if remote CKAN exposes organizations as groups
+                # this especially targets older versions of CKAN
+                org = self._get_group(harvest_object.source.url, remote_org)
+
+            for key in ['packages', 'created', 'users', 'groups', 'tags', 'extras', 'display_name', 'type']:
+                org.pop(key, None)
+            org = get_action('organization_create')(context.copy(), org)
+            log.info('Organization %s has been newly created' % remote_org)
+            return org
+        except (RemoteResourceError, ValidationError):
+            log.error('Could not get remote org %s' % remote_org)
+            return None
+
     def _set_config(self,config_str):
         if config_str:
-            self.config = json.loads(config_str)
+            if isinstance(config_str, dict):
+                # Already parsed, eg from the import context
+                self.config = config_str
+            else:
+                self.config = codec.loads(config_str)
             if 'api_version' in self.config:
                 self.api_version = int(self.config['api_version'])
 
@@ -99,7 +250,7 @@ class CKANHarvester(HarvesterBase):
             return config
 
         try:
-            config_obj = json.loads(config)
+            config_obj = codec.loads(config)
 
             if 'api_version' in config_obj:
                 try:
@@ -140,6 +291,13 @@ class CKANHarvester(HarvesterBase):
                     if not isinstance(config_obj[key],bool):
                         raise ValueError('%s must be boolean' % key)
 
+            for key in ('host_rate_limit', 'host_burst', 'host_max_in_flight'):
+                if key in config_obj:
+                    try:
+                        float(config_obj[key])
+                    except (ValueError, TypeError):
+                        raise ValueError('%s must be a number' % key)
+
         except ValueError,e:
             raise e
 
@@ -182,7 +340,7 @@ class CKANHarvester(HarvesterBase):
                 try:
                     content = self._get_content(url)
 
-                    revision_ids = json.loads(content)
+                    revision_ids = codec.loads(content)
                     if len(revision_ids):
                         for revision_id in revision_ids:
                             url = base_rest_url + '/revision/%s' % revision_id
@@ -192,7 +350,7 @@ class CKANHarvester(HarvesterBase):
                                 self._save_gather_error('Unable to get content for URL: %s: %s' % (url, str(e)),harvest_job)
                                 continue
 
-                            revision = json.loads(content)
+                            revision = codec.loads(content)
                             for package_id in revision['packages']:
                                 if not package_id in package_ids:
                                     package_ids.append(package_id)
@@ -210,26 +368,24 @@ class CKANHarvester(HarvesterBase):
 
 
 
+        content = None
         if get_all_packages:
             # Request all remote packages
             url = base_package_list_url + '/package_list'
             try:
-                content = self._get_content(url)
+                content = self._get_content_stream(url)
             except ContentFetchError,e:
                 self._save_gather_error('Unable to get content for URL: %s: %s' % (url, str(e)),harvest_job)
                 return None
 
-            package_ids = json.loads(content)['result']
+            # The ids are decoded as the objects are created, so the whole
+            # list does not need to be in memory
+            package_ids = iter_json_items(content, 'result')
 
         try:
-            object_ids = []
-            if len(package_ids):
-                for package_id in package_ids:
-                    # Create a new HarvestObject for this identifier
-                    obj = HarvestObject(guid = package_id, job = harvest_job)
-                    obj.save()
-                    object_ids.append(obj.id)
-
+            object_ids = self._create_harvest_objects_in_batches(package_ids,
+                                                                 harvest_job)
+            if len(object_ids):
                 return object_ids
 
             else:
@@ -237,7 +393,11 @@ class CKANHarvester(HarvesterBase):
                        harvest_job)
                return None
         except Exception, e:
+            Session.rollback()
             self._save_gather_error('%r'%e.message,harvest_job)
+        finally:
+            if content:
+                content.close()
 
 
     def fetch_stage(self,harvest_object):
@@ -251,7 +411,7 @@ class CKANHarvester(HarvesterBase):
 
         # Get contents
         try:
-            content = self._get_content(url)
+            content = self._get_content_stream(url)
         except ContentNotFoundError,e:
             # Remove package, as it no longer exists in the source:
             self._remove_package({"id": harvest_object.guid})
@@ -259,14 +419,57 @@ class CKANHarvester(HarvesterBase):
             harvest_object.save()
             return True
         except ContentFetchError,e:
+            if isinstance(e, RemoteHostError):
+                report_host_failure(harvest_object)
             self._save_object_error('Unable to get content for package: %s: %r' % \
                                         (url, e),harvest_object)
             return None
-        # Save the fetched contents in the HarvestObject
-        harvest_object.content = json.dumps(json.loads(content)['result'])
+        # Save the fetched contents in the HarvestObject. The whole document
+        # is decoded, so its size is only bounded by max_response_size
+        try:
+            package_dict = codec.load(content)['result']
+        finally:
+            content.close()
+        harvest_object.content = codec.dumps(package_dict)
+
+        # If the remote dataset was harvested itself, also get the document
+        # it was harvested from, so the import stage does not need to
+        for extra in list(harvest_object.extras):
+            if extra.key == FULL_METADATA_KEY:
+                harvest_object.extras.remove(extra)
+        full_metadata = self._get_full_metadata(harvest_object, package_dict)
+        if full_metadata is not None:
+            harvest_object.extras.append(
+                HarvestObjectExtra(key=FULL_METADATA_KEY, value=full_metadata))
+
         harvest_object.save()
         return True
 
+    def _get_full_metadata(self, harvest_object, package_dict):
+        '''
+        Returns the original document of a remote dataset that was harvested
+        by the remote instance, as served in its /harvest/object/{id} page,
+        or None if the dataset was not harvested or the document could not
+        be fetched.
+        '''
+        remote_object_id = None
+        for extra in package_dict.get('extras') or []:
+            if isinstance(extra, dict) and extra.get('key') == 'harvest_object_id':
+                remote_object_id = extra.get('value')
+        if not remote_object_id:
+            return None
+
+        url = harvest_object.source.url.rstrip('/') + '/harvest/object/' + remote_object_id
+        try:
+            full_metadata = self._get_content(url)
+        except (ContentFetchError, ContentNotFoundError), e:
+            log.warning('Unable to get full metadata for object %s: %s: %s',
+                        harvest_object.id, url, e)
+            return None
+        if isinstance(full_metadata, str):
+            full_metadata = full_metadata.decode('utf-8', 'replace')
+        return full_metadata
+
     def import_stage(self,harvest_object):
         log.debug('In CKANHarvester import_stage: %s' % harvest_object.id)
 
@@ -274,7 +477,6 @@ class CKANHarvester(HarvesterBase):
             log.debug('Dataset removed as expected, ignoring import for %s' % harvest_object.id)
             return True
 
-        context = {'model': model, 'session': Session, 'user': self._get_user_name()}
         if not harvest_object:
             log.error('No harvest object received')
             return False
@@ -284,10 +486,15 @@ class CKANHarvester(HarvesterBase):
                     harvest_object, 'Import')
             return False
 
-        self._set_config(harvest_object.job.source.config)
+        if self._skip_unchanged(harvest_object):
+            return True
 
         try:
-            package_dict = json.loads(harvest_object.content)
+            import_context = self._get_import_context(harvest_object)
+            self._set_config(import_context['config'])
+            context = {'model': model, 'session': Session, 'user': import_context['user_name']}
+
+            package_dict = codec.loads(harvest_object.content)
 
             if package_dict.get('type') == 'harvest':
                 log.warn('Remote dataset is a harvest source, ignoring...')
@@ -318,37 +525,28 @@ class CKANHarvester(HarvesterBase):
                 validated_groups = []
 
                 for group_name in package_dict['groups']:
-                    try:
-                        data_dict = {'id': group_name}
-                        group = get_action('group_show')(context, data_dict)
-                        if self.api_version == 1:
-                            validated_groups.append(group['name'])
-                        else:
-                            validated_groups.append(group['id'])
-                    except NotFound, e:
+                    if isinstance(group_name, dict):
+                        group_name = group_name.get('name') or group_name.get('id')
+                    group = self._find_local_group(group_name)
+                    if not group:
                         log.info('Group %s is not available' % group_name)
                         if remote_groups == 'create':
-                            try:
-                                group = self._get_group(harvest_object.source.url, group_name)
-                            except RemoteResourceError:
-                                log.error('Could not get remote group %s' % group_name)
-                                continue
-
-                            for key in ['packages', 'created', 'users', 'groups', 'tags', 'extras', 'display_name']:
-                                group.pop(key, None)
-
-                            get_action('group_create')(context, group)
-                            log.info('Group %s has been newly created' % group_name)
-                            if self.api_version == 1:
-                                validated_groups.append(group['name'])
-                            else:
-                                validated_groups.append(group['id'])
+                            group = self._create_local_group(
+                                group_name,
+                                lambda: self._create_remote_group(
+                                    context, harvest_object, group_name))
+                    if not group:
+                        continue
+                    if self.api_version == 1:
+                        validated_groups.append(group['name'])
+                    else:
+                        validated_groups.append(group['id'])
 
                 package_dict['groups'] = validated_groups
 
             log.debug('Starting to get harvest source info for: %s' % harvest_object.id)
             # Local harvest source organization
-            source_dataset = get_action('package_show')(context, {'id': harvest_object.source.id})
+            source_dataset = import_context['source_package']
             local_org = source_dataset.get('owner_org')
 
             log.debug('Have harvest source info for: %s' % harvest_object.id)
@@ -366,28 +564,17 @@ class CKANHarvester(HarvesterBase):
                 remote_org = package_dict['owner_org']
 
                 if remote_org:
-                    try:
-                        data_dict = {'id': remote_org}
-                        org = get_action('organization_show')(context, data_dict)
-                        validated_org = org['id']
-                    except NotFound, e:
+                    org = self._find_local_group(remote_org, is_organization=True)
+                    if not org:
                         log.info('Organization %s is not available' % remote_org)
                         if remote_orgs == 'create':
-                            try:
-                                try:
-                                    org = self._get_organization(harvest_object.source.url, remote_org)
-                                except RemoteResourceError:
-                                    # fallback if remote CKAN exposes organizations as groups
-                                    # this especially targets older versions of CKAN
-                                    org = self._get_group(harvest_object.source.url, remote_org)
-
-                                for key in ['packages', 'created', 'users', 'groups', 'tags', 'extras', 'display_name', 'type']:
-                                    org.pop(key, None)
-                                get_action('organization_create')(context, org)
-                                log.info('Organization %s has been newly created' % remote_org)
-                                validated_org = org['id']
-                            except (RemoteResourceError, ValidationError):
-                                log.error('Could not get remote org %s' % remote_org)
+                            org = self._create_local_group(
+                                remote_org,
+                                lambda: self._create_remote_organization(
+                                    context, harvest_object, remote_org),
+                                is_organization=True)
+                    if org:
+                        validated_org = org['id']
 
                 package_dict['owner_org'] = validated_org or local_org
 
@@ -399,26 +586,13 @@ class CKANHarvester(HarvesterBase):
                     package_dict['groups'] = []
                 package_dict['groups'].extend([g for g in default_groups if g not in package_dict['groups']])
 
-	    # Download full metadata link if applicable
-            harvest_source_id = None
-            for key in package_dict['extras']:
-                if key['key'] == 'harvest_object_id':
-                    harvest_source_id = key['value']
-            if harvest_source_id != None:
-                # Store the full metadata link
-                url = harvest_object.source.url.rstrip('/') + '/harvest/object/' + harvest_source_id
-                full_metadata = self._get_content(url)
-                harvest_object.content = full_metadata
-                harvest_object.save()
-
-            log.debug('Got full metadata content for: %s' % harvest_object.id)
             # Find any extras whose values are not strings and try to convert
             # them to strings, as non-string extras are not allowed anymore in
             # CKAN 2.0.
             for key in package_dict['extras']:
                 if not isinstance(key['value'], basestring):
                     try:
-                        key['value'] = json.dumps(key['value'])
+                        key['value'] = codec.dumps(key['value'])
                     except TypeError:
                         # If converting to a string fails, just delete it.
                         del key
@@ -510,5 +684,9 @@ class ContentFetchError(Exception):
 class ContentNotFoundError(Exception):
     pass
 
+class RemoteHostError(ContentFetchError):
+    '''The remote host failed to respond, see ``hosts.is_host_error``'''
+    pass
+
 class RemoteResourceError(Exception):
     pass
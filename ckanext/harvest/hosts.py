@@ -0,0 +1,390 @@
+'''
+Limits on the requests sent to each remote host during the fetch stage.
+
+The state is kept in the database so it is shared by all the fetch consumers,
+regardless of the queue backend used. Each remote host has a token bucket
+(``ckanext.harvest.host_rate_limit`` requests per second, with bursts of up to
+``ckanext.harvest.host_burst`` requests) and a cap on the number of objects
+being fetched from it at the same time (``ckanext.harvest.host_max_in_flight``).
+Both can be overridden on the configuration of each harvest source.
+
+When a host is busy, the fetch consumer puts the object back on the queue
+after a delay and moves on to the next one, so workers keep fetching from other
+hosts. Each process also remembers until when a host has run out of tokens, so
+it does not query the database again for that host in the meantime.
+
+Each host also has a circuit breaker. After
+``ckanext.harvest.host_failure_threshold`` consecutive fetches failed because
+of the host (connection errors, timeouts and server errors, see
+``is_host_error``) the circuit is opened and the objects from that host are parked without being
+fetched. Once ``ckanext.harvest.host_probe_interval`` seconds have passed, a
+single object is let through to probe the host. If it succeeds the circuit is
+closed and the parked objects are sent back to the fetch queue, otherwise the
+circuit stays open until the next probe.
+'''
+import time
+import socket
+import urllib2
+import httplib
+import logging
+import datetime
+import urlparse
+
+from pylons import config
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from ckan import model
+from ckan.model.types import make_uuid
+
+from ckanext.harvest import codec
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LEASE_TIMEOUT = 600
+DEFAULT_FAILURE_THRESHOLD = 0
+DEFAULT_PROBE_INTERVAL = 300
+
+CIRCUIT_CLOSED = u'closed'
+CIRCUIT_OPEN = u'open'
+CIRCUIT_HALF_OPEN = u'half-open'
+
+# Time (as returned by time.time) until which each remote host is known to
+# have no tokens left
+_busy_until = {}
+
+
+class HostBusy(Exception):
+    '''The remote host has no capacity left for another fetch right now.
+
+    ``wait`` is the estimated number of seconds until it will have.
+    '''
+    def __init__(self, host, wait):
+        super(HostBusy, self).__init__(
+            'Remote host %s is busy, retry in %.2fs' % (host, wait))
+        self.host = host
+        self.wait = wait
+
+
+class HostUnavailable(Exception):
+    '''The circuit of the remote host is open, so no fetches should be sent
+    to it until it is probed again.'''
+    def __init__(self, host):
+        super(HostUnavailable, self).__init__(
+            'Remote host %s is unavailable' % host)
+        self.host = host
+
+
+class HostLease(object):
+    '''A fetch slot acquired on a remote host. Call ``release`` once the
+    remote content has been fetched.'''
+
+    def __init__(self, host, id=None):
+        self.host = host
+        self.id = id
+
+    def release(self):
+        if not self.id:
+            return
+        conn = model.meta.engine.connect()
+        try:
+            conn.execute(text('DELETE FROM harvest_remote_host_lease WHERE id = :id'),
+                         id=self.id)
+        finally:
+            conn.close()
+        self.id = None
+
+
+def get_host(url):
+    '''Returns the host (and port, if any) of the given URL, in lower case'''
+    return urlparse.urlparse(url or '').netloc.lower()
+
+
+def get_host_limits(source):
+    '''
+    Returns the limits that apply to the remote host of a harvest source, as
+    a dict with the ``rate``, ``burst`` and ``max_in_flight`` keys. The site
+    wide values can be overridden with the ``host_rate_limit``,
+    ``host_burst`` and ``host_max_in_flight`` keys of the source config.
+    '''
+    limits = {
+        'rate': float(config.get('ckanext.harvest.host_rate_limit', 0)),
+        'burst': float(config.get('ckanext.harvest.host_burst', 0)),
+        'max_in_flight': int(config.get('ckanext.harvest.host_max_in_flight', 0)),
+    }
+    try:
+        source_config = codec.loads(source.config or '{}')
+    except ValueError:
+        source_config = {}
+    if isinstance(source_config, dict):
+        for key, option, cast in (('rate', 'host_rate_limit', float),
+                                  ('burst', 'host_burst', float),
+                                  ('max_in_flight', 'host_max_in_flight', int)):
+            if source_config.get(option) is not None:
+                try:
+                    limits[key] = cast(source_config[option])
+                except (ValueError, TypeError):
+                    log.warning('Invalid %s on harvest source %s',
+                                option, source.id)
+    if limits['burst'] < 1:
+        limits['burst'] = max(1.0, limits['rate'])
+    return limits
+
+
+def acquire_host_slot(harvest_object):
+    '''
+    Acquires a slot to fetch the given harvest object from its remote host,
+    checking the rate limit and the maximum number of concurrent fetches for
+    that host.
+
+    Returns a HostLease, which must be released after the fetch stage.
+    Raises HostBusy if the host has no capacity left at the moment.
+    '''
+    source = harvest_object.source
+    host = get_host(source.url)
+    limits = get_host_limits(source)
+    if not host or (limits['rate'] <= 0 and limits['max_in_flight'] <= 0):
+        return HostLease(host)
+
+    wait = _busy_until.get(host, 0) - time.time()
+    if wait > 0:
+        raise HostBusy(host, wait)
+
+    lease_timeout = int(config.get('ckanext.harvest.host_lease_timeout',
+                                   DEFAULT_LEASE_TIMEOUT))
+
+    # Use a connection of our own so the limits are checked and updated in a
+    # short transaction, independently of the session used by the harvesters
+    conn = model.meta.engine.connect()
+    try:
+        for attempt in range(2):
+            trans = conn.begin()
+            try:
+                lease_id = _acquire(conn, host, harvest_object.id, limits,
+                                    lease_timeout)
+                trans.commit()
+                return HostLease(host, lease_id)
+            except HostBusy:
+                trans.commit()
+                raise
+            except IntegrityError:
+                # Another consumer registered the host at the same time
+                trans.rollback()
+                if attempt:
+                    raise
+            except:
+                trans.rollback()
+                raise
+    finally:
+        conn.close()
+
+
+def _acquire(conn, host, harvest_object_id, limits, lease_timeout):
+    now = datetime.datetime.utcnow()
+
+    row = conn.execute(text('''SELECT tokens, last_refill FROM harvest_remote_host
+                               WHERE host = :host FOR UPDATE'''), host=host).first()
+    if row is None:
+        conn.execute(text('''INSERT INTO harvest_remote_host (host, tokens, last_refill)
+                             VALUES (:host, :tokens, :now)'''),
+                     host=host, tokens=limits['burst'], now=now)
+        tokens = limits['burst']
+    else:
+        tokens = row['tokens'] if row['tokens'] is not None else limits['burst']
+        if limits['rate'] > 0 and row['last_refill']:
+            elapsed = max(0.0, _total_seconds(now - row['last_refill']))
+            tokens = min(limits['burst'], tokens + elapsed * limits['rate'])
+        else:
+            tokens = limits['burst']
+
+    if limits['max_in_flight'] > 0:
+        expiry = now - datetime.timedelta(seconds=lease_timeout)
+        conn.execute(text('''DELETE FROM harvest_remote_host_lease
+                             WHERE host = :host AND acquired < :expiry'''),
+                     host=host, expiry=expiry)
+        in_flight = conn.execute(text('''SELECT count(*) FROM harvest_remote_host_lease
+                                         WHERE host = :host'''), host=host).scalar()
+        if in_flight >= limits['max_in_flight']:
+            _update_tokens(conn, host, tokens, now)
+            raise HostBusy(host, 1.0 / limits['rate'] if limits['rate'] > 0 else 1.0)
+
+    if limits['rate'] > 0:
+        if tokens < 1:
+            _update_tokens(conn, host, tokens, now)
+            wait = (1 - tokens) / limits['rate']
+            _busy_until[host] = time.time() + wait
+            raise HostBusy(host, wait)
+        tokens -= 1
+
+    _update_tokens(conn, host, tokens, now)
+
+    lease_id = make_uuid()
+    conn.execute(text('''INSERT INTO harvest_remote_host_lease
+                         (id, host, harvest_object_id, acquired)
+                         VALUES (:id, :host, :harvest_object_id, :now)'''),
+                 id=lease_id, host=host, harvest_object_id=harvest_object_id,
+                 now=now)
+    return lease_id
+
+
+def _update_tokens(conn, host, tokens, now):
+    conn.execute(text('''UPDATE harvest_remote_host
+                         SET tokens = :tokens, last_refill = :now
+                         WHERE host = :host'''),
+                 tokens=tokens, now=now, host=host)
+
+
+def _total_seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def get_failure_threshold():
+    return int(config.get('ckanext.harvest.host_failure_threshold',
+                          DEFAULT_FAILURE_THRESHOLD))
+
+
+def get_probe_interval():
+    return int(config.get('ckanext.harvest.host_probe_interval',
+                          DEFAULT_PROBE_INTERVAL))
+
+
+def check_host_circuit(harvest_object):
+    '''
+    Checks the circuit breaker of the remote host of the given harvest
+    object before fetching it.
+
+    Raises HostUnavailable if the circuit is open. If the probe interval has
+    passed, the circuit becomes half open and only the first caller is let
+    through to probe the host.
+    '''
+    if get_failure_threshold() <= 0:
+        return
+    host = get_host(harvest_object.source.url)
+    if not host:
+        return
+
+    conn = model.meta.engine.connect()
+    try:
+        row = conn.execute(text('''SELECT state, next_probe FROM harvest_remote_host
+                                   WHERE host = :host'''), host=host).first()
+        if not row or row['state'] in (None, CIRCUIT_CLOSED):
+            return
+
+        now = datetime.datetime.utcnow()
+        if row['next_probe'] and row['next_probe'] <= now:
+            next_probe = now + datetime.timedelta(seconds=get_probe_interval())
+            result = conn.execute(text('''UPDATE harvest_remote_host
+                                          SET state = :half_open, next_probe = :next_probe
+                                          WHERE host = :host
+                                          AND state IN (:open, :half_open)
+                                          AND next_probe <= :now'''),
+                                  host=host, now=now, next_probe=next_probe,
+                                  open=CIRCUIT_OPEN, half_open=CIRCUIT_HALF_OPEN)
+            if result.rowcount == 1:
+                log.info('Probing remote host %s with harvest object %s',
+                         host, harvest_object.id)
+                return
+    finally:
+        conn.close()
+
+    raise HostUnavailable(host)
+
+
+def is_host_error(error):
+    '''
+    Returns whether the given exception, raised while fetching a remote
+    document, means that the remote host is failing: a connection error, a
+    timeout or a server (5xx) error. Other errors (eg a missing document)
+    are not the fault of the host.
+    '''
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500
+    # Raised when there was no response at all, eg when the connection was
+    # refused or timed out
+    return isinstance(error, (urllib2.URLError, socket.error,
+                              httplib.HTTPException))
+
+
+def report_host_failure(harvest_object):
+    '''
+    Flags the fetch stage of the given harvest object as failed because of
+    its remote host (see ``is_host_error``). Harvesters should call it when
+    they catch such an error themselves, as only these failures count
+    towards opening the circuit of the host.
+    '''
+    harvest_object.host_failure = True
+
+
+def record_fetch_result(harvest_object, success):
+    '''
+    Updates the circuit breaker of the remote host of the given harvest
+    object with the outcome of its fetch stage. ``success`` is whether the
+    host responded, regardless of the fetch stage outcome otherwise.
+
+    Returns True if the host has just recovered (ie the circuit was open or
+    half open and has been closed), so the objects parked for it can be
+    sent back to the fetch queue.
+    '''
+    threshold = get_failure_threshold()
+    if threshold <= 0:
+        return False
+    host = get_host(harvest_object.source.url)
+    if not host:
+        return False
+
+    now = datetime.datetime.utcnow()
+    conn = model.meta.engine.connect()
+    try:
+        if success:
+            row = conn.execute(text('''
+                UPDATE harvest_remote_host h
+                SET consecutive_failures = 0, state = :closed,
+                    opened = NULL, next_probe = NULL
+                FROM (SELECT host, state FROM harvest_remote_host
+                      WHERE host = :host FOR UPDATE) previous
+                WHERE h.host = previous.host
+                AND (h.consecutive_failures > 0 OR h.state <> :closed)
+                RETURNING previous.state'''),
+                host=host, closed=CIRCUIT_CLOSED).first()
+            if row and row[0] in (CIRCUIT_OPEN, CIRCUIT_HALF_OPEN):
+                log.info('Remote host %s has recovered, closing circuit', host)
+                return True
+            return False
+
+        try:
+            conn.execute(text('''INSERT INTO harvest_remote_host
+                                 (host, state, consecutive_failures)
+                                 SELECT :host, :closed, 0
+                                 WHERE NOT EXISTS (SELECT 1 FROM harvest_remote_host
+                                                   WHERE host = :host)'''),
+                         host=host, closed=CIRCUIT_CLOSED)
+        except IntegrityError:
+            # Another consumer registered the host at the same time
+            pass
+
+        next_probe = now + datetime.timedelta(seconds=get_probe_interval())
+        row = conn.execute(text('''
+            UPDATE harvest_remote_host
+            SET consecutive_failures = coalesce(consecutive_failures, 0) + 1,
+                last_failure = :now,
+                opened = CASE WHEN coalesce(state, :closed) = :closed
+                              AND coalesce(consecutive_failures, 0) + 1 >= :threshold
+                              THEN :now ELSE opened END,
+                next_probe = CASE WHEN state = :half_open
+                                  OR coalesce(consecutive_failures, 0) + 1 >= :threshold
+                                  THEN :next_probe ELSE next_probe END,
+                state = CASE WHEN state = :half_open
+                             OR coalesce(consecutive_failures, 0) + 1 >= :threshold
+                             THEN :open ELSE coalesce(state, :closed) END
+            WHERE host = :host
+            RETURNING state, consecutive_failures'''),
+            host=host, now=now, next_probe=next_probe, threshold=threshold,
+            open=CIRCUIT_OPEN, half_open=CIRCUIT_HALF_OPEN,
+            closed=CIRCUIT_CLOSED).first()
+        if row and row['state'] == CIRCUIT_OPEN:
+            log.warning('Circuit open for remote host %s after %i consecutive '
+                        'failed fetches, next probe at %s', host,
+                        row['consecutive_failures'], next_probe)
+        return False
+    finally:
+        conn.close()
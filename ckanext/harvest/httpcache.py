@@ -0,0 +1,254 @@
+'''
+On-disk cache for the HTTP responses fetched by the harvesters.
+
+Responses are stored in the ``ckanext.harvest.http_cache.dir`` directory. The
+bodies are content addressed (``blobs/<sha1 of the body>``), so identical
+responses for different requests are only stored once, and each request
+(``keys/<sha1 of the URL and headers>``) points to the body it got. When the
+bodies take more than ``ckanext.harvest.http_cache.max_size`` bytes, the least
+recently used ones are removed, along with the requests pointing to them,
+until they take no more than 90% of it, so the cache is not scanned again on
+each of the following writes.
+
+The ``ckanext.harvest.http_cache.mode`` option sets how the cache is used:
+
+* ``record``: requests always go to the remote server, and the responses are
+  stored in the cache (default).
+* ``prefer``: cached responses are used when available, otherwise the request
+  is sent to the remote server and its response stored.
+* ``replay``: only cached responses are used, and no requests are sent to the
+  remote servers at all.
+'''
+import os
+import errno
+import hashlib
+import logging
+import tempfile
+from cStringIO import StringIO
+
+from pylons import config
+
+log = logging.getLogger(__name__)
+
+MODE_RECORD = 'record'
+MODE_PREFER = 'prefer'
+MODE_REPLAY = 'replay'
+MODES = (MODE_RECORD, MODE_PREFER, MODE_REPLAY)
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+# Fraction of the maximum size the cache is trimmed down to when it is full
+EVICT_LOW_WATER = 0.9
+
+CHUNK_SIZE = 64 * 1024
+
+TMP_PREFIX = '.tmp'
+
+
+class ResponseCache(object):
+    '''Content addressed store of HTTP responses, keyed by URL and headers'''
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        # Approximate size of the stored bodies, computed on the first write
+        self._size = None
+
+    def key(self, url, headers=None):
+        '''Returns the key of a request, from its URL and headers'''
+        key = hashlib.sha1(url.encode('utf-8') if isinstance(url, unicode)
+                           else url)
+        for name, value in sorted((headers or {}).items()):
+            key.update('\n%s: %s' % (name.lower(), value))
+        return key.hexdigest()
+
+    def open(self, url, headers=None):
+        '''Returns a file with the cached body of the response to a request,
+        or None'''
+        key_path = self._key_path(self.key(url, headers))
+        try:
+            with open(key_path) as f:
+                digest = f.read().strip()
+            blob_path = self._blob_path(digest)
+            body = open(blob_path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            if os.path.exists(key_path):
+                # The body has been evicted
+                _remove(key_path)
+            return None
+
+        # Mark both files as recently used
+        _touch(key_path)
+        _touch(blob_path)
+        return body
+
+    def get(self, url, headers=None):
+        '''Returns the cached body of the response to a request, or None'''
+        f = self.open(url, headers)
+        if f is None:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def set(self, url, headers, body):
+        '''Stores the body of the response to a request'''
+        self.set_file(url, headers, StringIO(body))
+
+    def set_file(self, url, headers, f):
+        '''Stores the body of the response to a request, read from the given
+        file in chunks'''
+        blobs_dir = os.path.join(self.directory, 'blobs')
+        _makedirs(blobs_dir)
+        digest = hashlib.sha1()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=blobs_dir, prefix=TMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+            digest = digest.hexdigest()
+            blob_path = self._blob_path(digest)
+            if os.path.exists(blob_path):
+                _remove(tmp_path)
+                _touch(blob_path)
+            else:
+                _makedirs(os.path.dirname(blob_path))
+                os.rename(tmp_path, blob_path)
+                if self._size is not None:
+                    self._size += size
+        except:
+            _remove(tmp_path)
+            raise
+        self._write(self._key_path(self.key(url, headers)), digest)
+
+        if self._size is None or self._size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        '''If the cache takes more than its maximum size, removes the least
+        recently used bodies until it takes no more than ``EVICT_LOW_WATER``
+        of it, and the requests not used since then'''
+        blobs = []
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.directory, 'blobs')):
+            for filename in filenames:
+                if filename.startswith(TMP_PREFIX):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, path))
+                size += stat.st_size
+
+        if size > self.max_size:
+            low_water = int(self.max_size * EVICT_LOW_WATER)
+            blobs.sort()
+            removed = 0
+            for mtime, blob_size, path in blobs:
+                if size <= low_water:
+                    break
+                _remove(path)
+                size -= blob_size
+                removed += 1
+                last_used = mtime
+            log.debug('Removed %i responses from the HTTP cache', removed)
+            if removed:
+                # Requests are touched along with their bodies, so the ones
+                # pointing to the removed bodies were not used after them
+                self._evict_keys(last_used)
+        self._size = size
+
+    def _evict_keys(self, last_used):
+        '''Removes the requests not used after ``last_used``'''
+        removed = 0
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.directory, 'keys')):
+            for filename in filenames:
+                if filename.startswith(TMP_PREFIX):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    if os.stat(path).st_mtime > last_used:
+                        continue
+                except OSError:
+                    continue
+                _remove(path)
+                removed += 1
+        log.debug('Removed %i requests from the HTTP cache', removed)
+
+    def _key_path(self, key):
+        return os.path.join(self.directory, 'keys', key[:2], key)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, 'blobs', digest[:2], digest)
+
+    def _write(self, path, data):
+        directory = os.path.dirname(path)
+        _makedirs(directory)
+        # Write to a temporary file and rename it, so readers never see a
+        # partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=TMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except:
+            _remove(tmp_path)
+            raise
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _touch(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+_cache = None
+
+
+def get_response_cache():
+    '''Returns the HTTP response cache, or None if it is not enabled'''
+    global _cache
+    directory = config.get('ckanext.harvest.http_cache.dir')
+    if not directory:
+        return None
+    if _cache is None or _cache.directory != directory:
+        max_size = int(config.get('ckanext.harvest.http_cache.max_size',
+                                  DEFAULT_MAX_SIZE))
+        _cache = ResponseCache(directory, max_size)
+    return _cache
+
+
+def get_cache_mode(mode=None):
+    '''Returns the mode the cache should be used in, ``mode`` overriding the
+    site wide one'''
+    mode = mode or config.get('ckanext.harvest.http_cache.mode', MODE_RECORD)
+    if mode not in MODES:
+        log.warning('Unknown HTTP cache mode %s, using %s', mode, MODE_RECORD)
+        mode = MODE_RECORD
+    return mode
@@ -11,15 +11,20 @@ from ckanext.harvest.interfaces import IHarvester
 import ckan.plugins as p
 from ckan.logic import NotFound, check_access, side_effect_free
 
+from ckanext.harvest import codec
 from ckanext.harvest import model as harvest_model
 
 from ckanext.harvest.model import (HarvestSource, HarvestJob, HarvestObject)
+from ckanext.harvest.hosts import get_host
 from ckanext.harvest.logic.dictization import (harvest_source_dictize,
                                                harvest_job_dictize,
                                                harvest_object_dictize)
 
 log = logging.getLogger(__name__)
 
+# Key of the harvest_system_info row recording the clearing of a source
+CLEAR_PROGRESS_KEY = u'clear_source:%s'
+
 @side_effect_free
 def harvest_source_show(context,data_dict):
     '''
@@ -120,6 +125,144 @@ def harvest_source_show_status(context, data_dict):
 
     return out
 
+def _get_sources_status(context, source_ids):
+    '''
+    Returns the status report of several harvest sources at once, as a dict
+    keyed by source id with the same values that harvest_source_show_status
+    returns, but computed with a fixed number of set-based queries rather
+    than several queries per source.
+    '''
+    session = context['model'].Session
+    source_ids = list(source_ids)
+    status = dict((source_id, {'job_count': 0,
+                               'last_job': None,
+                               'total_datasets': 0})
+                  for source_id in source_ids)
+    if not source_ids:
+        return status
+    params = {'source_ids': tuple(source_ids)}
+
+    job_counts = dict(session.execute('''
+        SELECT source_id, count(*) FROM harvest_job
+        WHERE source_id IN :source_ids
+        GROUP BY source_id''', params).fetchall())
+    if not job_counts:
+        return status
+
+    last_job_ids = [row[0] for row in session.execute('''
+        SELECT DISTINCT ON (source_id) id FROM harvest_job
+        WHERE source_id IN :source_ids
+        ORDER BY source_id, created DESC''', params)]
+    last_jobs = session.query(HarvestJob) \
+            .filter(HarvestJob.id.in_(last_job_ids)).all()
+    job_params = {'job_ids': tuple(last_job_ids)}
+
+    stats = {}
+    for job_id, report_status, count in session.execute('''
+            SELECT harvest_job_id, report_status, count(id) FROM harvest_object
+            WHERE harvest_job_id IN :job_ids
+            GROUP BY harvest_job_id, report_status''', job_params):
+        stats.setdefault(job_id, {})[report_status] = count
+
+    # Objects with errors (they could have been added/updated anyway) and
+    # gather errors are counted as errored
+    errored = {}
+    for job_id, count in session.execute('''
+            SELECT o.harvest_job_id, count(DISTINCT e.harvest_object_id)
+            FROM harvest_object_error e
+            JOIN harvest_object o ON o.id = e.harvest_object_id
+            WHERE o.harvest_job_id IN :job_ids
+            GROUP BY o.harvest_job_id''', job_params):
+        errored[job_id] = count
+    for job_id, count in session.execute('''
+            SELECT harvest_job_id, count(*) FROM harvest_gather_error
+            WHERE harvest_job_id IN :job_ids
+            GROUP BY harvest_job_id''', job_params):
+        errored[job_id] = errored.get(job_id, 0) + count
+
+    error_summary_limit = context.get('error_summmary_limit', 20)
+    object_error_summary = {}
+    for job_id, message, count in session.execute('''
+            SELECT harvest_job_id, message, error_count FROM (
+                SELECT o.harvest_job_id, e.message, count(e.message) AS error_count,
+                    row_number() OVER (PARTITION BY o.harvest_job_id
+                                       ORDER BY count(e.message) DESC) AS rank
+                FROM harvest_object_error e
+                JOIN harvest_object o ON o.id = e.harvest_object_id
+                WHERE o.harvest_job_id IN :job_ids
+                GROUP BY o.harvest_job_id, e.message) summary
+            WHERE rank <= :limit
+            ORDER BY harvest_job_id, error_count DESC''',
+            dict(job_params, limit=error_summary_limit)):
+        object_error_summary.setdefault(job_id, []).append((message, count))
+    gather_error_summary = {}
+    for job_id, message, count in session.execute('''
+            SELECT harvest_job_id, message, error_count FROM (
+                SELECT harvest_job_id, message, count(message) AS error_count,
+                    row_number() OVER (PARTITION BY harvest_job_id
+                                       ORDER BY count(message) DESC) AS rank
+                FROM harvest_gather_error
+                WHERE harvest_job_id IN :job_ids
+                GROUP BY harvest_job_id, message) summary
+            WHERE rank <= :limit
+            ORDER BY harvest_job_id, error_count DESC''',
+            dict(job_params, limit=error_summary_limit)):
+        gather_error_summary.setdefault(job_id, []).append((message, count))
+
+    total_datasets = dict(session.execute('''
+        SELECT o.harvest_source_id, count(DISTINCT p.id)
+        FROM package p
+        JOIN harvest_object o ON o.package_id = p.id
+        WHERE o.harvest_source_id IN :source_ids
+        AND o.current = true
+        AND p.state = 'active'
+        AND p.private = false
+        GROUP BY o.harvest_source_id''', params).fetchall())
+
+    for job in last_jobs:
+        job_dict = job.as_dict()
+        if context.get('return_stats', True):
+            job_dict['stats'] = stats.get(job.id, {})
+            if errored.get(job.id):
+                job_dict['stats']['errored'] = errored[job.id]
+        if context.get('return_error_summary', True):
+            job_dict['object_error_summary'] = object_error_summary.get(job.id, [])
+            job_dict['gather_error_summary'] = gather_error_summary.get(job.id, [])
+        status[job.source_id] = {
+            'job_count': job_counts.get(job.source_id, 0),
+            'last_job': job_dict,
+            'total_datasets': total_datasets.get(job.source_id, 0),
+        }
+    return status
+
+@side_effect_free
+def harvest_source_clear_status(context, data_dict):
+    '''
+    Returns the progress of the clearing of a harvest source, started with
+    harvest_source_clear
+
+    :param id: the id or name of the harvest source
+    :type id: string
+
+    :returns: the ``status`` of the clearing (``running``, ``finished`` or
+        ``failed``), the number of ``datasets`` deleted so far, the id of the
+        last one, and when it was ``started`` and last ``updated``. None if
+        the source was never cleared.
+    :rtype: dictionary
+    '''
+    p.toolkit.check_access('harvest_source_clear_status', context, data_dict)
+
+    source = harvest_model.HarvestSource.get(data_dict['id'])
+    if not source:
+        raise p.toolkit.ObjectNotFound('Harvest source {0} does not exist'.format(data_dict['id']))
+
+    return _get_clear_progress(context['model'].Session, source.id)
+
+def _get_clear_progress(session, source_id):
+    info = session.query(harvest_model.HarvestSystemInfo) \
+            .filter_by(key=CLEAR_PROGRESS_KEY % source_id).first()
+    return codec.loads(info.value) if info else None
+
 @side_effect_free
 def harvest_source_list(context, data_dict):
     '''
@@ -337,6 +480,38 @@ def harvesters_info_show(context,data_dict):
 
     return available_harvesters
 
+@side_effect_free
+def harvest_remote_host_list(context, data_dict):
+    '''
+    Returns the state of the remote hosts harvested, including their circuit
+    breaker, the number of objects being fetched from them and the number of
+    objects parked while they are unavailable.
+    '''
+    check_access('harvest_remote_host_list', context, data_dict)
+
+    session = context['session']
+
+    in_flight = dict(session.execute('''
+        SELECT host, count(*) FROM harvest_remote_host_lease GROUP BY host
+    ''').fetchall())
+
+    parked = {}
+    parked_objects = session.query(HarvestSource.url) \
+            .join(HarvestSource.objects) \
+            .filter(HarvestObject.state == u'PARKED')
+    for url, in parked_objects:
+        host = get_host(url)
+        parked[host] = parked.get(host, 0) + 1
+
+    hosts = []
+    for remote_host in session.query(harvest_model.HarvestRemoteHost) \
+            .order_by(harvest_model.HarvestRemoteHost.host):
+        host_dict = remote_host.as_dict()
+        host_dict['in_flight'] = in_flight.get(remote_host.host, 0)
+        host_dict['parked'] = parked.get(remote_host.host, 0)
+        hosts.append(host_dict)
+    return hosts
+
 def _get_sources_for_user(context,data_dict):
 
     model = context['model']
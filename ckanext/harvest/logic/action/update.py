@@ -1,12 +1,12 @@
 import hashlib
 import logging
 import datetime
-import json
+import threading
+import multiprocessing
 
 from pylons import config
 from paste.deploy.converters import asbool
-from sqlalchemy import and_, or_, exc
-import ckan.lib.search as search
+from sqlalchemy import and_, or_, exc, text
 from ckan.lib.search.index import PackageSearchIndex
 from ckan.plugins import PluginImplementations
 from ckan.logic import get_action
@@ -16,16 +16,44 @@ from ckan.model import Package
 from ckan import logic
 from ckan.plugins import toolkit
 from ckan.logic import NotFound, check_access
+from ckanext.harvest import codec
 from ckanext.harvest.plugin import DATASET_TYPE_NAME
-from ckanext.harvest.queue import get_gather_publisher, resubmit_jobs
-from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject, HarvestSystemInfo
+from ckanext.harvest.queue import get_gather_publisher, resubmit_jobs, \
+                                  resubmit_parked_objects, flush_index_queue, \
+                                  async_indexing_enabled, index_packages, \
+                                  update_guid_fingerprint, batched_index_adds
+from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject, HarvestSystemInfo, \
+                                  delta_encode_contents, DEFAULT_MAX_DELTA_CHAIN, \
+                                  archive_contents, purge_history, collect_content_garbage
+from ckanext.harvest.archive import get_archive
 from ckanext.harvest.logic import HarvestJobExists
-from ckanext.harvest.logic.action.get import harvest_source_show, harvest_job_list, _get_sources_for_user
+from ckanext.harvest.logic.action.get import harvest_source_show, harvest_job_list, _get_sources_for_user, \
+                                            _get_sources_status, _get_clear_progress, \
+                                            CLEAR_PROGRESS_KEY
 import ckan.lib.mailer as mailer
 from ckanext.harvest.logic.dictization import harvest_job_dictize
+from ckanext.harvest.harvesters.base import prefetch_packages
 
 log = logging.getLogger(__name__)
 
+# Number of objects whose datasets are read at once by harvest_objects_import
+IMPORT_PREFETCH_SIZE = 100
+
+# Number of harvest sources reindexed at once by harvest_sources_reindex
+DEFAULT_REINDEX_BATCH_SIZE = 100
+
+# Number of orphaned datasets removed at once by harvest_orphans_remove
+DEFAULT_ORPHANS_BATCH_SIZE = 500
+
+# Age in days of the harvest objects whose content is archived
+DEFAULT_ARCHIVE_AFTER_DAYS = 90
+
+# Number of rows deleted at once by harvest_history_purge
+DEFAULT_RETENTION_BATCH_SIZE = 1000
+
+# Number of datasets deleted at once by harvest_source_clear
+DEFAULT_CLEAR_BATCH_SIZE = 100
+
 
 def harvest_source_update(context, data_dict):
     '''
@@ -82,8 +110,18 @@ def harvest_source_clear(context, data_dict):
     Clears all datasets, jobs and objects related to a harvest source, but keeps the source itself.
     This is useful to clean history of long running harvest sources to start again fresh.
 
+    The datasets are deleted in chunks of ``ckanext.harvest.clear.batch_size``
+    datasets (100 by default), each one committed along with the progress
+    made, which harvest_source_clear_status returns. If the clearing is
+    interrupted, calling this action again resumes it. A source is only
+    cleared by one process at a time: while it is being cleared, calling
+    this action again does nothing.
+
     :param id: the id of the harvest source to clear
     :type id: string
+    :param background: clear the source in a background thread and return
+        straight away (optional, default: False)
+    :type background: bool
 
     '''
     check_access('harvest_source_clear', context, data_dict)
@@ -96,52 +134,184 @@ def harvest_source_clear(context, data_dict):
         raise NotFound('Harvest source %s does not exist' % harvest_source_id)
 
     harvest_source_id = source.id
-
-    # Clear all datasets from this source from the index
-    harvest_source_index_clear(context, data_dict)
+    background = asbool(data_dict.get('background', False))
 
     model = context['model']
+    lock = _lock_clear(model, harvest_source_id)
+    if lock is None:
+        log.info('Harvest source %s is already being cleared', harvest_source_id)
+        return {'id': harvest_source_id}
 
-    sql = "select id from related where id in (select related_id from related_dataset where dataset_id in (select package_id from harvest_object where harvest_source_id = '{harvest_source_id}'));".format(
-        harvest_source_id=harvest_source_id)
-    result = model.Session.execute(sql)
-    ids = []
-    for row in result:
-        ids.append(row[0])
-    related_ids = "('" + "','".join(ids) + "')"
+    try:
+        # Clear all datasets from this source from the index
+        harvest_source_index_clear(context, data_dict)
+
+        batch_size = int(config.get('ckanext.harvest.clear.batch_size',
+                                    DEFAULT_CLEAR_BATCH_SIZE))
+        _start_clear(model.Session, harvest_source_id)
+
+        if background:
+            # The thread releases the lock once done
+            thread = threading.Thread(target=_clear_source_in_background,
+                                      args=(harvest_source_id, batch_size, lock))
+            thread.daemon = True
+            thread.start()
+            lock = None
+            return {'id': harvest_source_id}
 
-    sql = '''begin;
-    update package set state = 'to_delete' where id in (select package_id from harvest_object where harvest_source_id = '{harvest_source_id}');'''.format(
-        harvest_source_id=harvest_source_id)
+        try:
+            _clear_source(model.Session, harvest_source_id, batch_size)
+        except Exception, e:
+            _fail_clear(model.Session, harvest_source_id, e)
+            raise
+    finally:
+        if lock is not None:
+            _unlock_clear(lock, harvest_source_id)
 
-    # CKAN-2.3 or above: delete resource views, resource revisions & resources
-    if toolkit.check_ckan_version(min_version='2.3'):
-        sql += '''
-        delete from resource_view where resource_id in (select id from resource where package_id in (select id from package where state = 'to_delete' ));
-        delete from resource_revision where package_id in (select id from package where state = 'to_delete' );
-        delete from resource where package_id in (select id from package where state = 'to_delete' );
-        '''
-    # Backwards-compatibility: support ResourceGroup (pre-CKAN-2.3)
+    # Refresh the index for this source to update the status object
+    get_action('harvest_source_reindex')(context, {'id': harvest_source_id})
+
+    return {'id': harvest_source_id}
+
+
+def _lock_clear(model, source_id):
+    '''
+    Takes an advisory lock on the clearing of a harvest source, so it is not
+    cleared by two processes (or threads) at the same time. The lock is held
+    by a connection of its own, so it is kept across the commits of each
+    chunk, and released by the database if the process dies. Returns the
+    connection, or None if the source is already being cleared.
+    '''
+    conn = model.meta.engine.connect()
+    try:
+        # The lock outlives the transaction, which is committed straight
+        # away so the connection is not left idle in it
+        trans = conn.begin()
+        locked = conn.execute(text('''
+            SELECT pg_try_advisory_lock(
+                ('x' || substr(md5(:key), 1, 15))::bit(60)::bigint)'''),
+            key=CLEAR_PROGRESS_KEY % source_id).scalar()
+        trans.commit()
+    except:
+        conn.close()
+        raise
+    if not locked:
+        conn.close()
+        return None
+    return conn
+
+
+def _unlock_clear(conn, source_id):
+    # Session level locks survive the connection going back to the pool, so
+    # they need to be released explicitly
+    try:
+        trans = conn.begin()
+        conn.execute(text('''
+            SELECT pg_advisory_unlock(
+                ('x' || substr(md5(:key), 1, 15))::bit(60)::bigint)'''),
+            key=CLEAR_PROGRESS_KEY % source_id)
+        trans.commit()
+    finally:
+        conn.close()
+
+
+def _start_clear(session, source_id):
+    progress = _get_clear_progress(session, source_id)
+    if progress and progress['status'] != 'finished':
+        log.info('Resuming the clearing of harvest source %s after %s datasets',
+                 source_id, progress['datasets'])
+        progress['status'] = 'running'
     else:
-        sql += '''
-        delete from resource_revision where resource_group_id in
-        (select id from resource_group where package_id in
-        (select id from package where state = 'to_delete'));
-        delete from resource where resource_group_id in
-        (select id from resource_group where package_id in
-        (select id from package where state = 'to_delete'));
-        delete from resource_group_revision where package_id in
-        (select id from package where state = 'to_delete');
-        delete from resource_group where package_id  in
-        (select id from package where state = 'to_delete');
-        '''
-    sql += '''
-    delete from harvest_object_error where harvest_object_id in (select id from harvest_object where harvest_source_id = '{harvest_source_id}');
-    delete from harvest_object_extra where harvest_object_id in (select id from harvest_object where harvest_source_id = '{harvest_source_id}');
-    delete from harvest_object where harvest_source_id = '{harvest_source_id}';
-    delete from harvest_gather_error where harvest_job_id in (select id from harvest_job where source_id = '{harvest_source_id}');
-    delete from harvest_job where source_id = '{harvest_source_id}';
-    delete from package_role where package_id in (select id from package where state = 'to_delete' );
+        progress = {
+            'status': 'running',
+            'datasets': 0,
+            'started': datetime.datetime.utcnow().isoformat(),
+        }
+    _set_clear_progress(session, source_id, progress)
+    session.commit()
+
+
+def _set_clear_progress(session, source_id, progress):
+    progress['updated'] = datetime.datetime.utcnow().isoformat()
+    key = CLEAR_PROGRESS_KEY % source_id
+    obj = session.query(HarvestSystemInfo).filter_by(key=key).first()
+    if not obj:
+        obj = HarvestSystemInfo()
+        obj.key = key
+        session.add(obj)
+    obj.value = codec.dumps(progress)
+
+
+def _clear_source_in_background(source_id, batch_size, lock):
+    from ckan import model
+    try:
+        _clear_source(model.Session, source_id, batch_size)
+        context = {'model': model, 'session': model.Session,
+                   'ignore_auth': True}
+        get_action('harvest_source_reindex')(context, {'id': source_id})
+    except Exception, e:
+        log.exception('Error clearing harvest source %s', source_id)
+        _fail_clear(model.Session, source_id, e)
+    finally:
+        model.Session.remove()
+        _unlock_clear(lock, source_id)
+
+
+def _fail_clear(session, source_id, error):
+    session.rollback()
+    progress = _get_clear_progress(session, source_id)
+    progress['status'] = 'failed'
+    progress['error'] = unicode(error)
+    _set_clear_progress(session, source_id, progress)
+    session.commit()
+
+
+def _clear_source(session, source_id, batch_size):
+    '''
+    Deletes the datasets of a harvest source by chunks, and then the objects
+    without dataset and the jobs of the source. The objects of the deleted
+    datasets are deleted with them, so each chunk is taken from the datasets
+    still linked to the source, including those added meanwhile
+    '''
+    progress = _get_clear_progress(session, source_id)
+    while True:
+        package_ids = [row[0] for row in session.execute('''
+            SELECT DISTINCT package_id FROM harvest_object
+            WHERE harvest_source_id = :source_id
+            AND package_id IS NOT NULL
+            LIMIT :limit''', {
+                'source_id': source_id,
+                'limit': batch_size,
+            })]
+        if not package_ids:
+            break
+        _delete_source_packages(session, source_id, tuple(package_ids))
+        progress['datasets'] += len(package_ids)
+        _set_clear_progress(session, source_id, progress)
+        session.commit()
+        log.debug('Deleted %i datasets of harvest source %s',
+                  progress['datasets'], source_id)
+
+    # Objects without dataset
+    while True:
+        object_ids = tuple(row[0] for row in session.execute('''
+            SELECT id FROM harvest_object
+            WHERE harvest_source_id = :source_id
+            AND package_id IS NULL
+            LIMIT :limit''', {'source_id': source_id, 'limit': batch_size}))
+        if not object_ids:
+            break
+        session.execute('''
+        delete from harvest_object_error where harvest_object_id in :object_ids;
+        delete from harvest_object_extra where harvest_object_id in :object_ids;
+        delete from harvest_object where id in :object_ids;
+        ''', {'object_ids': object_ids})
+        session.commit()
+
+    session.execute('''
+    delete from harvest_gather_error where harvest_job_id in (select id from harvest_job where source_id = :source_id);
+    delete from harvest_job where source_id = :source_id;
+    delete from harvest_guid_fingerprint where harvest_source_id = :source_id;
 
     DELETE FROM user_object_role
     USING user_object_role u
@@ -152,27 +322,63 @@ def harvest_source_clear(context, data_dict):
     AND u.context = 'Package'
     AND user_object_role.id = u.id
     ;
+    ''', {'source_id': source_id})
+    progress['status'] = 'finished'
+    _set_clear_progress(session, source_id, progress)
+    session.commit()
+    log.info('Cleared harvest source %s, %i datasets deleted',
+             source_id, progress['datasets'])
+
+
+def _delete_source_packages(session, source_id, package_ids):
+    params = {'source_id': source_id, 'package_ids': package_ids}
+    related_ids = tuple(row[0] for row in session.execute(
+        'select related_id from related_dataset where dataset_id in :package_ids',
+        params))
+
+    sql = '''
+    delete from harvest_object_error where harvest_object_id in (select id from harvest_object where harvest_source_id = :source_id and package_id in :package_ids);
+    delete from harvest_object_extra where harvest_object_id in (select id from harvest_object where harvest_source_id = :source_id and package_id in :package_ids);
+    delete from harvest_object where harvest_source_id = :source_id and package_id in :package_ids;
+    '''
 
-    delete from package_tag_revision where package_id in (select id from package where state = 'to_delete');
-    delete from member_revision where table_id in (select id from package where state = 'to_delete');
-    delete from package_extra_revision where package_id in (select id from package where state = 'to_delete');
-    delete from package_revision where id in (select id from package where state = 'to_delete');
-    delete from package_tag where package_id in (select id from package where state = 'to_delete');
-    delete from package_extra where package_id in (select id from package where state = 'to_delete');
-    delete from member where table_id in (select id from package where state = 'to_delete');
-    delete from related_dataset where dataset_id in (select id from package where state = 'to_delete');
-    delete from related where id in {related_ids};
-    delete from package where id in (select id from package where state = 'to_delete');
-    commit;
-    '''.format(
-        harvest_source_id=harvest_source_id, related_ids=related_ids)
-
-    model.Session.execute(sql)
-
-    # Refresh the index for this source to update the status object
-    get_action('harvest_source_reindex')(context, {'id': harvest_source_id})
-
-    return {'id': harvest_source_id}
+    # CKAN-2.3 or above: delete resource views, resource revisions & resources
+    if toolkit.check_ckan_version(min_version='2.3'):
+        sql += '''
+        delete from resource_view where resource_id in (select id from resource where package_id in :package_ids);
+        delete from resource_revision where package_id in :package_ids;
+        delete from resource where package_id in :package_ids;
+        '''
+    # Backwards-compatibility: support ResourceGroup (pre-CKAN-2.3)
+    else:
+        sql += '''
+        delete from resource_revision where resource_group_id in
+        (select id from resource_group where package_id in :package_ids);
+        delete from resource where resource_group_id in
+        (select id from resource_group where package_id in :package_ids);
+        delete from resource_group_revision where package_id in :package_ids;
+        delete from resource_group where package_id in :package_ids;
+        '''
+    sql += '''
+    delete from package_role where package_id in :package_ids;
+    delete from package_tag_revision where package_id in :package_ids;
+    delete from member_revision where table_id in :package_ids;
+    delete from package_extra_revision where package_id in :package_ids;
+    delete from package_revision where id in :package_ids;
+    delete from package_tag where package_id in :package_ids;
+    delete from package_extra where package_id in :package_ids;
+    delete from member where table_id in :package_ids;
+    delete from related_dataset where dataset_id in :package_ids;
+    '''
+    if related_ids:
+        sql += '''
+        delete from related where id in :related_ids;
+        '''
+        params['related_ids'] = related_ids
+    sql += '''
+    delete from package where id in :package_ids;
+    '''
+    session.execute(sql, params)
 
 
 def harvest_source_index_clear(context, data_dict):
@@ -262,7 +468,15 @@ def harvest_objects_import(context, data_dict):
 
     last_objects_count = 0
 
-    for obj_id in last_objects_ids:
+    for i, obj_id in enumerate(last_objects_ids):
+        if i % IMPORT_PREFETCH_SIZE == 0:
+            # Read the datasets of the next objects in a single query
+            next_ids = [o[0] for o in last_objects_ids[i:i + IMPORT_PREFETCH_SIZE]]
+            package_ids = session.query(HarvestObject.package_id) \
+                .filter(HarvestObject.id.in_(next_ids)) \
+                .filter(HarvestObject.package_id != None)
+            prefetch_packages([row[0] for row in package_ids])
+
         if segments and str(hashlib.md5(obj_id[0]).hexdigest())[0] not in segments:
             continue
 
@@ -270,9 +484,25 @@ def harvest_objects_import(context, data_dict):
 
         for harvester in PluginImplementations(IHarvester):
             if harvester.info()['name'] == obj.source.type:
-                if hasattr(harvester, 'force_import'):
-                    harvester.force_import = True
-                harvester.import_stage(obj)
+                # The harvester is shared by the whole process (eg the
+                # fetch consumer), so the overrides are only kept during
+                # this import
+                overrides = {'force_import': True}
+                if context.get('http_cache_mode'):
+                    overrides['http_cache_mode'] = context['http_cache_mode']
+                previous = {}
+                for key, value in overrides.items():
+                    if hasattr(harvester, key):
+                        previous[key] = getattr(harvester, key)
+                        setattr(harvester, key, value)
+                try:
+                    if harvester.import_stage(obj):
+                        # Keep the guid index in step, as the fetch consumer
+                        # does
+                        update_guid_fingerprint(obj)
+                finally:
+                    for key, value in previous.items():
+                        setattr(harvester, key, value)
                 break
         last_objects_count += 1
     log.info('Harvest objects imported: %s', last_objects_count)
@@ -357,6 +587,10 @@ def harvest_jobs_run(context, data_dict):
 
     set_harvest_system_info(context, 'last_run_time', datetime.datetime.utcnow() )
 
+    # Send back to the fetch queue the objects whose remote host is due to be
+    # probed or has recovered
+    resubmit_parked_objects()
+
     # Flag finished jobs as such
     jobs = harvest_job_list(context, {'source_id': source_id, 'status': u'Running'})
     if len(jobs):
@@ -376,124 +610,19 @@ def harvest_jobs_run(context, data_dict):
                     msg = '' # message to be emailed for fixed packages
                     job_obj = HarvestJob.get(job['id'])
 
-                    # look for packages with no current harvest objects
-                    # and relink them by marking last complete harvest object
-                    # current
-                    pkgs_no_current = set()
-                    sql = '''
-                        WITH temp_ho AS (
-                          SELECT DISTINCT package_id
-                                  FROM harvest_object
-                                  WHERE current
-                        )
-                        SELECT DISTINCT harvest_object.package_id
-                        FROM harvest_object
-                        LEFT JOIN temp_ho
-                        ON harvest_object.package_id = temp_ho.package_id
-                        JOIN package
-                        ON harvest_object.package_id = package.id
-                        WHERE
-                            package.state = 'active'
-                        AND
-                            temp_ho.package_id IS NULL
-                        AND
-                            harvest_object.state = 'COMPLETE'
-                        AND
-                            harvest_object.harvest_source_id = :harvest_source_id
-                        '''
-                    results = model.Session.execute(sql,
-                            {'harvest_source_id': job_obj.source_id})
-
-                    for row in results:
-                        pkgs_no_current.add(row['package_id'])
-                    if len(pkgs_no_current) > 0:
-                        log_message = '%s packages to be relinked for ' \
-                                'source %s' % (len(pkgs_no_current),
-                                job_obj.source_id)
-                        msg += log_message + '\n'
-                        log.info(log_message)
-
-                    # set last complete harvest object to be current
-                    sql = '''
-                        UPDATE harvest_object
-                        SET current = 't'
-                        WHERE
-                            package_id = :id
-                        AND
-                            state = 'COMPLETE'
-                        AND
-                            import_finished = (
-                                SELECT MAX(import_finished)
-                                FROM harvest_object
-                                WHERE
-                                    state = 'COMPLETE'
-                                AND
-                                    package_id = :id
-                            )
-                        RETURNING 1
-                    '''
-                    for id in pkgs_no_current:
-                        result = model.Session.execute(sql, {'id': id}).fetchall()
-                        model.Session.commit()
-                        if result:
-                            search.rebuild(id)
-                            log_message = '%s relinked' % id
-                            msg += log_message + '\n'
-                            log.info(log_message)
-                        else:
-                            log_message = '%s has no valid harvest object.' % id
-                            msg += log_message + '\n'
-                            log.info(log_message)
-
-                    # look for packages with no harvest object and remove them
-                    pkgs_no_harvest_object = set()
-                    source_dataset = model.Package.get(job_obj.source_id)
-                    owner_org = source_dataset.owner_org
-                    sql = '''
-                        SELECT package.id
-                        FROM package
-                        LEFT JOIN harvest_object
-                        ON package.id = harvest_object.package_id
-                        LEFT JOIN package_extra
-                        ON package.id = package_extra.package_id
-                        AND package_extra.key = 'metadata-source'
-                        AND package_extra.value = 'dms'
-                        WHERE
-                            harvest_object.package_id is null
-                        AND
-                            package_extra.package_id is null
-                        AND
-                            package.type='dataset'
-                        AND
-                            package.state='active'
-                        AND
-                            package.owner_org=:owner_org
-                    '''
-                    results = model.Session.execute(sql,
-                            {'owner_org': owner_org})
-
-                    for row in results:
-                        pkgs_no_harvest_object.add(row['id'])
-                    if len(pkgs_no_harvest_object) > 0:
-                        log_message = '%s packages to be removed for source %s' % (
-                                len(pkgs_no_harvest_object),
-                                job_obj.source_id
-                        )
+                    # look for packages updated by the job with no current
+                    # harvest objects and relink them by marking their last
+                    # complete harvest object current
+                    relinked = _relink_job_packages(session, job_obj.id)
+                    model.Session.commit()
+                    if relinked:
+                        log_message = '%s packages relinked for source %s' % (
+                                len(relinked), job_obj.source_id)
                         msg += log_message + '\n'
                         log.info(log_message)
-
-                    for id in pkgs_no_harvest_object:
-                        try:
-                            logic.get_action('package_delete')(context,
-                                    {"id": id})
-                        except Exception, e:
-                            log_message = 'Error deleting %s' % id
-                            msg += log_message + '\n'
-                            log.info(log_message)
-                        else:
-                            log_message = '%s removed' % id
-                            msg += log_message + '\n'
-                            log.info(log_message)
+                        for id in relinked:
+                            msg += '%s relinked\n' % id
+                        index_packages(relinked)
 
                     # email a list of fixed packages
                     if msg:
@@ -510,6 +639,13 @@ def harvest_jobs_run(context, data_dict):
                             log.error('Error: %s; email: %s' % (e, email))
 
 
+                    # make sure the datasets of the job are searchable
+                    # before calling it finished
+                    if async_indexing_enabled():
+                        get_action('harvest_index_flush')(
+                            {'model': model, 'session': session,
+                             'ignore_auth': True}, {})
+
                     # finally we can call this job finished
                     job_obj.status = u'Finished'
                     last_object = session.query(HarvestObject) \
@@ -523,9 +659,21 @@ def harvest_jobs_run(context, data_dict):
                         job_obj.finished = datetime.datetime.utcnow()
                     job_obj.save()
 
+                    # store the previous versions of the documents harvested
+                    # by the job as deltas
+                    if asbool(config.get('ckanext.harvest.delta_encoding', False)):
+                        try:
+                            get_action('harvest_delta_encode')(
+                                {'model': model, 'session': session,
+                                 'ignore_auth': True}, {'job_id': job_obj.id})
+                        except Exception, e:
+                            model.Session.rollback()
+                            log.exception('Error storing the contents of job %s as deltas: %s',
+                                          job_obj.id, e)
+
                     # recreate job for datajson collection or the like.
                     source = job_obj.source
-                    source_config = json.loads(source.config or '{}')
+                    source_config = codec.loads(source.config or '{}')
                     datajson_collection = source_config.get(
                         'datajson_collection')
                     if datajson_collection == 'parents_run':
@@ -533,12 +681,12 @@ def harvest_jobs_run(context, data_dict):
                         new_job.source = source
                         new_job.save()
                         source_config['datajson_collection'] = 'children_run'
-                        source.config = json.dumps(source_config)
+                        source.config = codec.dumps(source_config)
                         source.save()
                     elif datajson_collection:
                         # reset the key if 'children_run', or anything.
                         source_config.pop("datajson_collection", None)
-                        source.config = json.dumps(source_config)
+                        source.config = codec.dumps(source_config)
                         source.save()
 
                     if config.get('ckanext.harvest.email', 'on') == 'on':
@@ -705,30 +853,397 @@ def harvest_jobs_run(context, data_dict):
     return sent_jobs
 
 
+def harvest_index_flush(context, data_dict):
+    '''
+        Indexes right away the harvested datasets waiting in the index queue
+        (when ``ckanext.harvest.async_indexing`` is enabled), committing to
+        Solr once per batch.
+
+        Returns the number of datasets indexed.
+    '''
+    check_access('harvest_index_flush', context, data_dict)
+
+    count = flush_index_queue()
+    log.info('Flushed %i datasets from the index queue', count)
+    return count
+
+
+def harvest_orphans_remove(context, data_dict):
+    '''
+    Removes the datasets of the organizations owning harvest sources that are
+    not linked to any harvest object, unless they were created in the site
+    itself (ie they have a ``metadata-source`` extra set to ``dms``).
+
+    The datasets are flagged as deleted in chunks of
+    ``ckanext.harvest.orphans_batch_size`` datasets (500 by default), each one
+    committed on its own so an interrupted run can just be started again.
+    Each chunk is removed from the search index with a delete-by-query
+    before it is committed, so if the index fails the datasets are left
+    active, rather than deleted but still indexed.
+
+    Note that the datasets are flagged with a raw ``UPDATE`` on the package
+    table for speed: no revisions are created, and the ``IPackageController``
+    hooks of the plugins (eg ``after_delete``) are not called.
+
+    :param source_id: only remove the orphans of the organization of this
+        harvest source (optional)
+    :type source_id: string
+
+    :returns: the number of datasets removed
+    :rtype: int
+    '''
+    check_access('harvest_orphans_remove', context, data_dict)
+
+    session = context['session']
+
+    source_id = data_dict.get('source_id')
+    if source_id:
+        source = HarvestSource.get(source_id)
+        if not source:
+            raise NotFound('Harvest source %s does not exist' % source_id)
+        owners_sql = 'SELECT owner_org FROM package WHERE id = :source_id'
+        source_id = source.id
+    else:
+        owners_sql = '''
+            SELECT owner_org FROM package
+            WHERE type = 'harvest'
+            AND state = 'active'
+            AND owner_org IS NOT NULL'''
+
+    sql = '''
+        UPDATE package
+        SET state = 'deleted', metadata_modified = :now
+        WHERE id IN (
+            SELECT p.id FROM package p
+            WHERE p.type = 'dataset'
+            AND p.state = 'active'
+            AND p.owner_org IN (%s)
+            AND NOT EXISTS (
+                SELECT 1 FROM harvest_object o
+                WHERE o.package_id = p.id)
+            AND NOT EXISTS (
+                SELECT 1 FROM package_extra e
+                WHERE e.package_id = p.id
+                AND e.key = 'metadata-source'
+                AND e.value = 'dms')
+            LIMIT :limit)
+        RETURNING id
+    ''' % owners_sql
+    batch_size = int(config.get('ckanext.harvest.orphans_batch_size',
+                                DEFAULT_ORPHANS_BATCH_SIZE))
+
+    conn = make_connection()
+    removed = 0
+    try:
+        while True:
+            package_ids = [row[0] for row in session.execute(sql, {
+                'source_id': source_id,
+                'now': datetime.datetime.utcnow(),
+                'limit': batch_size})]
+            if not package_ids:
+                session.commit()
+                break
+            query = ''' +site_id:"%s" +id:(%s) ''' % (
+                config.get('ckan.site_id'),
+                ' OR '.join('"%s"' % id for id in package_ids))
+            try:
+                conn.delete_query(query)
+            except Exception, e:
+                session.rollback()
+                log.exception(e)
+                raise SearchIndexError(e)
+            session.commit()
+            removed += len(package_ids)
+            log.info('Removed %i orphaned datasets (%i so far)',
+                     len(package_ids), removed)
+            if len(package_ids) < batch_size:
+                break
+        if removed and asbool(config.get('ckan.search.solr_commit', 'true')):
+            conn.commit()
+    finally:
+        conn.close()
+
+    log.info('Removed %i orphaned datasets in total', removed)
+    return removed
+
+
+def harvest_delta_encode(context, data_dict):
+    '''
+    Stores the contents of the old versions of the harvested documents as
+    deltas against the next version of the same document, so keeping their
+    history takes little space. Old contents are rebuilt when accessed.
+
+    The number of deltas needed to rebuild a content is limited by the
+    ``ckanext.harvest.delta_max_chain`` option (10 by default).
+
+    :param source_id: only encode the documents of this harvest source
+        (optional)
+    :type source_id: string
+    :param job_id: only encode the documents harvested by this job
+        (optional)
+    :type job_id: string
+
+    :returns: the number of contents stored as deltas
+    :rtype: int
+    '''
+    check_access('harvest_delta_encode', context, data_dict)
+
+    source_id = data_dict.get('source_id')
+    if source_id:
+        source = HarvestSource.get(source_id)
+        if not source:
+            raise NotFound('Harvest source %s does not exist' % source_id)
+        source_id = source.id
+
+    max_chain = int(config.get('ckanext.harvest.delta_max_chain',
+                               DEFAULT_MAX_DELTA_CHAIN))
+    return delta_encode_contents(source_id=source_id,
+                                 job_id=data_dict.get('job_id'),
+                                 max_chain=max_chain)
+
+
+def harvest_objects_archive(context, data_dict):
+    '''
+    Moves the contents of the old harvest objects out of the database, to
+    the archive segment files in the ``ckanext.harvest.archive.dir``
+    directory. Only contents referenced by non-current objects gathered more
+    than ``days`` days ago are archived. They can still be read through the
+    objects as usual.
+
+    :param days: the age in days of the objects to archive (defaults to the
+        ``ckanext.harvest.archive.after_days`` option, 90)
+    :type days: int
+
+    :returns: the number of contents archived
+    :rtype: int
+    '''
+    check_access('harvest_objects_archive', context, data_dict)
+
+    archive = get_archive()
+    if archive is None:
+        raise logic.ValidationError({'archive':
+            ['The ckanext.harvest.archive.dir option is not set']})
+
+    days = int(data_dict.get('days') or
+               config.get('ckanext.harvest.archive.after_days',
+                          DEFAULT_ARCHIVE_AFTER_DAYS))
+    older_than = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    return archive_contents(archive, older_than)
+
+
+def harvest_history_purge(context, data_dict):
+    '''
+    Deletes the old harvest jobs, with their objects and errors, according to
+    the retention policy: the last ``keep_jobs`` jobs of each source and the
+    jobs younger than ``days`` days are kept, as are the current objects, the
+    last object of each package without a current one, and the jobs they
+    belong to. The contents no longer used by any object are deleted too.
+
+    Rows are deleted in chunks of ``ckanext.harvest.retention.batch_size``
+    rows (1000 by default), each committed separately and followed by a
+    pause of ``ckanext.harvest.retention.pause`` seconds (0.1 by default).
+
+    :param keep_jobs: the number of jobs to keep for each source (defaults
+        to the ``ckanext.harvest.retention.keep_jobs`` option)
+    :type keep_jobs: int
+    :param days: the age in days of the jobs to keep (defaults to the
+        ``ckanext.harvest.retention.days`` option)
+    :type days: int
+
+    :returns: the number of jobs, objects and contents deleted
+    :rtype: dictionary
+    '''
+    check_access('harvest_history_purge', context, data_dict)
+
+    keep_jobs = data_dict.get('keep_jobs') or \
+        config.get('ckanext.harvest.retention.keep_jobs')
+    days = data_dict.get('days') or \
+        config.get('ckanext.harvest.retention.days')
+    if not keep_jobs and not days:
+        raise logic.ValidationError({'retention':
+            ['Either the number of jobs or the days to keep must be set']})
+
+    batch_size = int(config.get('ckanext.harvest.retention.batch_size',
+                                DEFAULT_RETENTION_BATCH_SIZE))
+    pause = float(config.get('ckanext.harvest.retention.pause', 0.1))
+    older_than = None
+    if days:
+        older_than = datetime.datetime.utcnow() - \
+            datetime.timedelta(days=int(days))
+
+    deleted = purge_history(keep_jobs=int(keep_jobs or 1),
+                            older_than=older_than,
+                            batch_size=batch_size, pause=pause)
+    deleted['contents'] = collect_content_garbage(batch_size=batch_size,
+                                                  pause=pause)
+    return deleted
+
+
+def _relink_job_packages(session, job_id):
+    '''
+    Marks as current the last complete harvest object of the active packages
+    that were harvested by the given job but are left without a current
+    harvest object (eg because their last import failed), in a single
+    statement. Returns the ids of the packages relinked.
+    '''
+    sql = '''
+        WITH job_packages AS (
+            SELECT DISTINCT o.package_id
+            FROM harvest_object o
+            JOIN package p ON p.id = o.package_id
+            WHERE o.harvest_job_id = :job_id
+            AND p.state = 'active'
+            AND NOT EXISTS (
+                SELECT 1 FROM harvest_object c
+                WHERE c.package_id = o.package_id
+                AND c.current = true)
+        ), last_complete AS (
+            SELECT id, row_number() OVER (
+                PARTITION BY package_id
+                ORDER BY import_finished DESC NULLS LAST) AS rank
+            FROM harvest_object
+            WHERE state = 'COMPLETE'
+            AND package_id IN (SELECT package_id FROM job_packages)
+        )
+        UPDATE harvest_object
+        SET current = true
+        FROM last_complete
+        WHERE harvest_object.id = last_complete.id
+        AND last_complete.rank = 1
+        RETURNING harvest_object.package_id
+    '''
+    return [row[0] for row in session.execute(sql, {'job_id': job_id})]
+
+
 @logic.side_effect_free
 def harvest_sources_reindex(context, data_dict):
     '''
         Reindexes all harvest source datasets with the latest status
+
+        The sources are read in pages of ``batch_size`` (defaults to the
+        ``ckanext.harvest.reindex_batch_size`` option, 100), the status of all
+        the sources of a page is computed at once and their documents are sent
+        to the search index in a single request, with a single commit per
+        page. Pages can be
+        processed by several worker processes in parallel, set with the
+        ``ckanext.harvest.reindex_processes`` option (1 by default) or the
+        ``processes`` key of the context, which the ``reindex`` command
+        sets. It can not be set through the API, as forking workers is not
+        safe in a web server process.
+
+        :param batch_size: the number of sources reindexed at once
+        :type batch_size: int
+
+        :returns: the number of sources reindexed
+        :rtype: int
     '''
     log.info('Reindexing all harvest sources')
     check_access('harvest_sources_reindex', context, data_dict)
 
     model = context['model']
 
-    packages = model.Session.query(model.Package) \
+    batch_size = int(data_dict.get('batch_size') or
+                     config.get('ckanext.harvest.reindex_batch_size',
+                                DEFAULT_REINDEX_BATCH_SIZE))
+    processes = int(context.get('processes') or
+                    config.get('ckanext.harvest.reindex_processes', 1))
+
+    total = model.Session.query(model.Package) \
         .filter(model.Package.type == DATASET_TYPE_NAME) \
         .filter(model.Package.state == u'active') \
-        .all()
+        .count()
 
-    package_index = PackageSearchIndex()
-
-    reindex_context = {'defer_commit': True}
-    for package in packages:
-        get_action('harvest_source_reindex')(reindex_context, {'id': package.id})
-
-    package_index.commit()
+    batches = _get_source_id_batches(model, batch_size)
 
-    return True
+    done = 0
+    if processes > 1:
+        # The connections inherited from this process can not be shared with
+        # the workers
+        model.Session.remove()
+        model.meta.engine.dispose()
+        pool = multiprocessing.Pool(processes, initializer=_reindex_worker_init)
+        try:
+            for count in pool.imap_unordered(_reindex_sources_in_worker,
+                                             batches):
+                done += count
+                log.info('Reindexed %i/%i harvest sources', done, total)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for source_ids in batches:
+            done += _reindex_sources(source_ids)
+            log.info('Reindexed %i/%i harvest sources', done, total)
+
+    return done
+
+
+def _get_source_id_batches(model, batch_size):
+    '''Yields the ids of the active harvest sources in lists of batch_size,
+    paging through them by id'''
+    last_id = None
+    while True:
+        q = model.Session.query(model.Package.id) \
+            .filter(model.Package.type == DATASET_TYPE_NAME) \
+            .filter(model.Package.state == u'active')
+        if last_id is not None:
+            q = q.filter(model.Package.id > last_id)
+        source_ids = [row[0] for row in
+                      q.order_by(model.Package.id).limit(batch_size)]
+        if not source_ids:
+            break
+        yield source_ids
+        last_id = source_ids[-1]
+
+
+def _reindex_worker_init():
+    # Make sure each worker opens its own database connections
+    from ckan import model
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+
+def _reindex_sources(source_ids):
+    '''Reindexes a batch of harvest sources, sending their documents to the
+    search index in a single request and committing once. Returns the
+    number of sources reindexed.'''
+    from ckan import model
+    context = {'model': model, 'session': model.Session}
+    status = _get_sources_status(context, source_ids)
+    count = 0
+    try:
+        with batched_index_adds():
+            for source_id in source_ids:
+                reindex_context = {'model': model,
+                                   'session': model.Session,
+                                   'defer_commit': True,
+                                   'harvest_sources_status': status}
+                try:
+                    get_action('harvest_source_reindex')(reindex_context,
+                                                         {'id': source_id})
+                    count += 1
+                except NotFound, e:
+                    log.error('Could not reindex harvest source %s: %s',
+                              source_id, e)
+    except SearchIndexError, e:
+        log.error('Could not reindex harvest sources %s: %s',
+                  ', '.join(source_ids), e)
+        return 0
+    PackageSearchIndex().commit()
+    return count
+
+
+def _reindex_sources_in_worker(source_ids):
+    '''Reindexes a batch of harvest sources in a worker process, which
+    does not keep its session between batches'''
+    from ckan import model
+    try:
+        return _reindex_sources(source_ids)
+    finally:
+        model.Session.remove()
 
 
 @logic.side_effect_free
@@ -748,7 +1263,7 @@ def harvest_source_reindex(context, data_dict):
     # Remove configuration values
     new_dict = {}
     if package_dict.get('config'):
-        config = json.loads(package_dict['config'])
+        config = codec.loads(package_dict['config'])
         for key, value in package_dict.iteritems():
             if key not in config:
                 new_dict[key] = value
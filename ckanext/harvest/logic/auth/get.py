@@ -105,6 +105,28 @@ def harvest_job_list(context, data_dict):
                 .format(user, source_id)}
 
 
+def harvest_source_clear_status(context, data_dict):
+    '''
+        Authorization check for getting the progress of the clearing of a
+        harvest source
+
+        It forwards the checks to harvest_source_update, ie the users that
+        can clear the source can follow the progress
+    '''
+    user = context.get('user')
+    source_id = data_dict['id']
+
+    try:
+        pt.check_access('harvest_source_update',
+                        context,
+                        {'id': source_id})
+        return {'success': True}
+    except pt.NotAuthorized:
+        return {'success': False,
+                'msg': pt._('User {0} not authorized to see the clearing of source {1}')
+                .format(user, source_id)}
+
+
 
 @auth_allow_anonymous_access
 def harvest_object_show(context, data_dict):
@@ -132,3 +154,13 @@ def harvesters_info_show(context, data_dict):
         Everybody can do it
     '''
     return {'success': True}
+
+
+def harvest_remote_host_list(context, data_dict):
+    '''
+        Authorization check for getting the state of the remote hosts
+
+        Only sysadmins can do it
+    '''
+    # sysadmins can run all actions if we've got to this point we're not a sysadmin
+    return {'success': False, 'msg': pt._('Only sysadmins can see the state of the remote hosts')}
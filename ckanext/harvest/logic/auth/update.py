@@ -58,6 +58,63 @@ def harvest_jobs_run(context, data_dict):
     else:
         return {'success': True}
 
+def harvest_index_flush(context, data_dict):
+    '''
+        Authorization check for indexing the datasets waiting in the index
+        queue
+
+        Only sysadmins can do it
+    '''
+    if not user_is_sysadmin(context):
+        return {'success': False, 'msg': pt._('Only sysadmins can flush the harvest index queue')}
+    else:
+        return {'success': True}
+
+def harvest_orphans_remove(context, data_dict):
+    '''
+        Authorization check for removing the datasets not linked to any
+        harvest object
+
+        Only sysadmins can do it
+    '''
+    if not user_is_sysadmin(context):
+        return {'success': False, 'msg': pt._('Only sysadmins can remove orphaned datasets')}
+    else:
+        return {'success': True}
+
+def harvest_delta_encode(context, data_dict):
+    '''
+        Authorization check for storing old harvest object contents as deltas
+
+        Only sysadmins can do it
+    '''
+    if not user_is_sysadmin(context):
+        return {'success': False, 'msg': pt._('Only sysadmins can delta encode harvest object contents')}
+    else:
+        return {'success': True}
+
+def harvest_objects_archive(context, data_dict):
+    '''
+        Authorization check for archiving the contents of old harvest objects
+
+        Only sysadmins can do it
+    '''
+    if not user_is_sysadmin(context):
+        return {'success': False, 'msg': pt._('Only sysadmins can archive harvest objects')}
+    else:
+        return {'success': True}
+
+def harvest_history_purge(context, data_dict):
+    '''
+        Authorization check for deleting the old harvest jobs and objects
+
+        Only sysadmins can do it
+    '''
+    if not user_is_sysadmin(context):
+        return {'success': False, 'msg': pt._('Only sysadmins can purge the harvest history')}
+    else:
+        return {'success': True}
+
 def harvest_sources_reindex(context, data_dict):
     '''
         Authorization check for reindexing all harvest sources
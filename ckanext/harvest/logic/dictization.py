@@ -77,6 +77,7 @@ def harvest_job_dictize(job, context):
 
 def harvest_object_dictize(obj, context):
     out = obj.as_dict()
+    out['content'] = obj.content
     out['source'] = obj.harvest_source_id
     out['job'] = obj.harvest_job_id
 
@@ -1,11 +1,11 @@
 import logging
 import urlparse
-import json
 
 from ckan.lib.navl.dictization_functions import Invalid, validate
 from ckan import model
 from ckan.plugins import PluginImplementations
 
+from ckanext.harvest import codec
 from ckanext.harvest.plugin import DATASET_TYPE_NAME
 from ckanext.harvest.model import HarvestSource, UPDATE_FREQUENCIES, HarvestJob
 from ckanext.harvest.interfaces import IHarvester
@@ -161,7 +161,7 @@ def harvest_source_extra_validator(key,data,errors,context):
             # remove config extra so we can add back cleanly later
             package_extras.pop(num)
             try:
-                config_dict = json.loads(extra.get('value') or '{}')
+                config_dict = codec.loads(extra.get('value') or '{}')
             except ValueError:
                 log.error('Wrong JSON provided in config, skipping')
                 config_dict = {}
@@ -170,7 +170,7 @@ def harvest_source_extra_validator(key,data,errors,context):
         config_dict = {}
     config_dict.update(extra_data)
     if config_dict and not extra_errors:
-        config = json.dumps(config_dict)
+        config = codec.dumps(config_dict)
         package_extras.append(dict(key='config',
                                    value=config))
         data[('config',)] = config
@@ -180,7 +180,7 @@ def harvest_source_extra_validator(key,data,errors,context):
 def harvest_source_convert_from_config(key,data,errors,context):
     config = data[key]
     if config:
-        config_dict = json.loads(config)
+        config_dict = codec.loads(config)
         for key, value in config_dict.iteritems():
             data[(key,)] = value
 
@@ -1,15 +1,23 @@
 import logging
+import time
 import datetime
+import hashlib
 import uuid
+import zlib
 
 from sqlalchemy import event
+from sqlalchemy import bindparam
 from sqlalchemy import distinct
 from sqlalchemy import Table
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import types
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.orm import backref, relation
+from sqlalchemy.schema import CreateIndex
 
 from ckan import model
 from ckan import logic
@@ -19,28 +27,60 @@ from ckan.model.domain_object import DomainObject
 from ckan.model.package import Package
 from ckan.lib.munge import munge_title_to_name
 
+from ckanext.harvest.delta import make_delta, apply_delta
+from ckanext.harvest.archive import get_archive
+
 UPDATE_FREQUENCIES = ['MANUAL','MONTHLY','WEEKLY','BIWEEKLY','DAILY', 'ALWAYS']
 
+# Free space left in the harvest_object pages, so that state updates can be
+# written in place (HOT updates) rather than in a new page
+HARVEST_OBJECT_FILLFACTOR = 80
+
+# zlib compression level of the harvest object contents
+CONTENT_COMPRESSION_LEVEL = 6
+
+# Maximum number of deltas applied to rebuild a content
+DEFAULT_MAX_DELTA_CHAIN = 10
+
+# Number of partitions created by migrate_partitions
+DEFAULT_PARTITIONS = 16
+
+# Number of contents moved per transaction by migrate_contents
+DEFAULT_MIGRATE_CONTENTS_BATCH_SIZE = 500
+
 log = logging.getLogger(__name__)
 
 __all__ = [
     'HarvestSource', 'harvest_source_table',
     'HarvestJob', 'harvest_job_table',
     'HarvestObject', 'harvest_object_table',
+    'HarvestContentBlob', 'harvest_content_blob_table',
     'HarvestGatherError', 'harvest_gather_error_table',
     'HarvestObjectError', 'harvest_object_error_table',
+    'HarvestGuidFingerprint', 'harvest_guid_fingerprint_table',
+    'HarvestRemoteHost', 'harvest_remote_host_table',
+    'HarvestRemoteHostLease', 'harvest_remote_host_lease_table',
 ]
 
 
 harvest_source_table = None
 harvest_job_table = None
 harvest_object_table = None
+harvest_content_blob_table = None
 harvest_gather_error_table = None
 harvest_object_error_table = None
 harvest_object_extra_table = None
 harvest_system_info_table = None
+harvest_guid_fingerprint_table = None
+harvest_remote_host_table = None
+harvest_remote_host_lease_table = None
+
+# Table and id column still holding the contents stored before v9, until
+# migrate_contents has moved them
+legacy_content_table = None
 
 def setup():
+    global legacy_content_table
 
     if harvest_source_table is None:
         define_harvester_tables()
@@ -54,10 +94,15 @@ def setup():
             harvest_source_table.create()
             harvest_job_table.create()
             harvest_object_table.create()
+            harvest_content_blob_table.create()
+            set_harvest_object_fillfactor()
             harvest_gather_error_table.create()
             harvest_object_error_table.create()
             harvest_object_extra_table.create()
             harvest_system_info_table.create()
+            harvest_guid_fingerprint_table.create()
+            harvest_remote_host_table.create()
+            harvest_remote_host_lease_table.create()
 
             log.debug('Harvest tables created')
         else:
@@ -72,6 +117,50 @@ def setup():
             if not 'frequency' in [column['name'] for column in columns]:
                 log.debug('Harvest tables need to be updated')
                 migrate_v3()
+            # The inspector does not see partitioned tables
+            if not 'content_hash' in _get_column_names('harvest_object'):
+                log.debug('Harvest tables need to be updated')
+                migrate_v4()
+            if not harvest_guid_fingerprint_table.exists():
+                log.debug('Harvest tables need to be updated')
+                migrate_v5()
+            if not harvest_remote_host_table.exists():
+                log.debug('Harvest tables need to be updated')
+                migrate_v6()
+            columns = inspector.get_columns('harvest_remote_host')
+            if not 'state' in [column['name'] for column in columns]:
+                log.debug('Harvest tables need to be updated')
+                migrate_v7()
+            if not harvest_content_blob_table.exists():
+                log.debug('Harvest tables need to be updated')
+                migrate_v9()
+            columns = inspector.get_columns('harvest_content_blob')
+            if not 'base_hash' in [column['name'] for column in columns]:
+                log.debug('Harvest tables need to be updated')
+                migrate_v10()
+            if not 'archive_segment' in [column['name'] for column in columns]:
+                log.debug('Harvest tables need to be updated')
+                migrate_v11()
+
+            # Moving the contents takes a long time on big tables, so it is
+            # left to the `migrate_contents` command. They are read from
+            # their old place meanwhile
+            legacy_content_table = get_legacy_content_table()
+            if legacy_content_table:
+                log.warning('Harvest object contents are still stored in '
+                            'the %s table, run the `harvester '
+                            'migrate_contents` command to move them',
+                            legacy_content_table[0])
+                if legacy_content_table[0] == 'harvest_object_content':
+                    cascade_legacy_content_deletes()
+
+            # Indexes are not created here, as building them on big tables
+            # takes a while
+            missing_indexes = get_missing_indexes(inspector)
+            if missing_indexes:
+                log.warning('Harvest indexes %s are missing, run the '
+                            '`harvester initdb` command to create them',
+                            ', '.join(index.name for index in missing_indexes))
 
             # Check if this instance has harvest source datasets
             ## disable migrate check for now. takes too much time.
@@ -141,7 +230,45 @@ class HarvestObject(HarvestDomainObject):
        harvest source. Its contents can be processed and imported to ckan
        packages, RDF graphs, etc.
 
+       The content is stored compressed, once per digest, in
+       ``HarvestContentBlob``, and ``content_hash`` references it. It is
+       only loaded (and rebuilt, for old versions stored as deltas) when
+       accessed.
+    '''
+
+    def _get_content(self):
+        digest = self.content_hash
+        if digest is None:
+            return load_legacy_content(self.id)
+        cached = getattr(self, '_content_cache', None)
+        if cached and cached[0] == digest:
+            return cached[1]
+        content = load_content(digest)
+        if content is not None:
+            self._content_cache = (digest, content)
+        return content
+
+    def _set_content(self, value):
+        if value is None:
+            self.content_hash = None
+            self._content_cache = None
+        else:
+            if isinstance(value, str):
+                value = value.decode('utf-8')
+            self.content_hash = store_content(value)
+            self._content_cache = (self.content_hash, value)
+
+    content = property(_get_content, _set_content)
+
+class HarvestContentBlob(HarvestDomainObject):
+    '''The compressed content of Harvest Objects, stored once per digest.
+
+       Contents of old versions may be stored as a delta against the content
+       of the next version of the same document, ``base_hash``, and moved
+       out of the database to the archive segment files, in which case
+       ``data`` is empty.
     '''
+    key_attr = 'content_hash'
 
 class HarvestObjectExtra(HarvestDomainObject):
     '''Extra key value data for Harvest objects'''
@@ -161,6 +288,29 @@ class HarvestObjectError(HarvestDomainObject):
 class HarvestSystemInfo(HarvestDomainObject):
     '''Some system info for harvest'''
 
+class HarvestGuidFingerprint(HarvestDomainObject):
+    '''Compact index of the remote guids harvested from each source, with
+       the remote modification date and content digest of their current
+       harvest object. It is used by harvesters to only create objects for
+       new and changed guids during the gather stage.
+    '''
+    key_attr = 'guid'
+
+class HarvestRemoteHost(HarvestDomainObject):
+    '''Shared state of a remote host harvest objects are fetched from, used
+       to rate limit the requests sent to it by all the fetch consumers.
+
+       It also holds the state of the circuit breaker of the host: after a
+       number of consecutive fetch failures the circuit is ``open`` and the
+       objects from the host are parked until a probe fetch succeeds.
+    '''
+    key_attr = 'host'
+
+class HarvestRemoteHostLease(HarvestDomainObject):
+    '''A fetch in progress against a remote host. Leases older than
+       ``ckanext.harvest.host_lease_timeout`` are considered stale.
+    '''
+
 def harvest_object_before_insert_listener(mapper,connection,target):
     '''
         For compatibility with old harvesters, check if the source id has
@@ -178,10 +328,14 @@ def define_harvester_tables():
     global harvest_source_table
     global harvest_job_table
     global harvest_object_table
+    global harvest_content_blob_table
     global harvest_object_extra_table
     global harvest_gather_error_table
     global harvest_object_error_table
     global harvest_system_info_table
+    global harvest_guid_fingerprint_table
+    global harvest_remote_host_table
+    global harvest_remote_host_lease_table
 
     harvest_source_table = Table('harvest_source', metadata,
         Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
@@ -214,7 +368,6 @@ def define_harvester_tables():
         Column('current',types.Boolean,default=False),
         Column('gathered', types.DateTime, default=datetime.datetime.utcnow),
         Column('fetch_started', types.DateTime),
-        Column('content', types.UnicodeText, nullable=True),
         Column('fetch_finished', types.DateTime),
         Column('import_started', types.DateTime),
         Column('import_finished', types.DateTime),
@@ -225,6 +378,19 @@ def define_harvester_tables():
         Column('harvest_source_id', types.UnicodeText, ForeignKey('harvest_source.id')),
         Column('package_id', types.UnicodeText, ForeignKey('package.id', deferrable=True), nullable=True),
         Column('report_status', types.UnicodeText, nullable=True),
+        Column('content_hash', types.UnicodeText, nullable=True),
+    )
+
+    # New table
+    harvest_content_blob_table = Table('harvest_content_blob', metadata,
+        Column('content_hash', types.UnicodeText, primary_key=True),
+        Column('data', types.LargeBinary, nullable=True),
+        Column('size', types.Integer),
+        Column('created', types.DateTime, default=datetime.datetime.utcnow),
+        Column('base_hash', types.UnicodeText, nullable=True),
+        Column('archive_segment', types.Integer),
+        Column('archive_offset', types.BigInteger),
+        Column('archive_length', types.Integer),
     )
 
     # New table
@@ -259,6 +425,64 @@ def define_harvester_tables():
                                        Column('value', types.UnicodeText),
                                        )
 
+    # New table
+    harvest_guid_fingerprint_table = Table('harvest_guid_fingerprint', metadata,
+        Column('harvest_source_id', types.UnicodeText, ForeignKey('harvest_source.id'), primary_key=True),
+        Column('guid', types.UnicodeText, primary_key=True),
+        Column('metadata_modified_date', types.DateTime),
+        Column('content_hash', types.UnicodeText),
+        Column('harvest_object_id', types.UnicodeText),
+        Column('package_id', types.UnicodeText),
+    )
+
+    # New table
+    harvest_remote_host_table = Table('harvest_remote_host', metadata,
+        Column('host', types.UnicodeText, primary_key=True),
+        Column('tokens', types.Float),
+        Column('last_refill', types.DateTime),
+        Column('state', types.UnicodeText, default=u'closed'),
+        Column('consecutive_failures', types.Integer, default=0),
+        Column('last_failure', types.DateTime),
+        Column('opened', types.DateTime),
+        Column('next_probe', types.DateTime),
+    )
+
+    # New table
+    harvest_remote_host_lease_table = Table('harvest_remote_host_lease', metadata,
+        Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
+        Column('host', types.UnicodeText, ForeignKey('harvest_remote_host.host'), nullable=False),
+        Column('harvest_object_id', types.UnicodeText),
+        Column('acquired', types.DateTime, default=datetime.datetime.utcnow),
+    )
+
+    # Indexes for the most frequent queries. They are created with the
+    # tables on new instances, and by migrate_indexes on existing ones
+    Index('harvest_job_source_id_created_idx',
+          harvest_job_table.c.source_id, harvest_job_table.c.created)
+    Index('harvest_object_package_id_idx',
+          harvest_object_table.c.package_id)
+    Index('harvest_object_current_package_id_idx',
+          harvest_object_table.c.package_id,
+          postgresql_where=harvest_object_table.c.current == True)
+    Index('harvest_object_harvest_job_id_state_idx',
+          harvest_object_table.c.harvest_job_id, harvest_object_table.c.state)
+    Index('harvest_object_current_harvest_source_id_idx',
+          harvest_object_table.c.harvest_source_id,
+          postgresql_where=harvest_object_table.c.current == True)
+    Index('harvest_object_guid_idx',
+          harvest_object_table.c.guid)
+    Index('harvest_object_content_hash_idx',
+          harvest_object_table.c.content_hash)
+    Index('harvest_content_blob_base_hash_idx',
+          harvest_content_blob_table.c.base_hash,
+          postgresql_where=harvest_content_blob_table.c.base_hash != None)
+    Index('harvest_object_error_harvest_object_id_idx',
+          harvest_object_error_table.c.harvest_object_id)
+    Index('harvest_gather_error_harvest_job_id_idx',
+          harvest_gather_error_table.c.harvest_job_id)
+    Index('harvest_object_extra_harvest_object_id_idx',
+          harvest_object_extra_table.c.harvest_object_id)
+
     mapper(
         HarvestSource,
         harvest_source_table,
@@ -300,6 +524,11 @@ def define_harvester_tables():
         },
     )
 
+    mapper(
+        HarvestContentBlob,
+        harvest_content_blob_table,
+    )
+
     mapper(
         HarvestGatherError,
         harvest_gather_error_table,
@@ -338,6 +567,21 @@ def define_harvester_tables():
         harvest_system_info_table,
     )
 
+    mapper(
+        HarvestGuidFingerprint,
+        harvest_guid_fingerprint_table,
+    )
+
+    mapper(
+        HarvestRemoteHost,
+        harvest_remote_host_table,
+    )
+
+    mapper(
+        HarvestRemoteHostLease,
+        harvest_remote_host_lease_table,
+    )
+
     event.listen(HarvestObject, 'before_insert', harvest_object_before_insert_listener)
 
 def migrate_v2():
@@ -429,6 +673,904 @@ ALTER TABLE harvest_object_error
     Session.commit()
     log.info('Harvest tables migrated to v3')
 
+def migrate_v4():
+    log.debug('Migrating harvest tables to v4. This may take a while...')
+    conn = Session.connection()
+
+    statement = '''
+    ALTER TABLE harvest_object ADD COLUMN content_hash text;
+    '''
+    conn.execute(statement)
+    Session.commit()
+    log.info('Harvest tables migrated to v4')
+
+
+def migrate_v5():
+    log.debug('Migrating harvest tables to v5. This may take a while...')
+    harvest_guid_fingerprint_table.create()
+
+    # Build the guid index from the current harvest objects
+    conn = Session.connection()
+    statement = '''
+    INSERT INTO harvest_guid_fingerprint
+        (harvest_source_id, guid, metadata_modified_date, content_hash,
+         harvest_object_id, package_id)
+    SELECT DISTINCT ON (harvest_source_id, guid)
+        harvest_source_id, guid, metadata_modified_date, content_hash,
+        id, package_id
+    FROM harvest_object
+    WHERE current = TRUE
+        AND harvest_source_id IS NOT NULL
+        AND guid IS NOT NULL
+    ORDER BY harvest_source_id, guid, import_finished DESC NULLS LAST;
+    '''
+    conn.execute(statement)
+    Session.commit()
+    log.info('Harvest tables migrated to v5')
+
+
+def migrate_v6():
+    log.debug('Migrating harvest tables to v6')
+    harvest_remote_host_table.create()
+    harvest_remote_host_lease_table.create()
+    log.info('Harvest tables migrated to v6')
+
+
+def migrate_v7():
+    log.debug('Migrating harvest tables to v7')
+    conn = Session.connection()
+
+    statement = '''
+    ALTER TABLE harvest_remote_host
+        ADD COLUMN state text DEFAULT 'closed',
+        ADD COLUMN consecutive_failures integer DEFAULT 0,
+        ADD COLUMN last_failure timestamp without time zone,
+        ADD COLUMN opened timestamp without time zone,
+        ADD COLUMN next_probe timestamp without time zone;
+    '''
+    conn.execute(statement)
+    Session.commit()
+    log.info('Harvest tables migrated to v7')
+
+
+def migrate_v9():
+    log.debug('Migrating harvest tables to v9')
+    harvest_content_blob_table.create()
+    set_harvest_object_fillfactor()
+    log.info('Harvest tables migrated to v9')
+
+
+def get_legacy_content_table():
+    '''
+    Returns the name and id column of the table holding the contents stored
+    before v9, ie ``harvest_object`` itself or the ``harvest_object_content``
+    side table used by v8, or None if there are none left.
+    '''
+    if 'content' in _get_column_names('harvest_object'):
+        return ('harvest_object', 'id')
+    if 'content' in _get_column_names('harvest_object_content'):
+        return ('harvest_object_content', 'harvest_object_id')
+    return None
+
+
+def cascade_legacy_content_deletes():
+    '''
+    Makes the foreign key of the ``harvest_object_content`` table used by v8
+    delete the contents with their harvest objects, so old objects can be
+    purged or cleared before the contents have been migrated. The existing
+    rows are not validated again, so this does not scan the table.
+    '''
+    for constraint, in Session.execute('''
+            SELECT conname FROM pg_constraint
+            WHERE conrelid = CAST('harvest_object_content' AS regclass)
+            AND contype = 'f' AND confdeltype != 'c' ''').fetchall():
+        Session.execute('''
+            ALTER TABLE harvest_object_content DROP CONSTRAINT %s;
+            ALTER TABLE harvest_object_content ADD CONSTRAINT %s
+                FOREIGN KEY (harvest_object_id) REFERENCES harvest_object (id)
+                ON DELETE CASCADE NOT VALID''' % (constraint, constraint))
+        log.info('Harvest object contents are now deleted with their objects')
+    Session.commit()
+
+
+def load_legacy_content(object_id):
+    '''
+    Returns the content of the given object stored before v9, or None. It is
+    read on its own connection, so the current transaction is not aborted
+    if another process has just finished migrating the contents.
+    '''
+    global legacy_content_table
+    table = legacy_content_table
+    if not table or not object_id:
+        return None
+    from ckan.model.meta import engine
+    try:
+        return engine.execute(text(
+            'SELECT content FROM %s WHERE %s = :id' % table),
+            id=object_id).scalar()
+    except DBAPIError:
+        legacy_content_table = None
+        return None
+
+
+def migrate_contents(batch_size=DEFAULT_MIGRATE_CONTENTS_BATCH_SIZE,
+                     pause=0):
+    '''
+    Moves the contents stored before v9 to the content blob table, in
+    chunks of ``batch_size`` objects, each one committed on its own and
+    followed by a ``pause`` of the given seconds, so the harvesters can keep
+    running meanwhile. The moved contents are removed from their old place
+    in the same transaction, so an interrupted migration resumes where it
+    stopped when run again. The old column (or table) is dropped at the
+    end. Returns the number of contents moved.
+
+    Dropping the ``content`` column of ``harvest_object`` does not free its
+    space: run ``VACUUM FULL harvest_object`` (or pg_repack) afterwards.
+    '''
+    global legacy_content_table
+    table = get_legacy_content_table()
+    Session.commit()
+    if not table:
+        return 0
+    table_name, id_column = table
+    select = text('''
+        SELECT %(id)s, content FROM %(table)s
+        WHERE %(id)s > :last_id AND content IS NOT NULL
+        ORDER BY %(id)s LIMIT :limit''' % {'id': id_column,
+                                            'table': table_name})
+    if table_name == 'harvest_object':
+        clear = text('''UPDATE harvest_object SET content = NULL,
+                         content_hash = COALESCE(content_hash, :digest)
+                         WHERE id = :id''')
+    else:
+        clear = text('''UPDATE harvest_object
+                         SET content_hash = COALESCE(content_hash, :digest)
+                         WHERE id = :id''')
+
+    moved = 0
+    last_id = u''
+    while True:
+        rows = Session.execute(select, {'last_id': last_id,
+                                        'limit': batch_size}).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        digests = _store_contents([content for object_id, content in rows])
+        Session.execute(clear, [{'id': object_id, 'digest': digest}
+                                for (object_id, content), digest
+                                in zip(rows, digests)])
+        if table_name == 'harvest_object_content':
+            Session.execute(text('''DELETE FROM harvest_object_content
+                                   WHERE harvest_object_id IN :ids'''),
+                            {'ids': tuple(row[0] for row in rows)})
+        Session.commit()
+        moved += len(rows)
+        log.debug('Moved %i harvest object contents', moved)
+        time.sleep(pause)
+
+    if table_name == 'harvest_object':
+        Session.execute('ALTER TABLE harvest_object DROP COLUMN content')
+    else:
+        Session.execute('DROP TABLE harvest_object_content')
+    Session.commit()
+    legacy_content_table = None
+    log.info('Moved %i harvest object contents', moved)
+    return moved
+
+
+def _store_contents(contents):
+    '''
+    Stores the given contents like store_content, but with a fixed number of
+    statements for the whole list. Returns their digests, in the same order.
+    '''
+    digests = [content_hash(content) for content in contents]
+    unique = dict(zip(digests, contents))
+    # The locks are taken in order, so workers do not deadlock
+    Session.execute(text('''
+        SELECT pg_advisory_xact_lock(
+            ('x' || substr(d.digest, 1, 15))::bit(60)::bigint)
+        FROM (SELECT unnest(CAST(:digests AS text[])) AS digest
+              ORDER BY 1) d'''), {'digests': sorted(unique)}).fetchall()
+    cold = dict(Session.execute(text('''
+        SELECT content_hash, data IS NULL OR base_hash IS NOT NULL
+        FROM harvest_content_blob WHERE content_hash IN :digests'''),
+        {'digests': tuple(unique)}).fetchall())
+
+    inserted, updated = [], []
+    now = datetime.datetime.utcnow()
+    for digest, content in unique.iteritems():
+        if cold.get(digest) is False:
+            continue
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        data = zlib.compress(content, CONTENT_COMPRESSION_LEVEL)
+        if digest in cold:
+            updated.append({'b_content_hash': digest, 'b_data': data})
+        else:
+            inserted.append({'content_hash': digest, 'data': data,
+                             'size': len(content), 'created': now})
+    table = harvest_content_blob_table
+    if inserted:
+        Session.execute(table.insert(), inserted)
+    if updated:
+        Session.execute(table.update()
+                        .where(table.c.content_hash == bindparam('b_content_hash'))
+                        .values(data=bindparam('b_data'), base_hash=None,
+                                archive_segment=None, archive_offset=None,
+                                archive_length=None), updated)
+    return digests
+
+
+def migrate_v10():
+    log.debug('Migrating harvest tables to v10')
+    conn = Session.connection()
+
+    statement = '''
+    ALTER TABLE harvest_content_blob ADD COLUMN base_hash text;
+    '''
+    conn.execute(statement)
+    Session.commit()
+    log.info('Harvest tables migrated to v10')
+
+
+def migrate_v11():
+    log.debug('Migrating harvest tables to v11')
+    conn = Session.connection()
+
+    statement = '''
+    ALTER TABLE harvest_content_blob
+        ALTER COLUMN data DROP NOT NULL,
+        ADD COLUMN archive_segment integer,
+        ADD COLUMN archive_offset bigint,
+        ADD COLUMN archive_length integer;
+    '''
+    conn.execute(statement)
+    Session.commit()
+    log.info('Harvest tables migrated to v11')
+
+
+def set_harvest_object_fillfactor():
+    conn = Session.connection()
+    conn.execute('ALTER TABLE harvest_object SET (fillfactor = %i)'
+                 % HARVEST_OBJECT_FILLFACTOR)
+    Session.commit()
+
+
+def store_content(content):
+    '''
+    Stores the given content in the content blob table, compressed, unless
+    content with the same digest is already stored. Returns the digest.
+
+    Old contents harvested again (stored as deltas or archived) are stored
+    whole in the database again, as they are likely to be read.
+
+    A PostgreSQL advisory lock on the digest is held until the end of the
+    transaction, so concurrent workers storing the same content wait for
+    each other instead of inserting it twice.
+    '''
+    digest = content_hash(content)
+    lock_id = int(digest[:15], 16)
+    Session.execute('SELECT pg_advisory_xact_lock(:id)', {'id': lock_id})
+    cold = Session.execute('''
+        SELECT data IS NULL OR base_hash IS NOT NULL
+        FROM harvest_content_blob WHERE content_hash = :digest''',
+        {'digest': digest}).scalar()
+    if cold is None or cold:
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        data = zlib.compress(content, CONTENT_COMPRESSION_LEVEL)
+        table = harvest_content_blob_table
+        if cold is None:
+            Session.execute(table.insert(), {
+                'content_hash': digest,
+                'data': data,
+                'size': len(content),
+                'created': datetime.datetime.utcnow(),
+            })
+        else:
+            Session.execute(table.update()
+                            .where(table.c.content_hash == digest)
+                            .values(data=data, base_hash=None,
+                                    archive_segment=None, archive_offset=None,
+                                    archive_length=None))
+    return digest
+
+
+def load_content(digest):
+    '''
+    Returns the content stored with the given digest, or None. Contents
+    stored as deltas are rebuilt from their chain of bases, which is read in
+    a single query, and archived contents are read from the archive.
+    '''
+    rows = Session.execute('''
+        WITH RECURSIVE chain(content_hash, data, base_hash, archive_segment,
+                             archive_offset, archive_length, depth) AS (
+            SELECT content_hash, data, base_hash, archive_segment,
+                   archive_offset, archive_length, 0
+            FROM harvest_content_blob
+            WHERE content_hash = :digest
+          UNION ALL
+            SELECT b.content_hash, b.data, b.base_hash, b.archive_segment,
+                   b.archive_offset, b.archive_length, c.depth + 1
+            FROM harvest_content_blob b
+            JOIN chain c ON b.content_hash = c.base_hash
+        )
+        SELECT data, base_hash, archive_segment, archive_offset, archive_length
+        FROM chain ORDER BY depth DESC''',
+        {'digest': digest}).fetchall()
+    if not rows:
+        return None
+    if rows[0][1] is not None:
+        log.error('The base of content %s is missing', digest)
+        return None
+    content = None
+    for data, base_hash, segment, offset, length in rows:
+        if data is None:
+            archive = get_archive()
+            if archive is None or segment is None:
+                log.error('Content %s is archived but the archive is not '
+                          'available', digest)
+                return None
+            data = archive.read(segment, offset, length)
+        data = zlib.decompress(data)
+        if content is None:
+            content = data.decode('utf-8')
+        else:
+            content = apply_delta(content, data)
+    return content
+
+
+def _get_delta_chain(digest):
+    '''Returns the digests of the contents needed to rebuild a content,
+    starting by itself'''
+    return [row[0] for row in Session.execute('''
+        WITH RECURSIVE chain(content_hash, base_hash) AS (
+            SELECT content_hash, base_hash FROM harvest_content_blob
+            WHERE content_hash = :digest
+          UNION ALL
+            SELECT b.content_hash, b.base_hash FROM harvest_content_blob b
+            JOIN chain c ON b.content_hash = c.base_hash
+        )
+        SELECT content_hash FROM chain''', {'digest': digest})]
+
+
+def _get_delta_depth(digest):
+    '''Returns the length of the longest chain of deltas based on a
+    content'''
+    return Session.execute('''
+        WITH RECURSIVE deps(content_hash, depth) AS (
+            SELECT content_hash, 1 FROM harvest_content_blob
+            WHERE base_hash = :digest
+          UNION ALL
+            SELECT b.content_hash, d.depth + 1 FROM harvest_content_blob b
+            JOIN deps d ON b.base_hash = d.content_hash
+        )
+        SELECT coalesce(max(depth), 0) FROM deps''',
+        {'digest': digest}).scalar()
+
+
+def delta_encode_contents(source_id=None, job_id=None,
+                          max_chain=DEFAULT_MAX_DELTA_CHAIN, batch_size=100):
+    '''
+    Stores the contents of old versions of the harvested documents as deltas
+    against the content of the next version of the same document (same
+    source and guid). Only the documents of the given source, or harvested
+    by the given job, are considered if provided.
+
+    Contents referenced by a current object are always kept whole, and so
+    are contents whose delta would not be smaller, or that would need more
+    than ``max_chain`` deltas to be rebuilt (or make the contents based on
+    them need more). The most recent versions are encoded first, so the
+    older ones are kept whole once the chain is too long. Returns the number
+    of contents encoded.
+    '''
+    if job_id:
+        scope = '''AND (harvest_source_id, guid) IN (
+                    SELECT harvest_source_id, guid FROM harvest_object
+                    WHERE harvest_job_id = :job_id)'''
+    elif source_id:
+        scope = 'AND harvest_source_id = :source_id'
+    else:
+        scope = ''
+    candidates = Session.execute('''
+        SELECT o.content_hash, o.next_hash FROM (
+            SELECT content_hash, current, gathered,
+                lead(content_hash) OVER (
+                    PARTITION BY harvest_source_id, guid
+                    ORDER BY gathered) AS next_hash
+            FROM harvest_object
+            WHERE content_hash IS NOT NULL
+            %s
+        ) o
+        JOIN harvest_content_blob b ON b.content_hash = o.content_hash
+        WHERE o.current IS NOT TRUE
+        AND o.next_hash IS NOT NULL
+        AND o.next_hash <> o.content_hash
+        AND b.base_hash IS NULL
+        AND b.data IS NOT NULL
+        AND NOT EXISTS (
+            SELECT 1 FROM harvest_object c
+            WHERE c.content_hash = o.content_hash
+            AND c.current = true)
+        GROUP BY o.content_hash, o.next_hash
+        ORDER BY max(o.gathered) DESC''' % scope,
+        {'source_id': source_id, 'job_id': job_id}).fetchall()
+
+    encoded = 0
+    pending = 0
+    for digest, base_hash in candidates:
+        # A content may be a candidate against several next versions
+        if Session.execute('''SELECT base_hash FROM harvest_content_blob
+                              WHERE content_hash = :digest''',
+                           {'digest': digest}).scalar() is not None:
+            continue
+        base_chain = _get_delta_chain(base_hash)
+        if not base_chain or digest in base_chain:
+            continue
+        if len(base_chain) + _get_delta_depth(digest) > max_chain:
+            continue
+
+        blob = Session.execute('''SELECT data FROM harvest_content_blob
+                                  WHERE content_hash = :digest''',
+                               {'digest': digest}).scalar()
+        base = load_content(base_hash)
+        if blob is None or base is None:
+            continue
+        content = zlib.decompress(blob).decode('utf-8')
+        data = zlib.compress(make_delta(base, content),
+                             CONTENT_COMPRESSION_LEVEL)
+        if len(data) >= len(blob):
+            continue
+        table = harvest_content_blob_table
+        Session.execute(table.update()
+                        .where(table.c.content_hash == digest)
+                        .where(table.c.base_hash == None)
+                        .values(data=data, base_hash=base_hash))
+        encoded += 1
+        pending += 1
+        if pending >= batch_size:
+            Session.commit()
+            pending = 0
+    Session.commit()
+    log.info('Stored %i harvest object contents as deltas', encoded)
+    return encoded
+
+
+def archive_contents(archive, older_than, batch_size=500):
+    '''
+    Moves to the given archive the contents only referenced by non-current
+    harvest objects gathered before the ``older_than`` date, in batches of
+    ``batch_size`` contents. The contents are written (and synced) to the
+    archive before being removed from the database. Returns the number of
+    contents archived.
+    '''
+    table = harvest_content_blob_table
+    archived = 0
+    archive.lock()
+    try:
+        while True:
+            rows = Session.execute('''
+                SELECT b.content_hash, b.data FROM harvest_content_blob b
+                WHERE b.data IS NOT NULL
+                AND EXISTS (
+                    SELECT 1 FROM harvest_object o
+                    WHERE o.content_hash = b.content_hash)
+                AND NOT EXISTS (
+                    SELECT 1 FROM harvest_object o
+                    WHERE o.content_hash = b.content_hash
+                    AND (o.current = true OR o.gathered >= :older_than))
+                LIMIT :limit''',
+                {'older_than': older_than, 'limit': batch_size}).fetchall()
+            if not rows:
+                break
+            locations = archive.append([str(data) for digest, data in rows])
+            Session.execute(table.update()
+                            .where(table.c.content_hash == bindparam('b_digest'))
+                            .where(table.c.data != None)
+                            .values(data=None,
+                                    archive_segment=bindparam('b_segment'),
+                                    archive_offset=bindparam('b_offset'),
+                                    archive_length=bindparam('b_length')),
+                            [{'b_digest': digest, 'b_segment': segment,
+                              'b_offset': offset, 'b_length': length}
+                             for (digest, data), (segment, offset, length)
+                             in zip(rows, locations)])
+            Session.commit()
+            archived += len(rows)
+            log.info('Archived %i harvest object contents (%i so far)',
+                     len(rows), archived)
+            if len(rows) < batch_size:
+                break
+    finally:
+        archive.unlock()
+    return archived
+
+
+def purge_history(keep_jobs=1, older_than=None, batch_size=1000, pause=0):
+    '''
+    Deletes the old harvest jobs of each source, with their objects and
+    errors, except:
+
+    * the last ``keep_jobs`` jobs of each source (at least one),
+    * the jobs created after ``older_than``, if given,
+    * the jobs not finished yet,
+    * the current objects, and the jobs they belong to,
+    * the last object of each package left without a current object (eg
+      because its last import failed), and the job it belongs to, so the
+      package is not taken for an orphan.
+
+    Rows are deleted in chunks of ``batch_size``, each one committed on its
+    own and followed by a ``pause`` of the given seconds, so locks are held
+    briefly and other processes can keep working. Returns a dict with the
+    number of jobs and objects deleted.
+    '''
+    job_ids = [row[0] for row in Session.execute('''
+        SELECT id FROM (
+            SELECT id, status, created,
+                row_number() OVER (PARTITION BY source_id
+                                   ORDER BY created DESC) AS rank
+            FROM harvest_job) jobs
+        WHERE status = 'Finished'
+        AND rank > :keep_jobs
+        AND created < :older_than''', {
+            'keep_jobs': max(keep_jobs, 1),
+            'older_than': older_than or datetime.datetime.utcnow(),
+        })]
+    Session.commit()
+
+    deleted = {'jobs': 0, 'objects': 0}
+    for i in range(0, len(job_ids), batch_size):
+        params = {'job_ids': tuple(job_ids[i:i + batch_size]),
+                  'limit': batch_size}
+        while True:
+            object_ids = [row[0] for row in Session.execute('''
+                SELECT id FROM harvest_object
+                WHERE harvest_job_id IN :job_ids
+                AND current IS NOT TRUE
+                AND (package_id IS NULL OR EXISTS (
+                    SELECT 1 FROM harvest_object n
+                    WHERE n.package_id = harvest_object.package_id
+                    AND (n.current = true
+                         OR n.gathered > harvest_object.gathered
+                         OR (n.gathered = harvest_object.gathered
+                             AND n.id > harvest_object.id))))
+                LIMIT :limit''', params)]
+            if not object_ids:
+                break
+            object_params = {'object_ids': tuple(object_ids)}
+            Session.execute('''DELETE FROM harvest_object_error
+                               WHERE harvest_object_id IN :object_ids''',
+                            object_params)
+            Session.execute('''DELETE FROM harvest_object_extra
+                               WHERE harvest_object_id IN :object_ids''',
+                            object_params)
+            Session.execute('''DELETE FROM harvest_object
+                               WHERE id IN :object_ids
+                               AND current IS NOT TRUE''', object_params)
+            Session.commit()
+            deleted['objects'] += len(object_ids)
+            log.debug('Deleted %i old harvest objects', len(object_ids))
+            time.sleep(pause)
+
+        # Jobs with objects left are kept
+        Session.execute('''
+            DELETE FROM harvest_gather_error
+            WHERE harvest_job_id IN :job_ids
+            AND NOT EXISTS (
+                SELECT 1 FROM harvest_object o
+                WHERE o.harvest_job_id = harvest_gather_error.harvest_job_id)''',
+            params)
+        deleted['jobs'] += Session.execute('''
+            DELETE FROM harvest_job
+            WHERE id IN :job_ids
+            AND NOT EXISTS (
+                SELECT 1 FROM harvest_object o
+                WHERE o.harvest_job_id = harvest_job.id)''',
+            params).rowcount
+        Session.commit()
+        time.sleep(pause)
+
+    log.info('Deleted %(jobs)i old harvest jobs and %(objects)i objects',
+             deleted)
+    return deleted
+
+
+def collect_content_garbage(batch_size=1000, pause=0):
+    '''
+    Deletes the stored contents no longer referenced by any harvest object,
+    nor needed to rebuild other contents, in chunks of ``batch_size``
+    committed separately. Archived contents are removed from the database,
+    but the segment files are never rewritten. Returns the number of
+    contents deleted.
+    '''
+    deleted = 0
+    while True:
+        # Removing a delta may leave its base unused, so this is repeated
+        # until nothing is left to delete
+        count = Session.execute('''
+            DELETE FROM harvest_content_blob
+            WHERE content_hash IN (
+                SELECT b.content_hash FROM harvest_content_blob b
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM harvest_object o
+                    WHERE o.content_hash = b.content_hash)
+                AND NOT EXISTS (
+                    SELECT 1 FROM harvest_content_blob d
+                    WHERE d.base_hash = b.content_hash)
+                -- Skip the contents being stored again right now (see
+                -- store_content, which holds the same lock)
+                AND pg_try_advisory_xact_lock(
+                    ('x' || substr(b.content_hash, 1, 15))::bit(60)::bigint)
+                LIMIT :limit)''', {'limit': batch_size}).rowcount
+        Session.commit()
+        if not count:
+            break
+        deleted += count
+        log.debug('Deleted %i unused harvest object contents', count)
+        time.sleep(pause)
+    log.info('Deleted %i unused harvest object contents', deleted)
+    return deleted
+
+
+def get_harvest_indexes():
+    '''Returns the indexes defined on the harvest tables'''
+    indexes = []
+    for table in (harvest_source_table, harvest_job_table,
+                  harvest_object_table, harvest_object_extra_table,
+                  harvest_gather_error_table, harvest_object_error_table,
+                  harvest_content_blob_table):
+        indexes.extend(sorted(table.indexes, key=lambda index: index.name))
+    return indexes
+
+
+def get_missing_indexes(inspector):
+    '''Returns the harvest indexes that do not exist in the database'''
+    partitioned = get_partitioned_tables()
+    existing = set()
+    for table_name in set(index.table.name for index in get_harvest_indexes()):
+        if table_name in partitioned:
+            existing.update(_get_index_names(table_name))
+        else:
+            existing.update(index['name'] for index in
+                            inspector.get_indexes(table_name))
+    return [index for index in get_harvest_indexes()
+            if index.name not in existing]
+
+
+def migrate_indexes():
+    '''
+    Creates the harvest indexes that do not exist yet.
+
+    They are built with CREATE INDEX CONCURRENTLY, so the harvest tables can
+    still be written while it runs. Indexes left invalid by an interrupted
+    build are dropped and built again.
+    '''
+    from ckan.model.meta import engine
+    if harvest_source_table is None:
+        define_harvester_tables()
+
+    partitioned = get_partitioned_tables()
+    # CONCURRENTLY waits for the open transactions to finish
+    Session.commit()
+
+    # CONCURRENTLY can not be used inside a transaction
+    conn = engine.raw_connection()
+    try:
+        conn.connection.autocommit = True
+        cursor = conn.cursor()
+        for index in get_harvest_indexes():
+            cursor.execute('''
+                SELECT i.indisvalid FROM pg_class c
+                JOIN pg_index i ON i.indexrelid = c.oid
+                WHERE c.relname = %s''', (index.name,))
+            row = cursor.fetchone()
+            if row and row[0]:
+                continue
+            if row:
+                log.info('Dropping invalid index %s', index.name)
+                cursor.execute('DROP INDEX %s' % index.name)
+            log.info('Creating index %s. This may take a while...', index.name)
+            statement = unicode(CreateIndex(index).compile(dialect=engine.dialect))
+            if index.table.name in partitioned:
+                # Partitioned tables can only be indexed in the usual way,
+                # which blocks writes to the table meanwhile
+                cursor.execute(statement)
+            else:
+                cursor.execute(statement.replace(u'CREATE INDEX',
+                                                 u'CREATE INDEX CONCURRENTLY', 1))
+        cursor.close()
+    finally:
+        conn.connection.autocommit = False
+        conn.close()
+    log.info('Harvest indexes created')
+
+
+def get_partitioned_tables():
+    '''Returns the names of the harvest tables that are partitioned'''
+    return set(row[0] for row in Session.execute('''
+        SELECT relname FROM pg_class
+        WHERE relkind = 'p' AND relname IN :names
+        AND pg_table_is_visible(oid)''',
+        {'names': ('harvest_object', 'harvest_object_error')}))
+
+
+def migrate_partitions(partitions=DEFAULT_PARTITIONS):
+    '''
+    Partitions the biggest harvest tables, to keep their maintenance
+    (vacuum, index builds) and the queries on a source cheap:
+
+    * harvest_object, by the hash of harvest_source_id
+    * harvest_object_error, by the hash of harvest_object_id
+
+    Both are split in the given number of partitions. Tables already
+    partitioned are left as they are.
+
+    The rows are copied in a single transaction that locks the tables, so
+    the harvesters must be stopped while it runs. Partitioned tables can not
+    have a primary key on id alone, nor be referenced by foreign keys, so
+    id is made unique along with the partition key and the foreign keys to
+    harvest_object are dropped. Requires PostgreSQL 11 or later.
+    '''
+    if harvest_source_table is None:
+        define_harvester_tables()
+
+    conn = Session.connection()
+    version = int(conn.execute('SHOW server_version_num').scalar())
+    if version < 110000:
+        raise HarvestError('Partitioning the harvest tables requires '
+                           'PostgreSQL 11 or later')
+
+    partitioned = get_partitioned_tables()
+    for table, key, fillfactor in (
+            (harvest_object_table, 'harvest_source_id',
+             HARVEST_OBJECT_FILLFACTOR),
+            (harvest_object_error_table, 'harvest_object_id', None)):
+        if table.name in partitioned:
+            log.info('Table %s is already partitioned', table.name)
+            continue
+        _partition_table(conn, table, key, partitions, fillfactor)
+    Session.commit()
+    log.info('Harvest tables partitioned')
+
+
+def _partition_table(conn, table, key, partitions, fillfactor=None):
+    name = table.name
+    new_name = '%s_partitioned' % name
+    log.info('Partitioning table %s. This may take a while...', name)
+    conn.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % name)
+
+    # Foreign keys to the table can not be kept
+    for table_name, constraint in conn.execute('''
+            SELECT conrelid::regclass::text, conname FROM pg_constraint
+            WHERE confrelid = CAST(:name AS regclass) AND contype = 'f' ''',
+            {'name': name}).fetchall():
+        conn.execute('ALTER TABLE %s DROP CONSTRAINT %s'
+                     % (table_name, constraint))
+
+    conn.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) '
+                 'PARTITION BY HASH (%s)' % (new_name, name, key))
+    storage = ' WITH (fillfactor = %i)' % fillfactor if fillfactor else ''
+    for remainder in range(partitions):
+        conn.execute('CREATE TABLE %s_p%i PARTITION OF %s '
+                     'FOR VALUES WITH (MODULUS %i, REMAINDER %i)%s'
+                     % (name, remainder, new_name, partitions, remainder,
+                        storage))
+
+    # Keep the foreign keys from the table to the others
+    foreign_keys = conn.execute('''
+        SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = CAST(:name AS regclass) AND contype = 'f' ''',
+        {'name': name}).fetchall()
+
+    conn.execute('INSERT INTO %s SELECT * FROM %s' % (new_name, name))
+    conn.execute('DROP TABLE %s' % name)
+    conn.execute('ALTER TABLE %s RENAME TO %s' % (new_name, name))
+
+    for constraint, definition in foreign_keys:
+        conn.execute('ALTER TABLE %s ADD CONSTRAINT %s %s'
+                     % (name, constraint, definition))
+    conn.execute('CREATE UNIQUE INDEX %s_id_key ON %s (id, %s)'
+                 % (name, name, key))
+    for index in get_harvest_indexes():
+        if index.table is table:
+            conn.execute(CreateIndex(index))
+    conn.execute('ANALYZE %s' % name)
+
+
+def _get_column_names(table_name):
+    return [row[0] for row in Session.execute('''
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = :table_name
+        AND table_schema = current_schema()''', {'table_name': table_name})]
+
+
+def _get_index_names(table_name):
+    return [row[0] for row in Session.execute('''
+        SELECT i.relname FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        JOIN pg_class c ON c.oid = x.indrelid
+        WHERE c.relname = :table_name
+        AND pg_table_is_visible(c.oid)''', {'table_name': table_name})]
+
+
+def content_hash(content):
+    '''
+    Returns the digest used to detect whether the content of a harvest
+    object has changed between harvests.
+    '''
+    if content is None:
+        return None
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return unicode(hashlib.sha1(content).hexdigest())
+
+
+# Number of suffixed alternatives checked for each name when the name itself
+# is taken
+NAME_CANDIDATES = 3
+PACKAGE_NAME_MAX_LENGTH = 100
+
+
+def munge_package_name(title):
+    '''Returns a URL friendly dataset name from a title'''
+    name = munge_title_to_name(title).replace('_', '-')
+    while '--' in name:
+        name = name.replace('--', '-')
+    return name
+
+
+def allocate_package_names(titles):
+    '''
+    Returns a list with an unused dataset name for each of the given titles
+    (or names), in the same order.
+
+    The candidate names of the whole batch (the munged title, and a few
+    alternatives with a random suffix) are checked in a single statement,
+    which also reserves the free munged titles with a PostgreSQL advisory
+    lock on the current transaction. Other processes allocating names at the
+    same time skip them until the dataset has been created (ie the
+    transaction is committed). The suffixed alternatives are not locked, as
+    two processes are very unlikely to pick the same one.
+    '''
+    names = [None] * len(titles)
+    pending = range(len(titles))
+    while pending:
+        candidates = {}
+        for i in pending:
+            base_name = munge_package_name(titles[i])
+            short_name = base_name[:PACKAGE_NAME_MAX_LENGTH - 6]
+            candidates[i] = [base_name] + \
+                    ['%s-%s' % (short_name, str(uuid.uuid4())[:5])
+                     for j in range(NAME_CANDIDATES)]
+
+        base_names = sorted(set(candidates[i][0] for i in pending))
+        other_names = sorted(set(c for i in pending for c in candidates[i][1:])
+                             - set(base_names))
+        free = set(row[0] for row in Session.execute('''
+            SELECT c.name
+            FROM unnest(CAST(:names AS text[])) AS c(name)
+            WHERE CASE
+                WHEN EXISTS (SELECT 1 FROM package p WHERE p.name = c.name)
+                    THEN false
+                WHEN c.name = ANY(CAST(:base_names AS text[]))
+                    THEN pg_try_advisory_xact_lock(
+                        ('x' || substr(md5('package-name:' || c.name), 1, 15))
+                        ::bit(60)::bigint)
+                ELSE true
+            END''', {'names': base_names + other_names,
+                       'base_names': base_names}))
+
+        allocated = set(name for name in names if name)
+        for i in pending:
+            for candidate in candidates[i]:
+                if candidate in free and candidate not in allocated:
+                    names[i] = candidate
+                    allocated.add(candidate)
+                    break
+        pending = [i for i in pending if not names[i]]
+    return names
+
+
 class PackageIdHarvestSourceIdMismatch(Exception):
     """
     The package created for the harvest source must match the id of the
@@ -468,15 +1610,11 @@ def migrate_v3_create_datasets(source_ids=None):
                'extras_as_string': True,
               }
 
-    def gen_new_name(title):
-        name = munge_title_to_name(title).replace('_', '-')
-        while '--' in name:
-            name = name.replace('--', '-')
-        pkg_obj = Session.query(Package).filter(Package.name == name).first()
-        if pkg_obj:
-            return name + str(uuid.uuid4())[:5]
-        else:
-            return name
+    # Allocate the names of all the new datasets at once
+    titled_sources = [source for source in sources if source.title]
+    new_names = dict(zip([source.id for source in titled_sources],
+                         allocate_package_names([source.title
+                                                 for source in titled_sources])))
 
     for source in sources:
         if 'id' in context:
@@ -496,7 +1634,7 @@ def migrate_v3_create_datasets(source_ids=None):
 
         package_dict = {
             'id': source.id,
-            'name': gen_new_name(source.title) if source.title else source.id,
+            'name': new_names.get(source.id, source.id),
             'title': source.title if source.title else source.url,
             'notes': source.description,
             'url': source.url,
@@ -13,6 +13,7 @@ from ckanext.harvest.logic.action.get import harvest_source_show_status
 
 from ckanext.harvest.model import setup as model_setup
 from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject
+from ckanext.harvest.harvesters.base import clear_import_context
 
 
 log = getLogger(__name__)
@@ -45,6 +46,8 @@ class Harvest(p.SingletonPlugin, DefaultDatasetForm):
         if 'type' in data_dict and data_dict['type'] == DATASET_TYPE_NAME:
             # Edit the actual HarvestSource object
             _update_harvest_source_object(context, data_dict)
+            # Make the harvesters in this process pick up the changes
+            clear_import_context(data_dict.get('id'))
 
     def after_delete(self, context, data_dict):
 
@@ -86,7 +89,13 @@ class Harvest(p.SingletonPlugin, DefaultDatasetForm):
                 log.error('Harvest source not found for dataset {0}'.format(data_dict['id']))
                 return data_dict
 
-            data_dict['status'] = harvest_source_show_status(context, {'id': source.id})
+            # The status may have been computed in advance for several
+            # sources at once, eg when reindexing them
+            precomputed_status = context.get('harvest_sources_status') or {}
+            if source.id in precomputed_status:
+                data_dict['status'] = precomputed_status[source.id]
+            else:
+                data_dict['status'] = harvest_source_show_status(context, {'id': source.id})
 
         elif not 'type' in data_dict or data_dict['type'] != DATASET_TYPE_NAME:
             # This is a normal dataset, check if it was harvested and if so, add
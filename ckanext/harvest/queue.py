@@ -1,15 +1,31 @@
 import logging
 import datetime
-import json
+import time
+import threading
+from contextlib import contextmanager
 
 import pika
 
 from ckan.lib.base import config
 from ckan.plugins import PluginImplementations
 from ckan import model
-
-from ckanext.harvest.model import HarvestJob, HarvestObject,HarvestGatherError
+from ckan.model.types import make_uuid
+from ckan.logic import get_action, NotFound
+from ckan.lib.search import index as search_index
+from ckan.lib.search.index import PackageSearchIndex
+from ckan.lib.search.common import SearchIndexError, make_connection
+from paste.deploy.converters import asbool
+
+from sqlalchemy.exc import IntegrityError
+
+from ckanext.harvest import codec
+from ckanext.harvest.model import HarvestJob, HarvestObject,HarvestGatherError, \
+                                  HarvestGuidFingerprint, HarvestRemoteHost
 from ckanext.harvest.interfaces import IHarvester
+from ckanext.harvest.hosts import acquire_host_slot, HostBusy, \
+                                  check_host_circuit, record_fetch_result, \
+                                  HostUnavailable, get_host, CIRCUIT_CLOSED, \
+                                  is_host_error
 
 log = logging.getLogger(__name__)
 assert not log.disabled
@@ -30,6 +46,27 @@ REDIS_DB = 0
 EXCHANGE_TYPE = 'direct'
 EXCHANGE_NAME = 'ckan.harvest'
 
+# Delays (in seconds) after which an object whose remote host is busy is put
+# back on the fetch queue. The delay doubles each time the same object finds
+# its host busy, up to the last one.
+HOST_BUSY_DELAYS = tuple(0.1 * 2 ** n for n in range(9))
+
+# Maximum time (in seconds) a Redis consumer waits for a message before moving
+# the delayed messages that are due back to its queue
+DELAYED_POLL_INTERVAL = 1
+
+# Default number of datasets indexed per Solr commit, and maximum time (in
+# seconds) the index consumer waits to fill a batch
+DEFAULT_INDEX_BATCH_SIZE = 100
+DEFAULT_INDEX_WINDOW = 5
+
+# Default time (in seconds) an object can stay parked while its remote host is
+# unavailable before giving up on it
+DEFAULT_PARK_TIMEOUT = 86400
+
+# Number of parked objects resubmitted at once
+RESUBMIT_BATCH_SIZE = 1000
+
 def get_connection():
     backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
     if backend in ('amqp', 'ampq'):  # "ampq" is for compat with old typo
@@ -76,6 +113,36 @@ def get_fetch_queue_name():
                                                       'default'))
 
 
+def get_index_queue_name():
+    return 'ckan.harvest.{0}.index'.format(config.get('ckan.site_id',
+                                                      'default'))
+
+
+def get_fetch_delay_queue_name(delay):
+    return 'ckan.harvest.{0}.fetch.delay.{1}'.format(
+        config.get('ckan.site_id', 'default'), int(round(delay * 1000)))
+
+
+_declared_delay_queues = set()
+
+def declare_fetch_delay_queue(channel, delay):
+    '''
+    Declares the AMQP queue where the fetch messages delayed by the given
+    number of seconds wait. Messages expire after the delay and are then
+    dead lettered back to the fetch queue. There is a queue per delay, as
+    messages only expire once they reach the head of their queue.
+    '''
+    queue_name = get_fetch_delay_queue_name(delay)
+    if queue_name not in _declared_delay_queues:
+        channel.queue_declare(queue=queue_name, durable=True, arguments={
+            'x-message-ttl': int(round(delay * 1000)),
+            'x-dead-letter-exchange': EXCHANGE_NAME,
+            'x-dead-letter-routing-key': 'harvest_object_id',
+        })
+        _declared_delay_queues.add(queue_name)
+    return queue_name
+
+
 def purge_queues():
 
     backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
@@ -84,6 +151,8 @@ def purge_queues():
         channel = connection.channel()
         channel.queue_purge(queue=get_gather_queue_name())
         channel.queue_purge(queue=get_fetch_queue_name())
+        for delay in HOST_BUSY_DELAYS:
+            channel.queue_purge(queue=declare_fetch_delay_queue(channel, delay))
         return
     if backend == 'redis':
         connection.flushall()
@@ -98,7 +167,7 @@ def resubmit_jobs():
                                                  "%Y-%m-%d %H:%M:%S.%f")
         if (datetime.datetime.now() - date_of_key).seconds > 180: # 3 minuites for fetch and import max
             redis.rpush('harvest_object_id',
-                json.dumps({'harvest_object_id': key.split(':')[-1]})
+                codec.dumps({'harvest_object_id': key.split(':')[-1]})
             )
             redis.delete(key)
 
@@ -108,7 +177,7 @@ def resubmit_jobs():
                                                  "%Y-%m-%d %H:%M:%S.%f")
         if (datetime.datetime.now() - date_of_key).seconds > 7200: # 3 hours for a gather
             redis.rpush('harvest_job_id',
-                json.dumps({'harvest_job_id': key.split(':')[-1]})
+                codec.dumps({'harvest_job_id': key.split(':')[-1]})
             )
             redis.delete(key)
 
@@ -121,7 +190,7 @@ class Publisher(object):
     def send(self, body, **kw):
         return self.channel.basic_publish(self.exchange,
                                           self.routing_key,
-                                          json.dumps(body),
+                                          codec.dumps(body),
                                           properties=pika.BasicProperties(
                                              delivery_mode = 2, # make message persistent
                                           ),
@@ -134,7 +203,7 @@ class RedisPublisher(object):
         self.redis = redis ## not used
         self.routing_key = routing_key
     def send(self, body, **kw):
-        value = json.dumps(body)
+        value = codec.dumps(body)
         # remove if already there
         if self.routing_key == 'harvest_job_id':
             self.redis.lrem(self.routing_key, 0, value)
@@ -149,6 +218,12 @@ def get_publisher(routing_key):
     if backend in ('amqp', 'ampq'):
         channel = connection.channel()
         channel.exchange_declare(exchange=EXCHANGE_NAME, durable=True)
+        if routing_key == 'package_id':
+            # The datasets sent before the index consumer is first started
+            # would be lost otherwise
+            channel.queue_declare(queue=get_index_queue_name(), durable=True)
+            channel.queue_bind(queue=get_index_queue_name(),
+                               exchange=EXCHANGE_NAME, routing_key=routing_key)
         return Publisher(connection,
                          channel,
                          EXCHANGE_NAME,
@@ -166,15 +241,28 @@ class RedisConsumer(object):
     def __init__(self, redis, routing_key):
         self.redis = redis
         self.routing_key = routing_key
+        # Sorted set of the delayed messages, scored by the time they are due
+        self.delayed_key = 'delayed:' + routing_key
     def consume(self, queue):
         while True:
-            key, body = self.redis.blpop(self.routing_key)
+            self.move_due_messages()
+            item = self.redis.blpop(self.routing_key,
+                                    timeout=DELAYED_POLL_INTERVAL)
+            if item is None:
+                continue
+            key, body = item
             self.redis.set(self.persistance_key(body),
                            str(datetime.datetime.now()))
             yield (FakeMethod(body), self, body)
     def persistance_key(self, message):
-        message = json.loads(message)
-        return self.routing_key + ':' + str(message[self.routing_key])
+        return self.routing_key + ':' + \
+                str(codec.loads(message)[self.routing_key])
+    def move_due_messages(self):
+        '''Puts the delayed messages that are due back on the queue'''
+        for body in self.redis.zrangebyscore(self.delayed_key, 0, time.time()):
+            # Only the consumer that removes the message puts it back
+            if self.redis.zrem(self.delayed_key, body):
+                self.redis.rpush(self.routing_key, body)
     def basic_ack(self, message):
         self.redis.delete(self.persistance_key(message))
     def queue_purge(self, queue):
@@ -200,7 +288,7 @@ def get_consumer(queue_name, routing_key):
 
 def gather_callback(channel, method, header, body):
     try:
-        id = json.loads(body)['harvest_job_id']
+        id = codec.loads(body)['harvest_job_id']
         log.debug('Received harvest job id: %s' % id)
     except KeyError:
         log.error('No harvest job id received')
@@ -274,7 +362,8 @@ def gather_callback(channel, method, header, body):
 
 def fetch_callback(channel, method, header, body):
     try:
-        id = json.loads(body)['harvest_object_id']
+        message = codec.loads(body)
+        id = message['harvest_object_id']
         log.info('Received harvest object id: %s' % id)
     except KeyError:
         log.error('No harvest object id received')
@@ -288,31 +377,205 @@ def fetch_callback(channel, method, header, body):
         channel.basic_ack(method.delivery_tag)
         return False
 
-    obj.retry_times += 1
-    obj.save()
-
-    if obj.retry_times >= 5:
-        obj.state = "ERROR"
+    # If the circuit of the remote host is open, park the object until the
+    # host is probed successfully rather than sending it a request
+    try:
+        check_host_circuit(obj)
+    except HostUnavailable, e:
+        log.info('%s, parking harvest object %s', e, id)
+        obj.state = "PARKED"
         obj.save()
-        log.error('Too many consecutive retries for object {0}'.format(obj.id))
+        model.Session.remove()
         channel.basic_ack(method.delivery_tag)
         return False
 
-    # Send the harvest object to the plugins that implement
-    # the Harvester interface, only if the source type
-    # matches
-    for harvester in PluginImplementations(IHarvester):
-        if harvester.info()['name'] == obj.source.type:
-            fetch_and_import_stages(harvester, obj)
+    # Check the limits of the remote host before counting this as a retry.
+    # If the host is busy, the object goes back to the queue after a delay
+    # and the consumer moves on to the next one.
+    try:
+        lease = acquire_host_slot(obj)
+    except HostBusy, e:
+        busy_retries = message.get('busy_retries', 0)
+        delay = get_busy_delay(e.wait, busy_retries)
+        log.debug('%s, sending harvest object %s back to the queue in %.1fs',
+                  e, id, delay)
+        model.Session.remove()
+        message['busy_retries'] = busy_retries + 1
+        requeue(channel, codec.dumps(message), delay)
+        channel.basic_ack(method.delivery_tag)
+        return False
+
+    try:
+        obj.retry_times += 1
+        obj.save()
+
+        if obj.retry_times >= 5:
+            obj.state = "ERROR"
+            obj.save()
+            log.error('Too many consecutive retries for object {0}'.format(obj.id))
+            channel.basic_ack(method.delivery_tag)
+            return False
+
+        # Send the harvest object to the plugins that implement
+        # the Harvester interface, only if the source type
+        # matches
+        for harvester in PluginImplementations(IHarvester):
+            if harvester.info()['name'] == obj.source.type:
+                fetch_and_import_stages(harvester, obj, lease)
+    finally:
+        lease.release()
 
     model.Session.remove()
     channel.basic_ack(method.delivery_tag)
 
-def fetch_and_import_stages(harvester, obj):
+def get_busy_delay(wait, busy_retries):
+    '''
+    Returns the delay (one of HOST_BUSY_DELAYS) before fetching again an
+    object whose remote host is busy, given the estimated wait until the host
+    has capacity and the number of times the object already found it busy.
+    '''
+    delay = max(wait, HOST_BUSY_DELAYS[0] * 2 ** busy_retries)
+    for busy_delay in HOST_BUSY_DELAYS:
+        if busy_delay >= delay:
+            return busy_delay
+    return HOST_BUSY_DELAYS[-1]
+
+def requeue(channel, body, delay=0):
+    '''Puts a message back at the end of the fetch queue, once the given delay
+    (in seconds, one of HOST_BUSY_DELAYS) has passed'''
+    if isinstance(channel, RedisConsumer):
+        if delay:
+            channel.redis.zadd(channel.delayed_key, time.time() + delay, body)
+        else:
+            channel.redis.rpush(channel.routing_key, body)
+        return
+    if delay:
+        exchange = ''
+        routing_key = declare_fetch_delay_queue(channel, delay)
+    else:
+        exchange = EXCHANGE_NAME
+        routing_key = 'harvest_object_id'
+    channel.basic_publish(exchange,
+                          routing_key,
+                          body,
+                          properties=pika.BasicProperties(
+                             delivery_mode = 2, # make message persistent
+                          ))
+
+def resubmit_parked_objects(host=None):
+    '''
+    Sends back to the fetch queue the objects parked while their remote host
+    was unavailable.
+
+    All the parked objects of a host are resubmitted once its circuit is
+    closed again. While it is still open, a single object is resubmitted
+    when the next probe is due, so the host gets probed even if no new
+    objects are being fetched from it. Objects parked for longer than
+    ``ckanext.harvest.host_park_timeout`` seconds are flagged as errors.
+
+    Only the ids of the objects are read, in batches of
+    ``RESUBMIT_BATCH_SIZE`` per host.
+    '''
+    source_ids_by_host = {}
+    for source_id, url in model.Session.execute('''
+            SELECT id, url FROM harvest_source
+            WHERE id IN (SELECT DISTINCT harvest_source_id
+                         FROM harvest_object WHERE state = 'PARKED')'''):
+        source_host = get_host(url)
+        if host is None or source_host == host:
+            source_ids_by_host.setdefault(source_host, []).append(source_id)
+    if not source_ids_by_host:
+        return 0
+
+    park_timeout = int(config.get('ckanext.harvest.host_park_timeout',
+                                  DEFAULT_PARK_TIMEOUT))
+    expiry = datetime.datetime.utcnow() - \
+            datetime.timedelta(seconds=park_timeout)
+    now = datetime.datetime.utcnow()
+
+    resubmitted = 0
+    publisher = None
+    for source_host, source_ids in source_ids_by_host.iteritems():
+        params = {'source_ids': tuple(source_ids), 'expiry': expiry,
+                  'limit': RESUBMIT_BATCH_SIZE}
+        expired = [row[0] for row in model.Session.execute('''
+            UPDATE harvest_object
+            SET state = 'ERROR', report_status = 'errored'
+            WHERE state = 'PARKED'
+            AND harvest_source_id IN :source_ids
+            AND gathered < :expiry
+            RETURNING id''', params)]
+        if expired:
+            message = u'Remote host %s was unavailable for too long' % source_host
+            model.Session.execute('''
+                INSERT INTO harvest_object_error
+                (id, harvest_object_id, message, stage, created)
+                VALUES (:id, :harvest_object_id, :message, :stage, :created)''',
+                [{'id': make_uuid(), 'harvest_object_id': object_id,
+                  'message': message, 'stage': u'Fetch', 'created': now}
+                 for object_id in expired])
+            log.info('Flagged %i objects parked for remote host %s as errors',
+                     len(expired), source_host)
+        model.Session.commit()
+
+        remote_host = model.Session.query(HarvestRemoteHost) \
+                .filter_by(host=source_host).first()
+        if not remote_host or remote_host.state in (None, CIRCUIT_CLOSED):
+            limit = RESUBMIT_BATCH_SIZE
+        elif remote_host.next_probe and remote_host.next_probe <= now:
+            # Only one object to probe the host
+            limit = 1
+        else:
+            continue
+        params['limit'] = limit
+
+        while True:
+            object_ids = [row[0] for row in model.Session.execute('''
+                UPDATE harvest_object SET state = 'WAITING'
+                WHERE id IN (
+                    SELECT id FROM harvest_object
+                    WHERE state = 'PARKED'
+                    AND harvest_source_id IN :source_ids
+                    ORDER BY gathered
+                    LIMIT :limit)
+                AND state = 'PARKED'
+                RETURNING id''', params)]
+            model.Session.commit()
+            if not object_ids:
+                break
+            if publisher is None:
+                publisher = get_fetch_publisher()
+            for object_id in object_ids:
+                publisher.send({'harvest_object_id': object_id})
+            resubmitted += len(object_ids)
+            if limit == 1:
+                break
+
+    if publisher is not None:
+        publisher.close()
+    if resubmitted:
+        log.info('Resubmitted %i parked harvest objects', resubmitted)
+    return resubmitted
+
+def fetch_and_import_stages(harvester, obj, lease=None):
     obj.fetch_started = datetime.datetime.utcnow()
     obj.state = "FETCH"
     obj.save()
-    success_fetch = harvester.fetch_stage(obj)
+    success_fetch = False
+    # Only the failures caused by the remote host count towards opening its
+    # circuit, either raised or reported by the harvester
+    obj.host_failure = False
+    try:
+        success_fetch = harvester.fetch_stage(obj)
+    except Exception, e:
+        obj.host_failure = is_host_error(e)
+        raise
+    finally:
+        # Free the slot on the remote host as soon as the content is fetched
+        if lease:
+            lease.release()
+        if record_fetch_result(obj, not obj.host_failure):
+            resubmit_parked_objects(get_host(obj.source.url))
     obj.fetch_finished = datetime.datetime.utcnow()
     obj.save()
     if success_fetch:
@@ -330,20 +593,65 @@ def fetch_and_import_stages(harvester, obj):
     else:
         obj.state = "ERROR"
         obj.save()
-    if obj.report_status:
+    if not obj.report_status:
+        if obj.state == 'ERROR':
+            obj.report_status = 'errored'
+        elif obj.current == False:
+            obj.report_status = 'deleted'
+        elif len(model.Session.query(HarvestObject)
+               .filter_by(package_id = obj.package_id)
+               .limit(2)
+               .all()) == 2:
+            obj.report_status = 'updated'
+        else:
+            obj.report_status = 'added'
+        obj.save()
+    update_guid_fingerprint(obj)
+    if obj.package_id and obj.report_status != 'unchanged':
+        # Even if the import failed, the dataset may have been changed
+        queue_package_index(obj.package_id)
+
+def update_guid_fingerprint(obj):
+    '''
+    Updates the guid index of the object's source with the outcome of its
+    import stage, so the next gather stage can tell which guids are new,
+    changed or deleted.
+    '''
+    if obj.state != 'COMPLETE' or not obj.guid:
         return
-    if obj.state == 'ERROR':
-        obj.report_status = 'errored'
-    elif obj.current == False:
-        obj.report_status = 'deleted'
-    elif len(model.Session.query(HarvestObject)
-           .filter_by(package_id = obj.package_id)
-           .limit(2)
-           .all()) == 2:
-        obj.report_status = 'updated'
-    else:
-        obj.report_status = 'added'
-    obj.save()
+
+    fingerprint = model.Session.query(HarvestGuidFingerprint) \
+            .filter_by(harvest_source_id=obj.harvest_source_id,
+                       guid=obj.guid) \
+            .first()
+
+    if obj.report_status == 'unchanged':
+        # The previous object is still the current one
+        if fingerprint and obj.metadata_modified_date:
+            fingerprint.metadata_modified_date = obj.metadata_modified_date
+            fingerprint.save()
+        return
+
+    if not obj.current or not obj.package_id:
+        if fingerprint:
+            fingerprint.delete()
+            fingerprint.commit()
+        return
+
+    if not fingerprint:
+        fingerprint = HarvestGuidFingerprint(
+                harvest_source_id=obj.harvest_source_id, guid=obj.guid)
+    fingerprint.metadata_modified_date = obj.metadata_modified_date
+    fingerprint.content_hash = obj.content_hash
+    fingerprint.harvest_object_id = obj.id
+    fingerprint.package_id = obj.package_id
+    try:
+        fingerprint.save()
+    except IntegrityError:
+        # Another worker indexed the same guid in the meantime
+        model.Session.rollback()
+        log.debug('Guid %s already indexed for source %s', obj.guid,
+                  obj.harvest_source_id)
 
 def get_gather_consumer():
     consumer = get_consumer(get_gather_queue_name(), 'harvest_job_id')
@@ -355,12 +663,187 @@ def get_fetch_consumer():
     log.debug('Fetch queue consumer registered')
     return consumer
 
+def get_index_consumer():
+    consumer = get_consumer(get_index_queue_name(), 'package_id')
+    log.debug('Index queue consumer registered')
+    return consumer
+
 def get_gather_publisher():
     return get_publisher('harvest_job_id')
 
 def get_fetch_publisher():
     return get_publisher('harvest_object_id')
 
+_index_publisher = None
+
+def get_index_publisher():
+    # Kept open, as the fetch consumers send a message per imported object
+    global _index_publisher
+    if _index_publisher is None:
+        _index_publisher = get_publisher('package_id')
+    return _index_publisher
+
+def async_indexing_enabled():
+    return asbool(config.get('ckanext.harvest.async_indexing', False))
+
+def queue_package_index(package_id):
+    '''
+    Sends a dataset created, updated or deleted by a harvester to the index
+    queue, if async indexing is enabled, as it was not indexed when saved.
+    '''
+    if async_indexing_enabled():
+        get_index_publisher().send({'package_id': package_id})
+
+class _IndexBatch(object):
+    '''
+    Stands for the Solr connection of PackageSearchIndex.index_package
+    within batched_index_adds: the documents are kept, to be sent at once.
+    '''
+    url = None
+
+    def __init__(self):
+        self.docs = []
+
+    def add_many(self, docs, _commit=False):
+        # solrpy, up to CKAN 2.4
+        self.docs.extend(docs)
+
+    def add(self, docs, commit=False, **kwargs):
+        # pysolr, since CKAN 2.5
+        self.docs.extend(docs)
+
+    def close(self):
+        pass
+
+_index_batches = threading.local()
+
+def _make_index_connection(*args, **kwargs):
+    batch = getattr(_index_batches, 'batch', None)
+    if batch is not None:
+        return batch
+    return make_connection(*args, **kwargs)
+
+@contextmanager
+def batched_index_adds():
+    '''
+    Sends the documents built by PackageSearchIndex.index_package in the
+    current thread within the block to Solr in a single add request when it
+    ends, instead of one request per dataset. Nothing is committed. Only
+    active datasets must be indexed within the block, as deleting needs a
+    real connection.
+    '''
+    # The connection used by index_package is only replaced for the threads
+    # batching their documents
+    if search_index.make_connection is not _make_index_connection:
+        search_index.make_connection = _make_index_connection
+    batch = _IndexBatch()
+    _index_batches.batch = batch
+    try:
+        yield
+    finally:
+        _index_batches.batch = None
+    if batch.docs:
+        _send_index_documents(batch.docs)
+
+def _send_index_documents(docs):
+    conn = make_connection()
+    try:
+        if hasattr(conn, 'add_many'):
+            conn.add_many(docs, _commit=False)
+        else:
+            conn.add(docs=docs, commit=False)
+    except Exception, e:
+        raise SearchIndexError('Could not index %i datasets: %s'
+                               % (len(docs), e))
+    finally:
+        conn.close()
+
+def index_packages(package_ids):
+    '''
+    Updates the search index of the given datasets, sending them to Solr in
+    a single request and committing only once at the end. Datasets that no
+    longer exist or are not active are removed from the index.
+    '''
+    package_index = PackageSearchIndex()
+    context = {'model': model, 'ignore_auth': True, 'validate': False,
+               'use_cache': False}
+    package_ids = set(package_ids)
+    deleted_ids = []
+    with batched_index_adds():
+        for package_id in package_ids:
+            try:
+                package_dict = get_action('package_show')(context.copy(),
+                                                          {'id': package_id})
+            except NotFound:
+                package_dict = None
+            if package_dict and package_dict.get('state') == 'active':
+                package_index.index_package(package_dict, defer_commit=True)
+            else:
+                deleted_ids.append(package_id)
+    for package_id in deleted_ids:
+        package_index.delete_package({'id': package_id})
+    package_index.commit()
+    log.info('Indexed %i datasets', len(package_ids))
+    return len(package_ids)
+
+def _get_index_batch(consumer, batch_size, window=None):
+    '''Gets up to batch_size messages from the index queue, waiting up to
+    window seconds for them (or not waiting at all if window is None)'''
+    batch = []
+    deadline = time.time() + (window or 0)
+    while len(batch) < batch_size:
+        method, header, body = consumer.basic_get(queue=get_index_queue_name())
+        if body:
+            batch.append((method, body))
+        elif window is None or time.time() >= deadline:
+            break
+        else:
+            time.sleep(0.5)
+    return batch
+
+def _index_batch(consumer, batch):
+    package_ids = []
+    for method, body in batch:
+        try:
+            package_ids.append(codec.loads(body)['package_id'])
+        except (ValueError, KeyError):
+            log.error('Invalid message in the index queue: %r', body)
+    if package_ids:
+        index_packages(package_ids)
+    for method, body in batch:
+        consumer.basic_ack(method.delivery_tag)
+
+def consume_index_queue(consumer):
+    '''
+    Indexes the datasets sent to the index queue, in batches of
+    ``ckanext.harvest.index_batch_size`` datasets or of the datasets received
+    in ``ckanext.harvest.index_window`` seconds, whatever comes first.
+    '''
+    batch_size = int(config.get('ckanext.harvest.index_batch_size',
+                                DEFAULT_INDEX_BATCH_SIZE))
+    window = float(config.get('ckanext.harvest.index_window',
+                              DEFAULT_INDEX_WINDOW))
+    while True:
+        batch = _get_index_batch(consumer, batch_size, window)
+        if batch:
+            _index_batch(consumer, batch)
+            model.Session.remove()
+
+def flush_index_queue():
+    '''Indexes all the datasets waiting in the index queue right away.
+    Returns the number of messages processed.'''
+    batch_size = int(config.get('ckanext.harvest.index_batch_size',
+                                DEFAULT_INDEX_BATCH_SIZE))
+    consumer = get_index_consumer()
+    count = 0
+    while True:
+        batch = _get_index_batch(consumer, batch_size)
+        if not batch:
+            break
+        _index_batch(consumer, batch)
+        count += len(batch)
+    return count
+
 # Get a publisher for the fetch queue
 #fetch_publisher = get_fetch_publisher()
 
@@ -1,5 +1,6 @@
 import json
 import copy
+import datetime
 import ckan
 import paste
 import pylons.test
@@ -272,6 +273,29 @@ class TestHarvestSourceActionUpdate(HarvestSourceActionBase):
         assert source.url == source_dict['url']
         assert source.type == source_dict['source_type']
 
+    def test_reindex_sources_in_one_request(self):
+        from ckanext.harvest import queue
+
+        source = harvest_model.HarvestSource.get(
+            self.default_source_dict['id'])
+        RecordingSolrConnection.requests = []
+
+        make_connection = queue.make_connection
+        queue.make_connection = RecordingSolrConnection
+        try:
+            context = {'model': ckan.model, 'session': ckan.model.Session,
+                       'ignore_auth': True}
+            count = toolkit.get_action('harvest_sources_reindex')(context, {})
+        finally:
+            queue.make_connection = make_connection
+
+        assert count == 1
+        requests = RecordingSolrConnection.requests
+        assert len(requests) == 1, requests
+        assert [doc['id'] for doc in requests[0]] == [source.id]
+        # The session of the caller is kept
+        assert source in ckan.model.Session
+
 class TestHarvestObject(unittest.TestCase):
     @classmethod
     def setup_class(cls):
@@ -302,6 +326,18 @@ class TestHarvestObject(unittest.TestCase):
         # fetch the object from database to check it was created
         created_object = harvest_model.HarvestObject.get(harvest_object['id'])
         assert created_object.guid == harvest_object['guid'] == data_dict['guid']
+        assert created_object.content == harvest_object['content'] == data_dict['content']
+
+        # The content is stored once, compressed
+        blob = harvest_model.HarvestContentBlob.get(created_object.content_hash)
+        assert blob.size == len(data_dict['content'])
+        data_dict['guid'] = 'guid-2'
+        other_object = toolkit.get_action('harvest_object_create')(
+            context, data_dict)
+        other_object = harvest_model.HarvestObject.get(other_object['id'])
+        assert other_object.content_hash == created_object.content_hash
+        assert ckan.model.Session.query(harvest_model.HarvestContentBlob) \
+            .filter_by(content_hash=created_object.content_hash).count() == 1
 
     def test_create_bad_parameters(self):
         source_a = factories.HarvestSourceFactory()
@@ -327,3 +363,416 @@ class TestHarvestObject(unittest.TestCase):
 
         self.assertRaises(ckan.logic.ValidationError, harvest_object_create,
             context, data_dict)
+
+
+class TestSourcesStatus(unittest.TestCase):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        ckan.model.repo.rebuild_db()
+
+    def test_same_as_source_status(self):
+        from ckanext.harvest.logic.action.get import _get_sources_status
+
+        job_a1 = factories.HarvestJobFactory()
+        job_a1.save()
+        source_a = job_a1.source
+        job_a2 = factories.HarvestJobFactory(source=source_a)
+        job_a2.save()
+        obj = harvest_model.HarvestObject(guid='a', job=job_a2, source=source_a,
+                                          report_status='added')
+        obj.save()
+        harvest_model.HarvestObjectError(message='Error a', object=obj).save()
+        harvest_model.HarvestGatherError(message='Error b', job=job_a2).save()
+        source_b = factories.HarvestSourceFactory()
+        source_b.save()
+
+        context = {
+            'model' : ckan.model,
+            'session': ckan.model.Session,
+            'ignore_auth': True,
+        }
+        status = _get_sources_status(context, [source_a.id, source_b.id])
+
+        for source in (source_a, source_b):
+            expected = toolkit.get_action('harvest_source_show_status')(
+                context, {'id': source.id})
+            assert json.dumps(status[source.id], sort_keys=True, default=str) == \
+                json.dumps(expected, sort_keys=True, default=str), \
+                (status[source.id], expected)
+        assert status[source_a.id]['last_job']['id'] == job_a2.id
+        assert status[source_a.id]['last_job']['stats'] == \
+            {'added': 1, 'errored': 2}
+
+
+class TestRelinkJobPackages(unittest.TestCase):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        ckan.model.repo.rebuild_db()
+
+    def test_relink_last_complete_object(self):
+        from ckanext.harvest.logic.action.update import _relink_job_packages
+
+        ckan.model.repo.new_revision()
+        package = ckan.model.Package(name='relinked-package')
+        ckan.model.Session.add(package)
+        ckan.model.repo.commit_and_remove()
+        package = ckan.model.Package.get('relinked-package')
+
+        old_job = factories.HarvestJobFactory()
+        old_job.save()
+        source = old_job.source
+        job = factories.HarvestJobFactory(source=source)
+        job.save()
+        now = datetime.datetime.utcnow()
+        objects = {}
+        for guid, obj_job, state, finished in (
+                ('older', old_job, u'COMPLETE', now - datetime.timedelta(days=2)),
+                ('old', old_job, u'COMPLETE', now - datetime.timedelta(days=1)),
+                ('failed', job, u'ERROR', now)):
+            obj = harvest_model.HarvestObject(guid=guid, job=obj_job,
+                                              source=source, state=state,
+                                              package_id=package.id,
+                                              import_finished=finished,
+                                              current=False)
+            obj.save()
+            objects[guid] = obj.id
+
+        relinked = _relink_job_packages(ckan.model.Session, job.id)
+        ckan.model.Session.commit()
+
+        assert relinked == [package.id]
+        current = ckan.model.Session.query(harvest_model.HarvestObject.id) \
+            .filter_by(package_id=package.id, current=True).all()
+        assert [row[0] for row in current] == [objects['old']]
+
+        # Packages with a current object are left alone
+        assert _relink_job_packages(ckan.model.Session, job.id) == []
+
+
+class TestSourceClear(unittest.TestCase):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        ckan.model.repo.rebuild_db()
+
+    def test_clear_in_chunks(self):
+        from ckanext.harvest.logic.action.update import (_start_clear,
+                                                         _clear_source)
+
+        job = factories.HarvestJobFactory()
+        job.save()
+        source_id, job_id = job.source.id, job.id
+        ckan.model.repo.new_revision()
+        for name in ('cleared-a', 'cleared-b', 'cleared-c'):
+            ckan.model.Session.add(ckan.model.Package(name=name))
+        ckan.model.repo.commit_and_remove()
+        for name in ('cleared-a', 'cleared-b', 'cleared-c'):
+            obj = harvest_model.HarvestObject(
+                guid=name, job=harvest_model.HarvestJob.get(job_id),
+                source=harvest_model.HarvestSource.get(source_id),
+                package_id=ckan.model.Package.get(name).id)
+            obj.save()
+            harvest_model.HarvestObjectError(message='Error', object=obj).save()
+        harvest_model.HarvestObject(
+            guid='no-dataset', job=harvest_model.HarvestJob.get(job_id),
+            source=harvest_model.HarvestSource.get(source_id)).save()
+        harvest_model.HarvestGuidFingerprint(harvest_source_id=source_id,
+                                             guid=u'cleared-a').save()
+
+        _start_clear(ckan.model.Session, source_id)
+        _clear_source(ckan.model.Session, source_id, 2)
+        ckan.model.Session.remove()
+
+        for name in ('cleared-a', 'cleared-b', 'cleared-c'):
+            assert not ckan.model.Package.get(name)
+        assert not harvest_model.HarvestObject.filter(
+            harvest_source_id=source_id).count()
+        assert not harvest_model.HarvestJob.get(job_id)
+        assert not ckan.model.Session.query(
+            harvest_model.HarvestGuidFingerprint) \
+            .filter_by(harvest_source_id=source_id).count()
+        assert harvest_model.HarvestSource.get(source_id)
+
+        context = {
+            'model': ckan.model,
+            'session': ckan.model.Session,
+            'ignore_auth': True,
+        }
+        status = toolkit.get_action('harvest_source_clear_status')(
+            context, {'id': source_id})
+        assert status['status'] == 'finished'
+        assert status['datasets'] == 3
+
+    def test_resume_clear(self):
+        from ckanext.harvest.logic.action.update import (_start_clear,
+                                                         _clear_source,
+                                                         _get_clear_progress,
+                                                         _set_clear_progress)
+
+        job = factories.HarvestJobFactory()
+        job.save()
+        source_id, job_id = job.source.id, job.id
+        ckan.model.repo.new_revision()
+        for name in ('resumed-a', 'resumed-b'):
+            ckan.model.Session.add(ckan.model.Package(name=name))
+        ckan.model.repo.commit_and_remove()
+        package_ids = sorted(ckan.model.Package.get(name).id
+                             for name in ('resumed-a', 'resumed-b'))
+        for package_id in package_ids:
+            harvest_model.HarvestObject(
+                guid=package_id, job=harvest_model.HarvestJob.get(job_id),
+                source=harvest_model.HarvestSource.get(source_id),
+                package_id=package_id).save()
+
+        # A previous clear was interrupted, and recorded a progress past the
+        # lower package id (as the versions using a cursor on the ids did)
+        _start_clear(ckan.model.Session, source_id)
+        progress = _get_clear_progress(ckan.model.Session, source_id)
+        progress['status'] = 'failed'
+        progress['last_package_id'] = package_ids[0]
+        _set_clear_progress(ckan.model.Session, source_id, progress)
+        ckan.model.Session.commit()
+
+        _start_clear(ckan.model.Session, source_id)
+        _clear_source(ckan.model.Session, source_id, 1)
+        ckan.model.Session.remove()
+
+        for package_id in package_ids:
+            assert not ckan.model.Package.get(package_id)
+        assert not harvest_model.HarvestObject.filter(
+            harvest_source_id=source_id).count()
+
+    def test_clear_locked_source(self):
+        from ckanext.harvest.logic.action.update import (_lock_clear,
+                                                         _unlock_clear)
+
+        job = factories.HarvestJobFactory()
+        job.save()
+        source_id = job.source.id
+        ckan.model.repo.new_revision()
+        ckan.model.Session.add(ckan.model.Package(name='locked-dataset'))
+        ckan.model.repo.commit_and_remove()
+        harvest_model.HarvestObject(
+            guid='locked', job=harvest_model.HarvestJob.get(job.id),
+            source=harvest_model.HarvestSource.get(source_id),
+            package_id=ckan.model.Package.get('locked-dataset').id).save()
+
+        # Another process is clearing the source
+        lock = _lock_clear(ckan.model, source_id)
+        assert lock is not None
+        try:
+            assert _lock_clear(ckan.model, source_id) is None
+            context = {
+                'model': ckan.model,
+                'session': ckan.model.Session,
+                'ignore_auth': True,
+            }
+            toolkit.get_action('harvest_source_clear')(context,
+                                                       {'id': source_id})
+        finally:
+            _unlock_clear(lock, source_id)
+        ckan.model.Session.remove()
+
+        assert ckan.model.Package.get('locked-dataset')
+
+        # Once released the lock can be taken again
+        lock = _lock_clear(ckan.model, source_id)
+        assert lock is not None
+        _unlock_clear(lock, source_id)
+
+
+class RecordingSolrConnection(object):
+    '''Solr connection keeping the documents added'''
+    requests = []
+
+    def add_many(self, docs, _commit=False):
+        self.requests.append(docs)
+
+    def commit(self, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
+class FailingSolrConnection(object):
+    def delete_query(self, query):
+        raise Exception('Solr is down')
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class TestOrphansRemove(unittest.TestCase):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        ckan.model.repo.rebuild_db()
+
+    def _create_source_with_datasets(self, prefix):
+        job = factories.HarvestJobFactory()
+        job.save()
+        source_id, job_id = job.source.id, job.id
+
+        ckan.model.repo.new_revision()
+        org = ckan.model.Group(name=prefix + '-org', type='organization',
+                               is_organization=True)
+        ckan.model.Session.add(org)
+        ckan.model.Session.flush()
+        ckan.model.Session.add(ckan.model.Package(
+            id=source_id, name=prefix + '-source', type='harvest',
+            owner_org=org.id))
+        for name in ('orphan', 'harvested', 'local'):
+            ckan.model.Session.add(ckan.model.Package(
+                name='%s-%s' % (prefix, name), type='dataset',
+                owner_org=org.id))
+        ckan.model.repo.commit_and_remove()
+
+        local = ckan.model.Package.get(prefix + '-local')
+        ckan.model.repo.new_revision()
+        local.extras = {'metadata-source': 'dms'}
+        ckan.model.repo.commit_and_remove()
+
+        harvest_model.HarvestObject(
+            guid='harvested', job=harvest_model.HarvestJob.get(job_id),
+            source=harvest_model.HarvestSource.get(source_id),
+            package_id=ckan.model.Package.get(prefix + '-harvested').id).save()
+        return source_id
+
+    def _remove_orphans(self, source_id):
+        context = {
+            'model': ckan.model,
+            'session': ckan.model.Session,
+            'ignore_auth': True,
+        }
+        return toolkit.get_action('harvest_orphans_remove')(
+            context, {'source_id': source_id})
+
+    def _state(self, name):
+        ckan.model.Session.remove()
+        return ckan.model.Package.get(name).state
+
+    def test_remove_orphans(self):
+        source_id = self._create_source_with_datasets('orphans')
+
+        assert self._remove_orphans(source_id) == 1
+
+        assert self._state('orphans-orphan') == 'deleted'
+        assert self._state('orphans-harvested') == 'active'
+        assert self._state('orphans-local') == 'active'
+        assert self._state('orphans-source') == 'active'
+
+    def test_index_failure_keeps_orphans(self):
+        from ckan.lib.search.common import SearchIndexError
+        from ckanext.harvest.logic.action import update
+
+        source_id = self._create_source_with_datasets('unindexed')
+
+        make_connection = update.make_connection
+        update.make_connection = FailingSolrConnection
+        try:
+            self.assertRaises(SearchIndexError, self._remove_orphans,
+                              source_id)
+        finally:
+            update.make_connection = make_connection
+
+        # The datasets are still active, so they can be removed again
+        assert self._state('unindexed-orphan') == 'active'
+
+
+class TestHarvestObjectsImport(unittest.TestCase):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        ckan.model.repo.rebuild_db()
+
+    def test_import_updates_guid_fingerprint(self):
+        source = factories.HarvestSourceFactory(type='test-for-action')
+        source.save()
+        job = factories.HarvestJobFactory(source=source)
+        job.save()
+        ckan.model.repo.new_revision()
+        ckan.model.Session.add(ckan.model.Package(name='reimported'))
+        ckan.model.repo.commit_and_remove()
+        package_id = ckan.model.Package.get('reimported').id
+        obj = harvest_model.HarvestObject(
+            guid='reimported', job=harvest_model.HarvestJob.get(job.id),
+            source=harvest_model.HarvestSource.get(source.id),
+            package_id=package_id, current=True, state=u'COMPLETE')
+        obj.content = u'{"name": "reimported"}'
+        obj.save()
+        source_id, obj_id = source.id, obj.id
+
+        context = {
+            'model': ckan.model,
+            'session': ckan.model.Session,
+            'ignore_auth': True,
+        }
+        count = toolkit.get_action('harvest_objects_import')(
+            context, {'harvest_object_id': obj_id})
+        ckan.model.Session.remove()
+
+        assert count == 1
+        fingerprint = ckan.model.Session.query(
+            harvest_model.HarvestGuidFingerprint) \
+            .filter_by(harvest_source_id=source_id, guid=u'reimported').one()
+        assert fingerprint.harvest_object_id == obj_id
+        assert fingerprint.package_id == package_id
+
+    def test_import_overrides_restored(self):
+        source = factories.HarvestSourceFactory(type='test-for-action')
+        source.save()
+        job = factories.HarvestJobFactory(source=source)
+        job.save()
+        obj = harvest_model.HarvestObject(guid='overridden', job=job,
+                                          source=source, current=True)
+        obj.content = u'{"name": "overridden"}'
+        obj.save()
+
+        harvester = [h for h in p.PluginImplementations(IHarvester)
+                     if h.info()['name'] == 'test-for-action'][0]
+        seen = []
+        def import_stage(harvest_object):
+            seen.append((harvester.force_import, harvester.http_cache_mode))
+            return True
+        harvester.force_import = False
+        harvester.http_cache_mode = None
+        harvester.import_stage = import_stage
+        try:
+            context = {
+                'model': ckan.model,
+                'session': ckan.model.Session,
+                'ignore_auth': True,
+                'http_cache_mode': 'replay',
+            }
+            toolkit.get_action('harvest_objects_import')(
+                context, {'harvest_object_id': obj.id})
+
+            # The harvester is back to its normal mode afterwards
+            assert seen == [(True, 'replay')], seen
+            assert harvester.force_import is False
+            assert harvester.http_cache_mode is None
+        finally:
+            del harvester.force_import
+            del harvester.http_cache_mode
+            del harvester.import_stage
@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_raises
+
+from ckanext.harvest.archive import SegmentArchive, ArchiveLocked
+
+
+class TestSegmentArchive(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append_read(self):
+        archive = SegmentArchive(self.directory)
+        archive.lock()
+        locations = archive.append(['first', 'second'])
+        locations.extend(archive.append(['third']))
+        archive.unlock()
+
+        assert [archive.read(*location) for location in locations] == \
+            ['first', 'second', 'third']
+        archive.close()
+
+    def test_new_segments(self):
+        archive = SegmentArchive(self.directory, segment_size=10)
+        archive.lock()
+        locations = archive.append(['a' * 6, 'b' * 6, 'c' * 20])
+        archive.close()
+
+        assert [segment for segment, offset, length in locations] == [0, 1, 2]
+        assert len(os.listdir(self.directory)) == 4
+
+        archive = SegmentArchive(self.directory, segment_size=10)
+        archive.lock()
+        location = archive.append(['d'])[0]
+        assert location == (3, 0, 1)
+        assert archive.read(*location) == 'd'
+        assert archive.read(*locations[1]) == 'b' * 6
+        archive.close()
+
+    def test_single_writer(self):
+        archive = SegmentArchive(self.directory)
+        archive.lock()
+        other = SegmentArchive(self.directory)
+        assert_raises(ArchiveLocked, other.lock)
+        archive.unlock()
+        other.lock()
+        other.close()
@@ -0,0 +1,124 @@
+import os
+import json
+import shutil
+import tempfile
+import urllib
+
+from nose.tools import assert_raises
+from pylons import config
+
+from ckan import model
+
+import ckanext.harvest.model as harvest_model
+from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.httpcache import get_response_cache
+from ckanext.harvest.harvesters.ckanharvester import CKANHarvester, \
+    ContentFetchError
+
+import factories
+
+HEADERS = {'User-Agent': 'ckanext_harvest'}
+
+
+class TestGetContentStream(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.harvester = CKANHarvester()
+        self.harvester.config = {}
+
+    def teardown(self):
+        for key in ('ckanext.harvest.spool_threshold',
+                    'ckanext.harvest.max_response_size',
+                    'ckanext.harvest.http_cache.dir'):
+            config.pop(key, None)
+        shutil.rmtree(self.directory)
+
+    def _file_url(self, body):
+        path = os.path.join(self.directory, 'response.json')
+        with open(path, 'wb') as f:
+            f.write(body)
+        return 'file://' + urllib.pathname2url(path)
+
+    def test_small_response_kept_in_memory(self):
+        url = self._file_url('{"result": []}')
+
+        content = self.harvester._get_content_stream(url)
+        try:
+            assert not content._rolled
+            assert content.read() == '{"result": []}'
+        finally:
+            content.close()
+
+    def test_large_response_spooled(self):
+        config['ckanext.harvest.spool_threshold'] = '10'
+        body = json.dumps({'result': ['dataset-%i' % i for i in range(100)]})
+        url = self._file_url(body)
+
+        content = self.harvester._get_content_stream(url)
+        try:
+            assert content._rolled
+            assert content.read() == body
+        finally:
+            content.close()
+
+    def test_response_too_large(self):
+        config['ckanext.harvest.max_response_size'] = '10'
+        url = self._file_url('x' * 11)
+
+        assert_raises(ContentFetchError,
+                      self.harvester._get_content_stream, url)
+
+    def test_cached_response_too_large(self):
+        config['ckanext.harvest.http_cache.dir'] = self.directory
+        config['ckanext.harvest.max_response_size'] = '10'
+        url = 'http://remote.test.com/api/3/action/package_list'
+        get_response_cache().set(url, HEADERS, 'x' * 11)
+        self.harvester.http_cache_mode = 'replay'
+
+        assert_raises(ContentFetchError,
+                      self.harvester._get_content_stream, url)
+
+    def test_replay_without_cached_response(self):
+        config['ckanext.harvest.http_cache.dir'] = self.directory
+        self.harvester.http_cache_mode = 'replay'
+
+        assert_raises(ContentFetchError, self.harvester._get_content_stream,
+                      'http://remote.test.com/api/3/action/package_list')
+
+
+class TestFetchStage(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        config['ckanext.harvest.http_cache.dir'] = self.directory
+
+    def teardown(self):
+        config.pop('ckanext.harvest.http_cache.dir', None)
+        shutil.rmtree(self.directory)
+
+    def test_fetch_stage_from_cached_response(self):
+        job = factories.HarvestJobFactory()
+        job.save()
+        obj = HarvestObject(guid=u'remote-dataset', job=job,
+                            source=job.source)
+        obj.save()
+        package_dict = {'id': u'remote-dataset', 'title': u'Remote dataset',
+                        'extras': []}
+        url = job.source.url + \
+            '/api/3/action/package_show?id=remote-dataset'
+        get_response_cache().set(url, HEADERS,
+                                 json.dumps({'result': package_dict}))
+
+        harvester = CKANHarvester()
+        harvester.http_cache_mode = 'replay'
+
+        assert harvester.fetch_stage(obj) is True
+        assert json.loads(obj.content) == package_dict
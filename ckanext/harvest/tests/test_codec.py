@@ -0,0 +1,68 @@
+import sys
+from StringIO import StringIO
+
+from nose.tools import assert_raises
+
+from ckanext.harvest import codec
+
+BACKENDS = ('ujson', 'simplejson')
+
+
+def _reload_codec(missing=()):
+    '''Reloads the codec module as if the given libraries were not
+    installed'''
+    saved = dict((name, sys.modules.get(name)) for name in missing)
+    try:
+        for name in missing:
+            # Makes the import fail
+            sys.modules[name] = None
+        reload(codec)
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+
+class TestCodec(object):
+
+    def teardown(self):
+        _reload_codec()
+
+    def _check_round_trip(self):
+        document = {u'name': u'dataset', u'title': u'Caf\xe9',
+                    u'url': u'http://test.com/a/b', u'tags': [1, 2.5, None]}
+
+        encoded = codec.dumps(document)
+        assert '\\/' not in encoded, encoded
+        assert codec.loads(encoded) == document
+
+        f = StringIO()
+        codec.dump(document, f)
+        f.seek(0)
+        assert codec.load(f) == document
+
+        assert_raises(ValueError, codec.loads, '{"name": ')
+        assert_raises(TypeError, codec.dumps, object())
+
+        # Floats keep their full precision
+        value = 0.12345678901234
+        assert codec.loads(codec.dumps(value)) == value
+        assert codec.loads(codec.dumps({'value': 1e-300}))['value'] == 1e-300
+
+    def test_default_backend(self):
+        assert codec.backend in BACKENDS + ('json',)
+        self._check_round_trip()
+
+    def test_fallback_to_simplejson(self):
+        _reload_codec(missing=('ujson',))
+
+        assert codec.backend in ('simplejson', 'json')
+        self._check_round_trip()
+
+    def test_fallback_to_json(self):
+        _reload_codec(missing=BACKENDS)
+
+        assert codec.backend == 'json'
+        self._check_round_trip()
@@ -0,0 +1,51 @@
+import json
+import zlib
+
+from ckanext.harvest.delta import make_delta, apply_delta
+
+
+class TestDelta(object):
+
+    def test_round_trip(self):
+        base = u''.join(u'<line>%i</line>\n' % i for i in range(100))
+        content = base.replace(u'<line>10</line>', u'<line>ten</line>') \
+                      .replace(u'<line>50</line>\n', u'') + u'<last/>'
+
+        delta = make_delta(base, content)
+
+        assert apply_delta(base, delta) == content
+        assert len(delta) < len(content) / 10
+
+    def test_unrelated_documents(self):
+        base = u'{"a": 1}\n'
+        content = u'<?xml version="1.0"?>\n<b>\xe9</b>'
+
+        assert apply_delta(base, make_delta(base, content)) == content
+
+    def test_empty_documents(self):
+        assert apply_delta(u'', make_delta(u'', u'content')) == u'content'
+        assert apply_delta(u'content', make_delta(u'content', u'')) == u''
+
+    def test_single_line_json(self):
+        package = {'name': 'dataset', 'title': 'Dataset',
+                   'notes': 'Measurements of the monitoring stations. ' * 5,
+                   'metadata_modified': '2015-03-01T10:00:00.123456',
+                   'resources': [{'id': 'resource-%i' % i,
+                                  'url': 'http://test.com/file-%i.csv' % i,
+                                  'format': 'CSV', 'size': 1000 + i}
+                                 for i in range(10)]}
+        base = unicode(json.dumps(package))
+        package['metadata_modified'] = '2015-03-02T11:00:00.654321'
+        package['resources'][3]['size'] = 99999
+        content = unicode(json.dumps(package))
+
+        delta = make_delta(base, content)
+
+        assert apply_delta(base, delta) == content
+        assert len(zlib.compress(delta)) < len(zlib.compress(content)) / 2
+
+    def test_line_based_delta(self):
+        # Deltas stored by previous versions copy whole lines
+        delta = json.dumps([[0, 2], u'x\n'])
+
+        assert apply_delta(u'a\nb\nc\n', delta) == u'a\nb\nx\n'
@@ -0,0 +1,688 @@
+import datetime
+import shutil
+import tempfile
+
+from nose.plugins.skip import SkipTest
+
+from ckan import model
+
+import ckanext.harvest.model as harvest_model
+from ckanext.harvest.model import HarvestObject, HarvestGuidFingerprint
+from ckanext.harvest.harvesters import base
+from ckanext.harvest.harvesters.base import HarvesterBase
+import ckanext.harvest.queue as queue
+
+import factories
+
+
+class MockHarvester(HarvesterBase):
+    def info(self):
+        return {'name': 'test-base', 'title': 'test', 'description': 'test'}
+
+
+def _create_package(name):
+    model.repo.new_revision()
+    package = model.Package(name=name)
+    model.Session.add(package)
+    model.repo.commit_and_remove()
+    return model.Package.get(name)
+
+
+class TestGuidFingerprints(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def test_get_changed_guids(self):
+        job = factories.HarvestJobFactory()
+        job.save()
+
+        for guid, name in (('guid1', 'fingerprint-1'),
+                           ('guid2', 'fingerprint-2'),
+                           ('guid3', 'fingerprint-3')):
+            package = _create_package(name)
+            HarvestGuidFingerprint(harvest_source_id=job.source.id,
+                                   guid=guid,
+                                   metadata_modified_date=datetime.datetime(2015, 1, 1),
+                                   package_id=package.id).save()
+
+        harvester = MockHarvester()
+        new, changed, deleted = harvester._get_changed_guids(job, [
+            ('guid1', '2015-01-01T00:00:00'),
+            ('guid2', '2015-02-01T00:00:00+00:00'),
+            ('guid4', None),
+            ('guid1', '2015-01-01T00:00:00'),
+        ])
+
+        assert new == ['guid4'], new
+        assert changed == ['guid2'], changed
+        assert deleted == ['guid3'], deleted
+
+    def test_update_guid_fingerprint(self):
+        job = factories.HarvestJobFactory()
+        job.save()
+        package = _create_package('fingerprint-update')
+
+        obj = HarvestObject(guid='guid-update', job=job,
+                            package_id=package.id, current=True,
+                            state='COMPLETE', report_status='added',
+                            content_hash=u'abc',
+                            metadata_modified_date=datetime.datetime(2015, 1, 1))
+        obj.save()
+
+        queue.update_guid_fingerprint(obj)
+
+        fingerprint = model.Session.query(HarvestGuidFingerprint) \
+                .filter_by(guid='guid-update').one()
+        assert fingerprint.harvest_object_id == obj.id
+        assert fingerprint.package_id == package.id
+        assert fingerprint.content_hash == u'abc'
+
+        obj.current = False
+        obj.report_status = 'deleted'
+        obj.save()
+
+        queue.update_guid_fingerprint(obj)
+
+        assert model.Session.query(HarvestGuidFingerprint) \
+                .filter_by(guid='guid-update').count() == 0
+
+
+class TestSkipUnchanged(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def _create_objects(self, package_name, content):
+        package = _create_package(package_name)
+        job = factories.HarvestJobFactory()
+        job.save()
+        previous = HarvestObject(guid=package_name, job=job, source=job.source,
+                                 package_id=package.id, current=True,
+                                 state=u'COMPLETE',
+                                 import_finished=datetime.datetime.utcnow())
+        previous.content = u'{"title": "Same"}'
+        previous.save()
+        obj = HarvestObject(guid=package_name, job=job, source=job.source)
+        obj.content = content
+        obj.save()
+        return previous, obj
+
+    def test_same_content_skipped(self):
+        previous, obj = self._create_objects(u'unchanged', u'{"title": "Same"}')
+
+        harvester = MockHarvester()
+        assert harvester._is_unchanged(obj).id == previous.id
+        assert harvester._skip_unchanged(obj)
+
+        assert obj.report_status == 'unchanged'
+        assert obj.package_id == previous.package_id
+
+    def test_changed_content_imported(self):
+        previous, obj = self._create_objects(u'changed', u'{"title": "Other"}')
+
+        harvester = MockHarvester()
+        assert harvester._is_unchanged(obj) is None
+        assert not harvester._skip_unchanged(obj)
+        assert obj.report_status != 'unchanged'
+
+    def test_force_import(self):
+        previous, obj = self._create_objects(u'forced', u'{"title": "Same"}')
+
+        harvester = MockHarvester()
+        harvester.force_import = True
+        assert harvester._is_unchanged(obj) is None
+
+
+class TestCreateHarvestObjects(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def test_create_harvest_objects_in_batches(self):
+        job = factories.HarvestJobFactory()
+        job.save()
+
+        harvester = MockHarvester()
+        guids = ('guid-batch-%i' % i for i in range(5))
+        object_ids = harvester._create_harvest_objects_in_batches(
+            guids, job, batch_size=2)
+
+        assert len(object_ids) == 5
+        objects = model.Session.query(HarvestObject) \
+                .filter(HarvestObject.id.in_(object_ids)).all()
+        assert sorted(obj.guid for obj in objects) == \
+                ['guid-batch-%i' % i for i in range(5)]
+        for obj in objects:
+            assert obj.harvest_source_id == job.source.id
+            assert obj.state == 'WAITING'
+
+
+class TestImportContext(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def teardown(self):
+        base.clear_import_context()
+
+    def _create_object(self):
+        from ckan.plugins import toolkit
+
+        site_user = toolkit.get_action('get_site_user')(
+            {'model': model, 'ignore_auth': True}, {})['name']
+        source_dict = toolkit.get_action('harvest_source_create')(
+            {'model': model, 'session': model.Session, 'user': site_user},
+            {'url': u'http://context.test.com', 'name': u'context-source',
+             'title': u'Context source', 'source_type': u'test',
+             'frequency': u'MANUAL'})
+        source = harvest_model.HarvestSource.get(source_dict['id'])
+        job = factories.HarvestJobFactory(source=source)
+        job.save()
+        obj = HarvestObject(guid=u'context', job=job, source=source)
+        obj.save()
+        return obj
+
+    def test_import_context_cached(self):
+        obj = self._create_object()
+        harvester = MockHarvester()
+
+        import_context = harvester._get_import_context(obj)
+        assert import_context['source_id'] == obj.harvest_source_id
+        assert import_context['source_package']['id'] == obj.harvest_source_id
+
+        # Built once per job, even by other harvester instances
+        assert MockHarvester()._get_import_context(obj) is import_context
+
+        # Built again once the harvest source is modified
+        model.Session.execute(
+            'UPDATE package SET metadata_modified = :modified WHERE id = :id',
+            {'modified': datetime.datetime.utcnow() + datetime.timedelta(days=1),
+             'id': obj.harvest_source_id})
+        model.Session.commit()
+        rebuilt = harvester._get_import_context(obj)
+        assert rebuilt is not import_context
+        assert harvester._get_import_context(obj) is rebuilt
+
+        # And after clearing the cache
+        base.clear_import_context(obj.harvest_source_id)
+        assert harvester._get_import_context(obj) is not rebuilt
+
+
+class TestLocalGroups(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def setup(self):
+        base.clear_group_cache()
+
+    def test_find_local_group(self):
+        model.repo.new_revision()
+        model.Session.add(model.Group(name=u'local-group'))
+        model.repo.commit_and_remove()
+
+        harvester = MockHarvester()
+        group = harvester._find_local_group(u'local-group')
+        assert group['name'] == u'local-group'
+        assert harvester._find_local_group(u'local-group',
+                                           is_organization=True) is None
+
+    def test_create_local_group_once(self):
+        harvester = MockHarvester()
+        assert harvester._find_local_group(u'new-group') is None
+
+        created = []
+        def create():
+            created.append(True)
+            model.repo.new_revision()
+            group = model.Group(name=u'new-group')
+            model.Session.add(group)
+            model.repo.commit()
+            return {'id': group.id, 'name': group.name}
+
+        group = harvester._create_local_group(u'new-group', create)
+        assert group['name'] == u'new-group'
+
+        base.clear_group_cache()
+        assert harvester._create_local_group(u'new-group', create) == group
+        assert len(created) == 1
+
+
+class TestExistingPackages(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def test_get_existing_package(self):
+        package = _create_package('existing-package')
+
+        base.prefetch_packages([package.id, 'missing-id'])
+
+        harvester = MockHarvester()
+        existing = harvester._get_existing_package(package.id)
+        assert existing['name'] == 'existing-package'
+        assert existing['state'] == package.state
+        assert existing['metadata_modified'] == package.metadata_modified.isoformat()
+        assert harvester._get_existing_package('missing-id') is None
+
+        # Prefetched packages are only used once
+        assert package.id not in base._prefetched_packages
+        assert harvester._get_existing_package(package.id)['id'] == package.id
+
+
+class TestAllocatePackageNames(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def test_allocate_package_names(self):
+        _create_package('taken-name')
+
+        names = harvest_model.allocate_package_names(
+            [u'Taken name', u'Free name', u'Free name'])
+        model.Session.rollback()
+
+        assert names[0] != 'taken-name'
+        assert names[0].startswith('taken-name-'), names
+        assert names[1] == 'free-name'
+        assert names[2] != 'free-name'
+        assert names[2].startswith('free-name-'), names
+
+    def test_skip_name_reserved_by_another_transaction(self):
+        # Another process is creating a dataset with the same name
+        connection = model.meta.engine.connect()
+        transaction = connection.begin()
+        try:
+            connection.execute(
+                '''SELECT pg_advisory_xact_lock(
+                   ('x' || substr(md5('package-name:reserved-name'), 1, 15))
+                   ::bit(60)::bigint)''')
+
+            names = harvest_model.allocate_package_names([u'Reserved name'])
+            model.Session.rollback()
+        finally:
+            transaction.rollback()
+            connection.close()
+
+        assert names[0].startswith('reserved-name-'), names
+
+
+class TestIndexes(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def test_migrate_indexes(self):
+        from sqlalchemy.engine.reflection import Inspector
+
+        model.Session.remove()
+        model.meta.engine.execute(
+            'DROP INDEX harvest_object_current_package_id_idx')
+        inspector = Inspector.from_engine(model.meta.engine)
+        missing = harvest_model.get_missing_indexes(inspector)
+        assert [index.name for index in missing] == \
+            ['harvest_object_current_package_id_idx']
+
+        harvest_model.migrate_indexes()
+        # Running it again does nothing
+        harvest_model.migrate_indexes()
+
+        inspector = Inspector.from_engine(model.meta.engine)
+        assert harvest_model.get_missing_indexes(inspector) == []
+
+
+class TestMigrateContents(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        harvest_model.legacy_content_table = None
+        model.repo.rebuild_db()
+
+    def test_migrate_contents(self):
+        job = factories.HarvestJobFactory()
+        job.save()
+        objects = [HarvestObject(guid=u'legacy-%i' % i, job=job,
+                                 source=job.source) for i in range(3)]
+        for obj in objects:
+            obj.save()
+        object_ids = [obj.id for obj in objects]
+        model.Session.remove()
+
+        # The contents are stored in harvest_object, as before v9
+        model.Session.execute(
+            'ALTER TABLE harvest_object ADD COLUMN content text')
+        for i, object_id in enumerate(object_ids):
+            model.Session.execute('''UPDATE harvest_object SET content = :c
+                                     WHERE id = :id''',
+                                  {'c': u'content %i' % (i % 2),
+                                   'id': object_id})
+        model.Session.commit()
+        harvest_model.setup()
+        assert harvest_model.legacy_content_table == ('harvest_object', 'id')
+
+        # They are read from their old place until they are moved
+        assert HarvestObject.get(object_ids[0]).content == u'content 0'
+        model.Session.remove()
+
+        assert harvest_model.migrate_contents(batch_size=2) == 3
+        model.Session.remove()
+
+        assert harvest_model.legacy_content_table is None
+        assert 'content' not in \
+            harvest_model._get_column_names('harvest_object')
+        for i, object_id in enumerate(object_ids):
+            obj = HarvestObject.get(object_id)
+            assert obj.content_hash
+            assert obj.content == u'content %i' % (i % 2)
+        assert model.Session.query(harvest_model.HarvestContentBlob) \
+                .count() == 2
+
+        # Running it again does nothing
+        assert harvest_model.migrate_contents() == 0
+
+    def test_migrate_contents_from_side_table(self):
+        job = factories.HarvestJobFactory()
+        job.save()
+        objects = [HarvestObject(guid=u'side-%i' % i, job=job,
+                                 source=job.source) for i in range(2)]
+        for obj in objects:
+            obj.save()
+        kept_id, deleted_id = [obj.id for obj in objects]
+        model.Session.remove()
+
+        # The contents are stored in the side table used by v8
+        model.Session.execute('''
+            CREATE TABLE harvest_object_content (
+                harvest_object_id text PRIMARY KEY
+                    REFERENCES harvest_object (id),
+                content text)''')
+        model.Session.execute('''
+            INSERT INTO harvest_object_content
+            SELECT id, 'side content' FROM harvest_object''')
+        model.Session.commit()
+        harvest_model.setup()
+        assert harvest_model.legacy_content_table == \
+            ('harvest_object_content', 'harvest_object_id')
+
+        # Objects can be deleted before their content is moved
+        model.Session.execute('DELETE FROM harvest_object WHERE id = :id',
+                              {'id': deleted_id})
+        model.Session.commit()
+
+        assert harvest_model.migrate_contents() == 1
+        model.Session.remove()
+
+        assert harvest_model.get_legacy_content_table() is None
+        assert HarvestObject.get(kept_id).content == u'side content'
+
+
+class TestDeltaEncoding(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def _create_versions(self, count):
+        job = factories.HarvestJobFactory()
+        job.save()
+        lines = [u'<line>%i</line>\n' % i for i in range(200)]
+        objects = []
+        for version in range(count):
+            lines[0] = u'<version>%i</version>\n' % version
+            obj = HarvestObject(guid=u'delta-guid', job=job,
+                                source=job.source,
+                                current=(version == count - 1),
+                                gathered=datetime.datetime(2015, 1, 1 + version))
+            obj.content = u''.join(lines)
+            obj.save()
+            objects.append(obj)
+        return job, objects
+
+    def test_delta_encode_contents(self):
+        job, objects = self._create_versions(5)
+        contents = [obj.content for obj in objects]
+
+        encoded = harvest_model.delta_encode_contents(source_id=job.source.id,
+                                                      max_chain=3)
+        model.Session.remove()
+
+        # The current content and the one after three deltas are kept whole
+        assert encoded == 3, encoded
+        for obj, content in zip(objects, contents):
+            obj = HarvestObject.get(obj.id)
+            assert obj.content == content
+        blobs = dict((blob.content_hash, blob) for blob in
+                     model.Session.query(harvest_model.HarvestContentBlob))
+        assert blobs[objects[-1].content_hash].base_hash is None
+        assert blobs[objects[0].content_hash].base_hash is None
+        assert blobs[objects[1].content_hash].base_hash == \
+            objects[2].content_hash
+
+        # Running it again does nothing
+        assert harvest_model.delta_encode_contents(
+            source_id=job.source.id, max_chain=3) == 0
+
+
+class TestArchiveContents(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def setup(self):
+        from pylons import config
+        self.directory = tempfile.mkdtemp()
+        config['ckanext.harvest.archive.dir'] = self.directory
+
+    def teardown(self):
+        from pylons import config
+        config.pop('ckanext.harvest.archive.dir', None)
+        shutil.rmtree(self.directory)
+
+    def test_archive_contents(self):
+        from ckanext.harvest.archive import get_archive
+
+        job = factories.HarvestJobFactory()
+        job.save()
+        old = HarvestObject(guid=u'archived', job=job, source=job.source,
+                            current=False,
+                            gathered=datetime.datetime(2015, 1, 1))
+        old.content = u'old content'
+        old.save()
+        current = HarvestObject(guid=u'archived', job=job, source=job.source,
+                                current=True,
+                                gathered=datetime.datetime(2015, 1, 2))
+        current.content = u'current content'
+        current.save()
+
+        count = harvest_model.archive_contents(
+            get_archive(), datetime.datetime(2016, 1, 1))
+        model.Session.remove()
+
+        assert count == 1
+        blob = harvest_model.HarvestContentBlob.get(old.content_hash)
+        assert blob.data is None
+        assert blob.archive_segment == 0
+        assert harvest_model.HarvestContentBlob.get(current.content_hash).data
+        assert HarvestObject.get(old.id).content == u'old content'
+        assert HarvestObject.get(current.id).content == u'current content'
+
+        # Harvesting the same content again brings it back to the database
+        obj = HarvestObject.get(old.id)
+        obj.content = u'old content'
+        obj.save()
+        assert harvest_model.HarvestContentBlob.get(old.content_hash).data
+
+
+class TestPurgeHistory(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def _create_job(self, source, day):
+        job = factories.HarvestJobFactory(source=source, status=u'Finished',
+                                          created=datetime.datetime(2015, 1, day))
+        job.save()
+        return job
+
+    def test_purge_history(self):
+        first = factories.HarvestJobFactory(status=u'Finished',
+                                            created=datetime.datetime(2015, 1, 1))
+        first.save()
+        source = first.source
+        second = self._create_job(source, 2)
+        third = self._create_job(source, 3)
+
+        old = HarvestObject(guid=u'purged', job=first, source=source,
+                            current=False)
+        old.content = u'old content'
+        old.save()
+        harvest_model.HarvestObjectError(object=old, message=u'Error').save()
+        current = HarvestObject(guid=u'kept', job=second, source=source,
+                                current=True)
+        current.content = u'current content'
+        current.save()
+        latest = HarvestObject(guid=u'purged', job=third, source=source,
+                               current=False)
+        latest.save()
+        old_id, old_hash, current_id = old.id, old.content_hash, current.id
+        first_id, second_id, third_id = first.id, second.id, third.id
+        model.Session.remove()
+
+        deleted = harvest_model.purge_history(keep_jobs=1)
+        contents = harvest_model.collect_content_garbage()
+        model.Session.remove()
+
+        assert deleted == {'jobs': 1, 'objects': 1}, deleted
+        assert contents == 1
+        assert not HarvestObject.get(old_id)
+        assert not harvest_model.HarvestContentBlob.get(old_hash)
+        assert not harvest_model.HarvestJob.get(first_id)
+        # The job with a current object and the last job are kept
+        assert harvest_model.HarvestJob.get(second_id)
+        assert harvest_model.HarvestJob.get(third_id)
+        assert HarvestObject.get(current_id).content == u'current content'
+
+    def test_purge_history_keeps_last_object_of_package(self):
+        package = _create_package(u'purge-no-current')
+        first = factories.HarvestJobFactory(status=u'Finished',
+                                            created=datetime.datetime(2015, 1, 1))
+        first.save()
+        source = first.source
+        second = self._create_job(source, 2)
+        self._create_job(source, 3)
+
+        # The last import of the package failed, so it has no current object
+        old = HarvestObject(guid=u'no-current', job=first, source=source,
+                            package_id=package.id, current=False,
+                            gathered=datetime.datetime(2015, 1, 1))
+        old.save()
+        last = HarvestObject(guid=u'no-current', job=second, source=source,
+                             package_id=package.id, current=False,
+                             gathered=datetime.datetime(2015, 1, 2))
+        last.save()
+        old_id, last_id, second_id = old.id, last.id, second.id
+        model.Session.remove()
+
+        harvest_model.purge_history(keep_jobs=1)
+        model.Session.remove()
+
+        assert not HarvestObject.get(old_id)
+        assert HarvestObject.get(last_id)
+        assert harvest_model.HarvestJob.get(second_id)
+
+
+class TestPartitions(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+        version = model.Session.execute('SHOW server_version_num').scalar()
+        if int(version) < 110000:
+            raise SkipTest('Partitioning requires PostgreSQL 11')
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+        # Create the harvest tables again without partitions
+        model.Session.remove()
+        model.meta.engine.execute('DROP TABLE %s CASCADE' % ', '.join(
+            table.name for table in model.meta.metadata.sorted_tables
+            if table.name.startswith('harvest_')))
+        harvest_model.setup()
+
+    def test_migrate_partitions(self):
+        from sqlalchemy.engine.reflection import Inspector
+
+        job = factories.HarvestJobFactory()
+        job.save()
+        obj = HarvestObject(guid=u'partitioned', job=job, source=job.source,
+                            current=True)
+        obj.content = u'content'
+        obj.save()
+        harvest_model.HarvestObjectError(object=obj, message=u'Error').save()
+        obj_id = obj.id
+        model.Session.remove()
+
+        harvest_model.migrate_partitions(4)
+        # Running it again does nothing
+        harvest_model.migrate_partitions(4)
+        model.Session.remove()
+
+        assert harvest_model.get_partitioned_tables() == \
+            set(['harvest_object', 'harvest_object_error'])
+        obj = HarvestObject.get(obj_id)
+        assert obj.content == u'content'
+        assert [error.message for error in obj.errors] == [u'Error']
+
+        new_obj = HarvestObject(guid=u'new', job=obj.job, source=obj.source)
+        new_obj.save()
+        assert HarvestObject.get(new_obj.id)
+
+        inspector = Inspector.from_engine(model.meta.engine)
+        assert harvest_model.get_missing_indexes(inspector) == []
@@ -0,0 +1,222 @@
+import socket
+import urllib2
+import datetime
+
+from nose.tools import assert_raises
+from pylons import config
+
+from ckan import model
+
+import ckanext.harvest.model as harvest_model
+from ckanext.harvest.model import HarvestObject, HarvestObjectError, \
+                                  HarvestRemoteHost
+from ckanext.harvest import hosts
+from ckanext.harvest.hosts import acquire_host_slot, HostBusy, \
+                                  check_host_circuit, HostUnavailable, \
+                                  record_fetch_result, is_host_error, \
+                                  report_host_failure, CIRCUIT_OPEN, \
+                                  CIRCUIT_CLOSED
+from ckanext.harvest.queue import get_busy_delay, HOST_BUSY_DELAYS, \
+                                  fetch_and_import_stages, \
+                                  resubmit_parked_objects
+
+import factories
+
+
+def _create_object(url):
+    source = factories.HarvestSourceFactory(url=url)
+    source.save()
+    job = factories.HarvestJobFactory(source=source)
+    job.save()
+    obj = HarvestObject(guid=u'guid', job=job, source=source)
+    obj.save()
+    return obj
+
+
+class TestHostLimits(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def setup(self):
+        hosts._busy_until.clear()
+
+    def teardown(self):
+        for key in ('ckanext.harvest.host_rate_limit',
+                    'ckanext.harvest.host_burst',
+                    'ckanext.harvest.host_max_in_flight'):
+            config.pop(key, None)
+        hosts._busy_until.clear()
+
+    def test_no_limits(self):
+        obj = _create_object(u'http://unlimited.test.com')
+
+        for i in range(5):
+            lease = acquire_host_slot(obj)
+            assert lease.id is None
+            lease.release()
+
+    def test_token_bucket(self):
+        config['ckanext.harvest.host_rate_limit'] = '0.1'
+        config['ckanext.harvest.host_burst'] = '2'
+        obj = _create_object(u'http://rate.test.com')
+
+        # The burst is let through, then the host is out of tokens
+        acquire_host_slot(obj).release()
+        acquire_host_slot(obj).release()
+        assert_raises(HostBusy, acquire_host_slot, obj)
+
+        # The time until the host has a token again is remembered, so the
+        # database is not queried meanwhile
+        assert hosts._busy_until[u'rate.test.com']
+        try:
+            acquire_host_slot(obj)
+        except HostBusy, e:
+            assert 0 < e.wait <= 10, e.wait
+        else:
+            assert False, 'HostBusy not raised'
+
+    def test_max_in_flight(self):
+        config['ckanext.harvest.host_max_in_flight'] = '1'
+        obj = _create_object(u'http://in-flight.test.com')
+
+        lease = acquire_host_slot(obj)
+        assert lease.id
+        assert_raises(HostBusy, acquire_host_slot, obj)
+
+        # Once the lease is released the host has a free slot again
+        lease.release()
+        acquire_host_slot(obj).release()
+
+    def test_source_config_overrides_limits(self):
+        config['ckanext.harvest.host_max_in_flight'] = '1'
+        obj = _create_object(u'http://override.test.com')
+        obj.source.config = u'{"host_max_in_flight": 2}'
+        obj.source.save()
+
+        first = acquire_host_slot(obj)
+        second = acquire_host_slot(obj)
+        assert_raises(HostBusy, acquire_host_slot, obj)
+        first.release()
+        second.release()
+
+
+class FailingHarvester(object):
+    '''Harvester whose fetch stage fails, reporting a host failure or not'''
+
+    def __init__(self, host_failure):
+        self.host_failure = host_failure
+
+    def fetch_stage(self, harvest_object):
+        if self.host_failure:
+            report_host_failure(harvest_object)
+        return None
+
+
+class TestCircuitBreaker(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def setup(self):
+        config['ckanext.harvest.host_failure_threshold'] = '2'
+
+    def teardown(self):
+        config.pop('ckanext.harvest.host_failure_threshold', None)
+        config.pop('ckanext.harvest.host_park_timeout', None)
+
+    def _get_host(self, host):
+        model.Session.remove()
+        return HarvestRemoteHost.get(host)
+
+    def test_is_host_error(self):
+        def http_error(code):
+            return urllib2.HTTPError('http://test.com', code, 'Error', {}, None)
+
+        assert is_host_error(http_error(500))
+        assert is_host_error(http_error(503))
+        assert not is_host_error(http_error(404))
+        assert is_host_error(urllib2.URLError('Connection refused'))
+        assert is_host_error(socket.timeout('timed out'))
+        assert not is_host_error(ValueError('Invalid JSON'))
+
+    def test_open_probe_and_close(self):
+        obj = _create_object(u'http://failing.test.com')
+
+        record_fetch_result(obj, False)
+        check_host_circuit(obj)
+        record_fetch_result(obj, False)
+        assert self._get_host(u'failing.test.com').state == CIRCUIT_OPEN
+        assert_raises(HostUnavailable, check_host_circuit, obj)
+
+        # Once the probe is due a single object is let through
+        model.Session.execute('''UPDATE harvest_remote_host
+                                 SET next_probe = :past
+                                 WHERE host = :host''',
+                              {'past': datetime.datetime(2000, 1, 1),
+                               'host': u'failing.test.com'})
+        model.Session.commit()
+        check_host_circuit(obj)
+        assert_raises(HostUnavailable, check_host_circuit, obj)
+
+        # The host has recovered
+        assert record_fetch_result(obj, True) is True
+        assert self._get_host(u'failing.test.com').state == CIRCUIT_CLOSED
+        check_host_circuit(obj)
+
+    def test_only_host_errors_count(self):
+        obj = _create_object(u'http://not-found.test.com')
+
+        # The host responded, eg with a missing document
+        fetch_and_import_stages(FailingHarvester(host_failure=False), obj)
+        fetch_and_import_stages(FailingHarvester(host_failure=False), obj)
+        remote_host = self._get_host(u'not-found.test.com')
+        assert not remote_host or not remote_host.consecutive_failures
+
+        obj = HarvestObject.get(obj.id)
+        fetch_and_import_stages(FailingHarvester(host_failure=True), obj)
+        assert self._get_host(u'not-found.test.com').consecutive_failures == 1
+
+    def test_resubmit_parked_objects(self):
+        config['ckanext.harvest.host_park_timeout'] = '3600'
+        expired = _create_object(u'http://parked.test.com')
+        expired.state = u'PARKED'
+        expired.gathered = datetime.datetime(2000, 1, 1)
+        expired.save()
+        parked = HarvestObject(guid=u'parked', job=expired.job,
+                               source=expired.source, state=u'PARKED')
+        parked.save()
+        expired_id, parked_id = expired.id, parked.id
+        model.Session.remove()
+
+        # The circuit of the host is closed
+        assert resubmit_parked_objects(u'parked.test.com') == 1
+        model.Session.remove()
+
+        assert HarvestObject.get(parked_id).state == u'WAITING'
+        assert HarvestObject.get(expired_id).state == u'ERROR'
+        assert model.Session.query(HarvestObjectError) \
+                .filter_by(harvest_object_id=expired_id).count() == 1
+
+
+class TestBusyDelay(object):
+
+    def test_delay_doubles_with_retries(self):
+        assert get_busy_delay(0, 0) == HOST_BUSY_DELAYS[0]
+        assert get_busy_delay(0, 1) == HOST_BUSY_DELAYS[1]
+        assert get_busy_delay(0, 3) == HOST_BUSY_DELAYS[3]
+
+    def test_delay_covers_wait(self):
+        assert get_busy_delay(1.5, 0) == HOST_BUSY_DELAYS[4]
+
+    def test_delay_is_bounded(self):
+        assert get_busy_delay(0, 100) == HOST_BUSY_DELAYS[-1]
+        assert get_busy_delay(3600, 0) == HOST_BUSY_DELAYS[-1]
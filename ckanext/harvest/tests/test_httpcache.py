@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+
+from ckanext.harvest.httpcache import ResponseCache
+
+
+class TestResponseCache(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _blob_path(self, cache, url):
+        with open(cache._key_path(cache.key(url))) as f:
+            return cache._blob_path(f.read())
+
+    def test_get_set(self):
+        cache = ResponseCache(self.directory)
+        headers = {'User-Agent': 'ckanext_harvest'}
+
+        assert cache.get('http://test.com/a', headers) is None
+
+        cache.set('http://test.com/a', headers, 'content a')
+
+        assert cache.get('http://test.com/a', headers) == 'content a'
+        assert cache.get('http://test.com/a', {'Authorization': 'key'}) is None
+        assert cache.get('http://test.com/b', headers) is None
+
+    def test_same_content_stored_once(self):
+        cache = ResponseCache(self.directory)
+
+        cache.set('http://test.com/a', {}, 'same content')
+        cache.set('http://test.com/b', {}, 'same content')
+
+        blobs = [f for d, ds, fs in os.walk(os.path.join(self.directory, 'blobs'))
+                 for f in fs]
+        assert len(blobs) == 1, blobs
+        assert cache.get('http://test.com/b', {}) == 'same content'
+
+    def test_evict_least_recently_used(self):
+        cache = ResponseCache(self.directory, max_size=25)
+
+        cache.set('http://test.com/a', {}, 'a' * 10)
+        cache.set('http://test.com/b', {}, 'b' * 10)
+        blob_a = self._blob_path(cache, 'http://test.com/a')
+        blob_b = self._blob_path(cache, 'http://test.com/b')
+        os.utime(blob_a, (1000, 1000))
+        os.utime(blob_b, (2000, 2000))
+
+        cache.set('http://test.com/c', {}, 'c' * 10)
+
+        assert cache.get('http://test.com/a', {}) is None
+        assert cache.get('http://test.com/b', {}) == 'b' * 10
+        assert cache.get('http://test.com/c', {}) == 'c' * 10
+
+    def test_evict_to_low_water_mark(self):
+        cache = ResponseCache(self.directory, max_size=35)
+
+        for i, name in enumerate('abcd'):
+            url = 'http://test.com/%s' % name
+            cache.set(url, {}, name * 10)
+            os.utime(self._blob_path(cache, url), (1000 * i, 1000 * i))
+            os.utime(cache._key_path(cache.key(url)), (1000 * i, 1000 * i))
+
+        # The cache is trimmed down to 90% of its maximum size, and the
+        # requests pointing to the removed bodies are removed too
+        assert cache._size == 30, cache._size
+        assert not os.path.exists(
+            cache._key_path(cache.key('http://test.com/a')))
+        assert cache.get('http://test.com/a', {}) is None
+        assert cache.get('http://test.com/d', {}) == 'd' * 10
@@ -7,6 +7,8 @@ import json
 import ckan.logic as logic
 from ckan import model
 
+import factories
+
 
 class TestHarvester(SingletonPlugin):
     implements(IHarvester)
@@ -277,3 +279,144 @@ class TestHarvestQueue(object):
         assert harvest_source_dict['status']['last_job']['stats'] == {'updated': 2, 'deleted': 1}
         assert harvest_source_dict['status']['total_datasets'] == 2
         assert harvest_source_dict['status']['job_count'] == 2
+
+
+class RecordingPublisher(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, body, **kw):
+        self.sent.append(body)
+
+    def close(self):
+        pass
+
+
+class IndexTestHarvester(object):
+    '''Harvester whose import stage links the object to a package, with the
+    given outcome'''
+
+    def __init__(self, package_id, success=True, report_status=None):
+        self.package_id = package_id
+        self.success = success
+        self.report_status = report_status
+
+    def fetch_stage(self, harvest_object):
+        return True
+
+    def import_stage(self, harvest_object):
+        harvest_object.package_id = self.package_id
+        harvest_object.current = True
+        harvest_object.report_status = self.report_status
+        harvest_object.save()
+        return self.success
+
+
+class RecordingSolrConnection(object):
+    '''Solr connection keeping the documents added'''
+    requests = []
+
+    def add_many(self, docs, _commit=False):
+        self.requests.append(docs)
+
+    def commit(self, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
+class TestIndexQueue(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def setup(self):
+        from pylons import config
+        config['ckanext.harvest.async_indexing'] = 'true'
+        self.publisher = queue._index_publisher
+        queue._index_publisher = RecordingPublisher()
+
+    def teardown(self):
+        from pylons import config
+        config.pop('ckanext.harvest.async_indexing', None)
+        queue._index_publisher = self.publisher
+
+    def _create_package(self, name):
+        model.repo.new_revision()
+        package = model.Package(name=name)
+        model.Session.add(package)
+        model.repo.commit_and_remove()
+        return model.Package.get(name).id
+
+    def _import(self, harvester):
+        job = factories.HarvestJobFactory()
+        job.save()
+        obj = HarvestObject(guid=u'guid', job=job, source=job.source)
+        obj.save()
+        queue.fetch_and_import_stages(harvester, obj)
+        return queue._index_publisher.sent
+
+    def test_imported_package_sent(self):
+        package_id = self._create_package(u'index-imported')
+
+        sent = self._import(IndexTestHarvester(package_id))
+
+        assert sent == [{'package_id': package_id}], sent
+
+    def test_failed_import_sent(self):
+        # The import may have changed the dataset before failing
+        package_id = self._create_package(u'index-failed')
+
+        sent = self._import(IndexTestHarvester(package_id, success=False))
+
+        assert sent == [{'package_id': package_id}], sent
+
+    def test_unchanged_package_not_sent(self):
+        package_id = self._create_package(u'index-unchanged')
+
+        sent = self._import(IndexTestHarvester(package_id,
+                                               report_status='unchanged'))
+
+        assert sent == [], sent
+
+    def test_not_sent_without_async_indexing(self):
+        from pylons import config
+        config['ckanext.harvest.async_indexing'] = 'false'
+        package_id = self._create_package(u'index-sync')
+
+        sent = self._import(IndexTestHarvester(package_id))
+
+        assert sent == [], sent
+
+    def test_index_packages_in_one_request(self):
+        package_ids = [self._create_package(u'index-batched-%i' % i)
+                       for i in range(3)]
+        RecordingSolrConnection.requests = []
+
+        make_connection = queue.make_connection
+        queue.make_connection = RecordingSolrConnection
+        try:
+            assert queue.index_packages(package_ids) == 3
+        finally:
+            queue.make_connection = make_connection
+
+        requests = RecordingSolrConnection.requests
+        assert len(requests) == 1, requests
+        assert sorted(doc['id'] for doc in requests[0]) == sorted(package_ids)
+
+    def test_flush_index_queue(self):
+        package_id = self._create_package(u'index-flushed')
+        # Use the queue for real
+        queue._index_publisher = None
+        consumer = queue.get_index_consumer()
+        consumer.queue_purge(queue=queue.get_index_queue_name())
+
+        queue.get_index_publisher().send({'package_id': package_id})
+
+        assert queue.flush_index_queue() == 1
+        assert queue.flush_index_queue() == 0